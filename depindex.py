@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import re
+from typing import Dict
+from typing import List
+
+from invoke import run
+
+INDEX_FILE = ".homelab/depindex.json"
+
+# Files impacting all configurations of a kind, whatever the nix imports
+GLOBAL_DEPENDENCIES = {
+    "nixos": [
+        "flake.nix",
+        "flake.lock",
+        "nixpkgs.nix",
+        "nix/overlays/",
+        "nix/pkgs/",
+        "nix/modules/nixos/",
+    ],
+    "home": [
+        "flake.nix",
+        "flake.lock",
+        "nixpkgs.nix",
+        "nix/overlays/",
+        "nix/pkgs/",
+        "nix/modules/home-manager/",
+    ],
+}
+
+# Configuration declaration in flake.nix
+RE_CONFIGURATION = re.compile(
+    r"^\s*\"?([\w@.-]+)\"?\s*=\s*"
+    r"(nixpkgs\.lib\.nixosSystem|home-manager\.lib\.homeManagerConfiguration)",
+    flags=re.M,
+)
+# Relative path literal in a nix file
+RE_NIXPATH = re.compile(r"(?<![\w/.$])(\.\.?/[\w./+-]*)")
+RE_COMMENT = re.compile(r"#.*$", flags=re.M)
+
+
+##############################################################################
+# Index
+##############################################################################
+
+
+def _git_files() -> List[str]:
+    res = run("git ls-files", hide=True)
+    return res.stdout.splitlines()
+
+
+def _index_key(files: List[str]) -> str:
+    """
+    Compute the index key from the nix files stats
+    """
+    h = hashlib.sha256()
+    for filename in sorted(files):
+        if filename.endswith(".nix") and os.path.exists(filename):
+            st = os.stat(filename)
+            h.update(f"{filename}:{st.st_mtime_ns}:{st.st_size}\n".encode())
+
+    return h.hexdigest()
+
+
+def _nix_references(filename: str) -> List[str]:
+    """
+    Return the paths referenced by a nix file, relative to the project root,
+    directories are suffixed by a /
+    """
+    with open(filename, "r") as fr:
+        content = RE_COMMENT.sub("", fr.read())
+
+    refs = []
+    dirname = os.path.dirname(filename)
+    for m in RE_NIXPATH.finditer(content):
+        path = os.path.normpath(os.path.join(dirname, m.group(1)))
+        # Root references are dynamic paths (ex: hosts/${hostName}),
+        # already covered by the configuration roots
+        if path == ".":
+            continue
+
+        if os.path.isdir(path):
+            refs.append(f"{path}/")
+        elif os.path.exists(path):
+            refs.append(path)
+
+    return refs
+
+
+def _dependencies(roots: List[str]) -> List[str]:
+    """
+    Return all files and directories reachable from the <roots> references
+    """
+    deps = set()
+    todo = list(roots)
+    while todo:
+        path = todo.pop()
+        if path in deps:
+            continue
+        deps.add(path)
+
+        # A directory import load the default.nix
+        if path.endswith("/") and os.path.exists(f"{path}default.nix"):
+            todo.append(f"{path}default.nix")
+
+        if path.endswith(".nix"):
+            todo.extend(_nix_references(path))
+
+    return sorted(deps)
+
+
+def _flake_configurations() -> Dict[str, Dict[str, List[str]]]:
+    """
+    Return the root paths of each nixosConfigurations and
+    homeConfigurations declared in flake.nix
+    """
+    with open("flake.nix", "r") as fr:
+        content = RE_COMMENT.sub("", fr.read())
+
+    configurations = {"nixos": {}, "home": {}}
+    matches = list(RE_CONFIGURATION.finditer(content))
+    for idx, m in enumerate(matches):
+        end = matches[idx + 1].start() if idx + 1 < len(matches) else None
+        block = content[m.end() : end]  # noqa: E203
+
+        kind = "nixos" if m.group(2).endswith("nixosSystem") else "home"
+        roots = []
+        for ref in RE_NIXPATH.finditer(block):
+            path = os.path.normpath(ref.group(1))
+            if os.path.isdir(path):
+                roots.append(f"{path}/")
+            elif os.path.exists(path):
+                roots.append(path)
+
+        configurations[kind][m.group(1)] = roots
+
+    return configurations
+
+
+def load_index() -> Dict[str, Dict[str, List[str]]]:
+    """
+    Return the file dependencies of each configuration, the index is cached
+    in INDEX_FILE until a nix file change
+    """
+    files = _git_files()
+    key = _index_key(files)
+
+    if os.path.exists(INDEX_FILE):
+        with open(INDEX_FILE, "r") as fr:
+            index = json.load(fr)
+            if index.get("key") == key:
+                return index
+
+    index = {"key": key, "nixos": {}, "home": {}}
+    configurations = _flake_configurations()
+    for kind in configurations:
+        for name, roots in configurations[kind].items():
+            index[kind][name] = (
+                _dependencies(roots) + GLOBAL_DEPENDENCIES[kind]
+            )
+
+    os.makedirs(os.path.dirname(INDEX_FILE), exist_ok=True)
+    with open(INDEX_FILE, "w") as fw:
+        fw.write(json.dumps(index, indent=4))
+
+    return index
+
+
+##############################################################################
+# Impact
+##############################################################################
+
+
+def changed_files(ref: str) -> List[str]:
+    """
+    Return the files changed between <ref> and the working tree, with the
+    untracked ones: nix fails on an import of an untracked file, the
+    configurations using it must be deployed (and fail) rather than skipped
+    """
+    res = run(f"git diff --name-only {ref}", hide=True)
+    untracked = run("git ls-files --others --exclude-standard", hide=True)
+    return res.stdout.splitlines() + untracked.stdout.splitlines()
+
+
+def _is_impacted(deps: List[str], files: List[str]) -> bool:
+    for filename in files:
+        for dep in deps:
+            if filename == dep or (
+                dep.endswith("/") and filename.startswith(dep)
+            ):
+                return True
+
+    return False
+
+
+def affected_configurations(ref: str) -> Dict[str, List[str]]:
+    """
+    Return the nixos and home configurations impacted by the changes since
+    <ref>
+    """
+    files = changed_files(ref)
+    index = load_index()
+
+    return {
+        kind: [
+            name
+            for name, deps in index[kind].items()
+            if _is_impacted(deps, files)
+        ]
+        for kind in ["nixos", "home"]
+    }
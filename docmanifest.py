@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+MANIFEST_FILE = ".homelab/docs-manifest.json"
+
+
+def hash_inputs(files: Optional[List[str]] = None, data: Any = None) -> str:
+    """
+    Return the key of a generated page from its input <files> content and
+    its input <data> (homelab.json slice, generator sources, ...)
+    """
+    h = hashlib.sha256()
+    for filename in files or []:
+        h.update(f"{filename}\0".encode())
+        if os.path.exists(filename):
+            with open(filename, "rb") as fr:
+                h.update(hashlib.sha256(fr.read()).digest())
+        else:
+            h.update(b"missing")
+
+    h.update(json.dumps(data, sort_keys=True, default=str).encode())
+
+    return h.hexdigest()
+
+
+def write_if_changed(filename: str, content: str) -> bool:
+    """
+    Write <content> to <filename> only if it differs, return True if the
+    file was written
+    """
+    if os.path.exists(filename):
+        with open(filename, "r") as fr:
+            if fr.read() == content:
+                return False
+
+    with open(filename, "w") as fw:
+        fw.write(content)
+
+    return True
+
+
+class Manifest:
+    """
+    Input key of each generated page, a page is generated again only when
+    its key change
+    """
+
+    def __init__(self, filename: str = MANIFEST_FILE) -> None:
+        self.filename = filename
+        self.pages: Dict[str, str] = {}
+        if os.path.exists(filename):
+            with open(filename, "r") as fr:
+                self.pages = json.load(fr)
+
+    def is_uptodate(self, target: str, key: str) -> bool:
+        return os.path.exists(target) and self.pages.get(target) == key
+
+    def update(self, target: str, key: str) -> None:
+        self.pages[target] = key
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        write_if_changed(self.filename, json.dumps(self.pages, indent=4))
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import re
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+# Generated section markers: [comment]: (>>NAME) ... [comment]: (<<NAME)
+RE_MARKER = re.compile(r"\[comment\]: \((>>|<<)(\w+)\)")
+
+
+def section(marker: str, content: str) -> str:
+    return f"""[comment]: (>>{marker})
+
+{content}
+
+[comment]: (<<{marker})"""
+
+
+def render(content: str, generators: Dict[str, Callable[[], str]]) -> str:
+    """
+    Fill the marker sections of <content> in one pass, a generator is only
+    called when its marker section is present in <content>. An unclosed
+    marker is left as is, the sections inside a section are its content
+    """
+    sections: List[Tuple[int, int, str]] = []
+    opened: Dict[str, int] = {}
+
+    for m in RE_MARKER.finditer(content):
+        kind, marker = m.groups()
+        if marker not in generators:
+            continue
+
+        if kind == ">>":
+            opened.setdefault(marker, m.start())
+        elif marker in opened:
+            start = opened.pop(marker)
+            sections = [s for s in sections if s[0] < start]
+            opened = {k: pos for k, pos in opened.items() if pos < start}
+            sections.append((start, m.end(), marker))
+
+    parts: List[str] = []
+    pos = 0
+    for start, end, marker in sections:
+        parts.append(content[pos:start])
+        parts.append(section(marker, generators[marker]()))
+        pos = end
+    parts.append(content[pos:])
+
+    return "".join(parts)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import subprocess
+import threading
+from typing import Dict
+from typing import Optional
+
+CACHE_FILE = ".homelab/evalcache.json"
+LOCK_FILE = "flake.lock"
+
+# Number of flake sources (trees) kept in the cache
+MAX_SOURCES = 16
+
+
+def _file_hash(filename: str) -> str:
+    h = hashlib.sha256()
+    if os.path.exists(filename):
+        with open(filename, "rb") as fr:
+            h.update(fr.read())
+    else:
+        h.update(b"missing")
+
+    return h.hexdigest()
+
+
+def source_key() -> str:
+    """
+    Return the key of the flake source: the content of the git tracked
+    files (as seen by nix) and the flake.lock content
+    """
+    res = subprocess.run(
+        ["git", "ls-files", "-z"],
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+
+    h = hashlib.sha256()
+    for filename in sorted(res.stdout.decode().split("\0")):
+        if filename:
+            h.update(f"{filename}\0{_file_hash(filename)}\n".encode())
+
+    return f"{h.hexdigest()}-{_file_hash(LOCK_FILE)}"
+
+
+class EvalCache:
+    """
+    drvPath and outPath of the flake attributes evaluated from the current
+    flake source, the entries of the older sources are not used
+    """
+
+    def __init__(self, filename: str = CACHE_FILE) -> None:
+        self.filename = filename
+        self.key = source_key()
+        self._lock = threading.Lock()
+        self._sources: Dict[str, Dict[str, Dict[str, str]]] = {}
+        if os.path.exists(filename):
+            with open(filename, "r") as fr:
+                self._sources = json.load(fr)
+
+        # The current source is the most recent one
+        self.entries = self._sources.pop(self.key, {})
+        self._sources[self.key] = self.entries
+
+    def get(self, attr: str) -> Optional[Dict[str, str]]:
+        with self._lock:
+            return self.entries.get(attr)
+
+    def put(self, attr: str, drv_path: str, out_path: str) -> None:
+        with self._lock:
+            self.entries[attr] = {"drvPath": drv_path, "outPath": out_path}
+
+    def save(self) -> None:
+        with self._lock:
+            for key in list(self._sources)[:-MAX_SOURCES]:
+                del self._sources[key]
+
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            with open(self.filename, "w") as fw:
+                fw.write(json.dumps(self._sources, indent=4))
+
+
+_cache: Optional[EvalCache] = None
+
+
+def load() -> EvalCache:
+    """
+    Return the evaluation cache of the current flake source
+    """
+    global _cache
+
+    if _cache is None or _cache.key != source_key():
+        _cache = EvalCache()
+
+    return _cache
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import subprocess
+import time
+from dataclasses import dataclass
+from typing import Any
+from typing import Dict
+from typing import List
+
+import inventory
+
+# Homelab root of a fake fleet, set for the tasks run against it
+ROOT_ENV = "HOMELAB_ROOT"
+
+# Fake hosts OS, the others hosts are NixOS
+OTHER_OS = ["Nix", "Android", "Chromecast", "GoogleMini", "ArchLinux"]
+HOSTS_BY_ZONE = 25
+
+# Stand-in commands, the "remote" commands are run by the ssh stub on the
+# local computer
+STUBS = {
+    "ssh": """
+target=
+while [ $# -gt 0 ]; do
+    case "$1" in
+        --) shift; break ;;
+        -[oipFlJ]) shift 2 ;;
+        -*) shift ;;
+        *) [ -z "$target" ] || break; target="$1"; shift ;;
+    esac
+done
+# The remote directories (/nix-homelab, ...) does not exist
+cd() { builtin cd "$@" 2>/dev/null || builtin cd "$HOME"; }
+export -f cd
+exec bash -c "$*"
+""",
+    "ping": "",
+    "sudo": """
+while [ "${1#-}" != "$1" ]; do shift; done
+exec "$@"
+""",
+    "nix": """
+src=/nix/store/00000000000000000000000000000000-source
+case "$1 $2" in
+    "flake archive")
+        echo "copying path '$src' from 'local' to 'fleet'" >&2
+        [[ " $* " != *" --json "* ]] || echo '{"path":"'$src'"}' ;;
+    "path-info --json") echo '[{"path":"'$src'","narSize":65536}]' ;;
+    "copy "*)
+        echo "copying path '$src' from 'local' to 'fleet'" >&2 ;;
+    *) exit 1 ;;
+esac
+""",
+    "nix-store": "exit 1",
+    "nix-shell": """
+while [ $# -gt 0 ] && [ "$1" != "--run" ]; do shift; done
+exec bash -c "$2"
+""",
+    "nixos-rebuild": """
+log() { printf '@nix {"action":"%s","id":%s%s}\\n' "$1" "$2" "$3" >&2; }
+for id in 1 2 3; do
+    log start $id ',"type":108,"text":"copying path"'
+    log stop $id
+done
+log start 4 ',"type":101,"text":"downloading"'
+log result 4 ',"type":105,"fields":[4096,4096,0,0]'
+log stop 4
+log start 5 ',"type":105,"text":"building system"'
+log stop 5
+""",
+    "nix-info": """
+echo "system: $(uname -m)-linux, multi-user?: yes, version: nix-env (Nix)"
+""",
+    "inxi": """
+echo "System: Kernel: 6.1.0 arch: x86_64 bits: 64 Console: pty"
+echo "CPU: Info: quad core model: Fake CPU bits: 64 type: MT"
+echo "Memory: RAM: total: 15.52 GiB used: 4.10 GiB (26.4%)"
+echo "Drives: Local Storage: total: 476.94 GiB used: 120.3 GiB"
+""",
+    "lscpu": """
+echo "Architecture:        $(uname -m)"
+echo "CPU(s):              4"
+echo "Model name:          Fake CPU"
+echo "BogoMIPS:            4000.00"
+""",
+    "lstopo": """
+while [ $# -gt 1 ]; do shift; done
+echo '<svg xmlns="http://www.w3.org/2000/svg"/>' > "$1"
+""",
+    "nmap": """
+echo '<?xml version="1.0"?><nmaprun>'
+for target in "$@"; do
+    case "$target" in
+        */*) continue ;;
+        [0-9]*.*.*.[0-9]*) ;;
+        *) continue ;;
+    esac
+    echo "<host><address addr='$target' addrtype='ipv4'/><ports>"
+    for port in 22 80; do
+        echo "<port protocol='tcp' portid='$port'><state state='open'/>"
+        echo "<service name='svc$port' product='fake'/></port>"
+    done
+    echo "</ports></host>"
+done
+echo '</nmaprun>'
+""",
+}
+
+
+@dataclass
+class Measure:
+    command: str
+    hosts: int
+    seconds: float
+    maxrss: int
+    returncode: int
+
+
+def homelab(nbhosts: int, roles: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Return a synthetic homelab inventory of <nbhosts> hosts: an internet
+    box, a router by zone and the zones hosts
+    """
+    hosts: Dict[str, Any] = {}
+    infra = ["coredns", "nix-serve", "ntp"]
+
+    def add(hn: str, system: str, parent: str, zone: str) -> None:
+        idx = len(hosts)
+        hosts[hn] = {
+            "ipv4": f"10.77.{idx // 250}.{idx % 250 + 1}",
+            "os": system,
+            "zone": zone,
+            "parent": parent,
+            "description": f"fake {system} host",
+        }
+
+    add("box", "Sagem", inventory.ROOT_PARENT, "box")
+    zone = 0
+    while len(hosts) < nbhosts:
+        router = f"router-{zone:03d}"
+        add(router, "MikroTik", "box", f"zone-{zone:03d}")
+        for idx in range(HOSTS_BY_ZONE):
+            if len(hosts) >= nbhosts:
+                break
+
+            hn = f"host-{zone:03d}-{idx:02d}"
+            system = "NixOS"
+            if idx % 4 == 3:
+                system = OTHER_OS[(idx // 4) % len(OTHER_OS)]
+            add(hn, system, router, f"zone-{zone:03d}")
+
+            if system == "NixOS":
+                role = infra[idx] if idx < len(infra) else ""
+                hosts[hn]["roles"] = [role] if role in roles else []
+        zone += 1
+
+    return {
+        "domain": "fleet.lan",
+        "networks": {"fleet": {"net": "10.77.0.0", "mask": 16}},
+        "roles": roles,
+        "hosts": hosts,
+    }
+
+
+def create(root: str, source: str, nbhosts: int) -> List[str]:
+    """
+    Create a fake fleet homelab in <root> from the git tracked files of
+    <source>, with the stubs commands in <root>/.fleet/bin, return the
+    NixOS hostnames
+    """
+    res = subprocess.run(
+        ["git", "ls-files", "-z"],
+        cwd=source,
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    for filename in res.stdout.decode().split("\0"):
+        if not filename or not os.path.isfile(f"{source}/{filename}"):
+            continue
+        os.makedirs(os.path.dirname(f"{root}/{filename}"), exist_ok=True)
+        shutil.copy2(f"{source}/{filename}", f"{root}/{filename}")
+
+    with open(f"{source}/{inventory.HOMELAB_FILE}", "r") as fr:
+        roles = json.load(fr).get("roles", {})
+
+    jinfo = homelab(nbhosts, roles)
+    with open(f"{root}/{inventory.HOMELAB_FILE}", "w") as fw:
+        fw.write(json.dumps(jinfo, indent=4))
+
+    bindir = f"{root}/.fleet/bin"
+    os.makedirs(bindir, exist_ok=True)
+    for name, script in STUBS.items():
+        with open(f"{bindir}/{name}", "w") as fw:
+            fw.write(f"#!/usr/bin/env bash\n{script.lstrip()}")
+        os.chmod(f"{bindir}/{name}", 0o755)
+
+    return [hn for hn, h in jinfo["hosts"].items() if h["os"] == "NixOS"]
+
+
+def measure(
+    root: str, command: str, args: List[str], nbhosts: int, logfile: str
+) -> Measure:
+    """
+    Run the <command> (<args>) against the fake fleet in <root>, return
+    its duration and its peak memory (KiB)
+    """
+    env = dict(os.environ)
+    env[ROOT_ENV] = root
+    env["HOME"] = f"{root}/.fleet"
+    env["PATH"] = f"{root}/.fleet/bin:{env['PATH']}"
+
+    with open(logfile, "a") as fw:
+        start = time.monotonic()
+        proc = subprocess.Popen(
+            args, stdin=subprocess.DEVNULL, stdout=fw, stderr=fw, env=env
+        )
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        seconds = time.monotonic() - start
+
+    return Measure(
+        command=command,
+        hosts=nbhosts,
+        seconds=round(seconds, 3),
+        maxrss=rusage.ru_maxrss,
+        returncode=proc.returncode,
+    )
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import signal
+import subprocess
+import time
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from evalcache import EvalCache
+
+# Evaluated attribute of each configuration kind
+ATTRIBUTES = {
+    "nixos": "nixosConfigurations.{}.config.system.build.toplevel",
+    "home": 'homeConfigurations."{}".activationPackage',
+}
+
+APPLY = "d: { drvPath = d.drvPath; outPath = d.outPath; }"
+
+
+@dataclass
+class EvalResult:
+    name: str
+    attr: str
+    drv_path: str = ""
+    out_path: str = ""
+    seconds: float = 0
+    error: str = ""
+    cached: bool = False
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "attr": self.attr,
+            "drvPath": self.drv_path,
+            "outPath": self.out_path,
+            "time": self.seconds,
+            "error": self.error,
+            "cached": self.cached,
+        }
+
+
+def attribute(kind: str, name: str) -> str:
+    return ATTRIBUTES[kind].format(name)
+
+
+def evaluate(name: str, attr: str, max_memory: int = 0) -> EvalResult:
+    """
+    Evaluate the drvPath and outPath of the flake <attr> in a new nix
+    process, its resident memory is limited to <max_memory> MiB (0: no limit)
+    in a systemd user scope: the nix garbage collector reserves more address
+    space than it uses, a virtual memory limit (ulimit -v) would fail the
+    small evaluations
+    """
+    cmd = [
+        "nix",
+        "eval",
+        "--json",
+        "--option",
+        "accept-flake-config",
+        "true",
+        f".#{attr}",
+        "--apply",
+        APPLY,
+    ]
+    if max_memory > 0:
+        cmd = [
+            "systemd-run",
+            "--user",
+            "--scope",
+            "--quiet",
+            "-p",
+            f"MemoryMax={max_memory}M",
+            "-p",
+            "MemorySwapMax=0",
+            "--",
+        ] + cmd
+
+    result = EvalResult(name, attr)
+    start = time.monotonic()
+    proc = subprocess.run(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+    result.seconds = round(time.monotonic() - start, 3)
+
+    if proc.returncode == -signal.SIGKILL and max_memory > 0:
+        result.error = f"out of memory (max {max_memory} MiB)"
+        return result
+    if proc.returncode != 0:
+        lines = proc.stderr.strip().splitlines()
+        result.error = lines[-1] if lines else f"exit {proc.returncode}"
+        return result
+
+    paths = json.loads(proc.stdout)
+    result.drv_path = paths["drvPath"]
+    result.out_path = paths["outPath"]
+
+    return result
+
+
+def evaluate_all(
+    attrs: Dict[str, str],
+    workers: int,
+    max_memory: int = 0,
+    fail_fast: bool = False,
+    cache: Optional[EvalCache] = None,
+) -> List[EvalResult]:
+    """
+    Evaluate the <attrs> (name: attribute) with <workers> nix processes at
+    the same time, return the results in the <attrs> order. If <fail_fast>,
+    the evaluations not started are cancelled at the first error, their
+    results have the "cancelled" error
+
+    The attributes found in the <cache> are not evaluated, the others are
+    added to it
+    """
+    results: Dict[str, EvalResult] = {}
+    todo = {}
+    for name, attr in attrs.items():
+        entry = cache.get(attr) if cache else None
+        if entry:
+            results[name] = EvalResult(
+                name,
+                attr,
+                drv_path=entry["drvPath"],
+                out_path=entry["outPath"],
+                cached=True,
+            )
+        else:
+            todo[name] = attr
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {
+            executor.submit(evaluate, name, attr, max_memory): name
+            for name, attr in todo.items()
+        }
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+
+            result = future.result()
+            results[result.name] = result
+            if cache and not result.error:
+                cache.put(result.attr, result.drv_path, result.out_path)
+            if result.error and fail_fast:
+                for pending in futures:
+                    pending.cancel()
+
+    for name, attr in todo.items():
+        if name not in results:
+            results[name] = EvalResult(name, attr, error="cancelled")
+
+    if cache:
+        cache.save()
+
+    return [results[name] for name in attrs]
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+from dataclasses import asdict
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Union
+
+HOSTS_DIR = "docs/hosts"
+CACHE_FILE = ".homelab/hostsummary.json"
+
+# lscpu fields
+LSCPU_ARCH = "Architecture"
+LSCPU_NB = "CPU(s)"
+LSCPU_MODEL = "Model name"
+LSCPU_BOGOMIPS = "BogoMIPS"
+
+# inxi report
+RE_MEMORY = re.compile(r"Memory:.*RAM: total: .*?([0-9]+\.[0-9]+) GiB")
+RE_DISK = re.compile(r"Local Storage:.*?total.*?: ([0-9]+\.[0-9]+ \w?iB)")
+RE_BITS = re.compile(r"CPU: .*?bits: (.*?) \w+:")
+RE_KERNEL = re.compile(r"System: .*?Kernel: ([0-9]+\.[0-9]+\.[0-9]+)")
+
+
+@dataclass
+class CPUSummary:
+    arch: str = ""
+    model: str = ""
+    nb: str = ""
+    bits: Union[int, str] = 0
+    bogomips: int = 0
+
+
+@dataclass
+class HostSummary:
+    memory: str = ""
+    disk: str = ""
+    kernel: str = ""
+    cpu: CPUSummary = field(default_factory=CPUSummary)
+
+    @classmethod
+    def from_dict(cls, sinfo: Dict[str, Any]) -> "HostSummary":
+        return cls(
+            memory=sinfo.get("memory", ""),
+            disk=sinfo.get("disk", ""),
+            kernel=sinfo.get("kernel", ""),
+            cpu=CPUSummary(**sinfo.get("cpu", {})),
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Return the summary, as saved in summaries.json
+        """
+        return asdict(self)
+
+    def lines(self) -> List[str]:
+        """
+        Return the summary lines of the host documentation
+        """
+        lines = []
+        if self.cpu.arch:
+            lines.append(f"Arch     : {self.cpu.arch}")
+        if self.cpu.model:
+            lines.append(f"CPU      : {self.cpu.nb} x {self.cpu.model}")
+        if self.cpu.bogomips:
+            lines.append(f"BogoMIPS : {self.cpu.bogomips}")
+        if self.memory:
+            lines.append(f"RAM      : {self.memory}")
+        if self.disk:
+            lines.append(f"DISK     : {self.disk}")
+        if self.kernel:
+            lines.append(f"KERNEL   : {self.kernel}")
+
+        return lines
+
+
+##############################################################################
+# Parsers
+##############################################################################
+
+
+def parse_lscpu(content: str, summary: HostSummary) -> None:
+    """
+    Fill the <summary> from the lscpu report, in one pass over the lines
+    """
+    fields: Dict[str, str] = {}
+    for line in content.splitlines():
+        key, sep, value = line.partition(":")
+        if sep:
+            fields.setdefault(key.strip(), value.strip())
+
+    summary.cpu.arch = fields.get(LSCPU_ARCH, "")
+    summary.cpu.model = fields.get(LSCPU_MODEL, "")
+    if fields.get(LSCPU_NB, "").isdigit():
+        summary.cpu.nb = fields[LSCPU_NB]
+
+    try:
+        summary.cpu.bogomips = int(float(fields.get(LSCPU_BOGOMIPS, "")))
+    except ValueError:
+        pass
+
+
+def parse_inxi(content: str, summary: HostSummary) -> None:
+    """
+    Fill the <summary> from the inxi report
+    """
+    m = RE_MEMORY.search(content)
+    if m:
+        # GiB to Go
+        summary.memory = f"{math.floor(float(m.group(1))*1.073741824)} Go"
+
+    m = RE_DISK.search(content)
+    if m:
+        summary.disk = m.group(1)
+
+    m = RE_BITS.search(content)
+    if m:
+        summary.cpu.bits = m.group(1)
+
+    m = RE_KERNEL.search(content)
+    if m:
+        summary.kernel = m.group(1)
+
+
+##############################################################################
+# Cache
+##############################################################################
+
+_lock = threading.Lock()
+_cache: Optional[Dict[str, Dict[str, Any]]] = None
+
+
+def _read(filename: str) -> Optional[bytes]:
+    if not os.path.exists(filename):
+        return None
+
+    with open(filename, "rb") as fr:
+        return fr.read()
+
+
+def load(hostname: str) -> HostSummary:
+    """
+    Return the host summary parsed from its lscpu and inxi reports, the
+    summary is cached in CACHE_FILE until a report change
+    """
+    global _cache
+
+    cpu = _read(f"{HOSTS_DIR}/{hostname}/cpu.txt")
+    hw = _read(f"{HOSTS_DIR}/{hostname}/hardwares.txt")
+
+    h = hashlib.sha256()
+    for content in [cpu, hw]:
+        h.update(hashlib.sha256(content or b"").digest())
+    key = h.hexdigest()
+
+    with _lock:
+        if _cache is None:
+            _cache = {}
+            if os.path.exists(CACHE_FILE):
+                with open(CACHE_FILE, "r") as fr:
+                    _cache = json.load(fr)
+
+        if hostname in _cache and _cache[hostname]["key"] == key:
+            return HostSummary.from_dict(_cache[hostname]["summary"])
+
+    summary = HostSummary()
+    if cpu is not None:
+        parse_lscpu(cpu.decode(errors="replace"), summary)
+    if hw is not None:
+        parse_inxi(hw.decode(errors="replace"), summary)
+
+    with _lock:
+        _cache[hostname] = {"key": key, "summary": summary.to_dict()}
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        with open(CACHE_FILE, "w") as fw:
+            fw.write(json.dumps(_cache, indent=4))
+
+    return summary
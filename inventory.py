@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+HOMELAB_FILE = "homelab.json"
+
+# Parent of the hosts directly connected to internet
+ROOT_PARENT = "internet"
+
+
+class InventoryError(Exception):
+    pass
+
+
+@dataclass
+class Network:
+    name: str
+    net: str
+    mask: int
+
+    @property
+    def cidr(self) -> str:
+        return f"{self.net}/{self.mask}"
+
+
+@dataclass
+class Role:
+    name: str
+    icon: str = ""
+    description: str = ""
+
+
+@dataclass
+class Host:
+    name: str
+    ipv4: str
+    os: str
+    icon: str = ""
+    description: str = ""
+    zone: str = ""
+    parent: str = ""
+    wg: str = ""
+    roles: List[str] = field(default_factory=list)
+    dnsalias: List[str] = field(default_factory=list)
+    # homelab.json host section, as read
+    raw: Dict[str, Any] = field(default_factory=dict)
+
+
+class Inventory:
+    """
+    homelab.json content, with hosts indexes
+    """
+
+    def __init__(self, jinfo: Dict[str, Any]) -> None:
+        self.domain: str = jinfo.get("domain", "")
+        self.networks: Dict[str, Network] = {
+            name: Network(name, net["net"], net["mask"])
+            for name, net in jinfo.get("networks", {}).items()
+        }
+        self.roles: Dict[str, Role] = {
+            name: Role(name, role.get("icon", ""), role.get("description", ""))
+            for name, role in jinfo.get("roles", {}).items()
+        }
+
+        self.hosts: Dict[str, Host] = {}
+        for hn, hinfo in jinfo.get("hosts", {}).items():
+            for key in ["ipv4", "os"]:
+                if key not in hinfo:
+                    raise InventoryError(f"{hn}: missing '{key}' field")
+
+            self.hosts[hn] = Host(
+                name=hn,
+                ipv4=hinfo["ipv4"],
+                os=hinfo["os"],
+                icon=hinfo.get("icon", ""),
+                description=hinfo.get("description", ""),
+                zone=hinfo.get("zone", ""),
+                parent=hinfo.get("parent", ""),
+                wg=hinfo.get("wg", ""),
+                roles=hinfo.get("roles", []),
+                dnsalias=hinfo.get("dnsalias", []),
+                raw=hinfo,
+            )
+
+        # Indexes
+        self.by_ip: Dict[str, Host] = {}
+        self.by_role: Dict[str, List[Host]] = {}
+        self.by_zone: Dict[str, List[Host]] = {}
+        self.by_parent: Dict[str, List[Host]] = {}
+        for host in self.hosts.values():
+            if host.ipv4 in self.by_ip:
+                raise InventoryError(
+                    f"{host.name}: ipv4 {host.ipv4} already used by "
+                    f"{self.by_ip[host.ipv4].name}"
+                )
+            self.by_ip[host.ipv4] = host
+
+            for role in host.roles:
+                if role not in self.roles:
+                    raise InventoryError(
+                        f"{host.name}: role '{role}' not defined in roles"
+                    )
+                self.by_role.setdefault(role, []).append(host)
+
+            if host.zone:
+                self.by_zone.setdefault(host.zone, []).append(host)
+
+            if host.parent:
+                if (
+                    host.parent != ROOT_PARENT
+                    and host.parent not in self.hosts
+                ):
+                    raise InventoryError(
+                        f"{host.name}: unknown parent '{host.parent}'"
+                    )
+                self.by_parent.setdefault(host.parent, []).append(host)
+
+        self._depths: Dict[str, int] = {}
+        for hn in self.hosts:
+            self._depths[hn] = len(self.ancestors(hn))
+
+    def host(self, hostname: str) -> Host:
+        if hostname not in self.hosts:
+            raise InventoryError(f"{hostname}: host not defined")
+
+        return self.hosts[hostname]
+
+    def host_by_ip(self, ip: str) -> Optional[Host]:
+        return self.by_ip.get(ip)
+
+    def hosts_with_role(self, role: str) -> List[Host]:
+        return self.by_role.get(role, [])
+
+    def hosts_in_zone(self, zone: str) -> List[Host]:
+        return self.by_zone.get(zone, [])
+
+    def children(self, hostname: str) -> List[Host]:
+        return self.by_parent.get(hostname, [])
+
+    def ancestors(self, hostname: str) -> List[str]:
+        """
+        Return the parents of the host, from the nearest to the root
+        """
+        ancestors = []
+        host = self.hosts[hostname]
+        while host.parent in self.hosts:
+            if host.parent in ancestors or host.parent == hostname:
+                raise InventoryError(f"{hostname}: parent loop detected")
+            ancestors.append(host.parent)
+            host = self.hosts[host.parent]
+
+        return ancestors
+
+    def depth(self, hostname: str) -> int:
+        return self._depths.get(hostname, 0)
+
+
+_lock = threading.Lock()
+_cache: Dict[str, Tuple[int, Inventory]] = {}
+
+
+def load(filename: str = HOMELAB_FILE) -> Inventory:
+    """
+    Return the homelab inventory, the file is parsed again only when its
+    modification time change
+    """
+    mtime = os.stat(filename).st_mtime_ns
+
+    with _lock:
+        if filename in _cache and _cache[filename][0] == mtime:
+            return _cache[filename][1]
+
+        with open(filename, "r") as fh:
+            inv = Inventory(json.load(fh))
+
+        _cache[filename] = (mtime, inv)
+
+    return inv
@@ -3,4 +3,5 @@
 
 { pkgs ? (import ../nixpkgs.nix) { } }: {
   # example = pkgs.callPackage ./example { };
+  homelab-discovery = pkgs.callPackage ./homelab-discovery { };
 }
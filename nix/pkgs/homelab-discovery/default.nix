@@ -0,0 +1,13 @@
+# Tools used by the hosts discovery (inv docs.scan-all-hosts), pinned by the
+# flake and copied once to the hosts, instead of a nix-shell per discovery step
+{ symlinkJoin, nix-info, inxi, hwloc, nmap, util-linux }:
+symlinkJoin {
+  name = "homelab-discovery";
+  paths = [
+    nix-info
+    (inxi.override { withRecommends = true; })
+    hwloc
+    nmap
+    util-linux
+  ];
+}
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import IO
+from typing import Iterator
+from typing import List
+
+from runlog import format_size
+
+# nix --log-format internal-json line prefix
+PREFIX = "@nix "
+
+# Activity types (nix/src/libutil/logging.hh)
+ACT_FILE_TRANSFER = 101
+ACT_BUILD = 105
+ACT_SUBSTITUTE = 108
+
+# Result types
+RES_SET_PHASE = 104
+RES_PROGRESS = 105
+
+# Message levels
+LVL_ERROR = 0
+
+RE_STORE_PATH = re.compile(r"/nix/store/[a-z0-9]{32}-")
+RE_ANSI = re.compile(r"\x1b\[[0-9;]*m")
+# Error message of a failed build (nix < 2.19, then >= 2.19)
+RE_BUILD_FAILED = re.compile(
+    r"(?:builder for|Cannot build) '(/nix/store/[^']+\.drv)'"
+)
+
+# nix build --dry-run report sections
+RE_DRY_BUILT = re.compile(r"^th(?:ese|is) (?:\d+ )?derivations? will be built")
+RE_DRY_FETCHED = re.compile(
+    r"^th(?:ese|is) (?:\d+ )?paths? will be fetched"
+    r"(?: \(([0-9.]+) (\w+) download, ([0-9.]+) (\w+) unpacked\))?"
+)
+UNITS = {
+    "B": 1,
+    "KiB": 1024,
+    "MiB": 1024**2,
+    "GiB": 1024**3,
+    "TiB": 1024**4,
+}
+
+
+class BuildProgress:
+    """
+    Build counters, updated one nix internal-json log line at a time
+    """
+
+    def __init__(self) -> None:
+        self.substituted = 0
+        self.downloaded = 0
+        self.errors: List[str] = []
+
+        # Derivations of the finished builds, and of the failed ones (the
+        # error message can come before or after the build stop)
+        self.finished: List[str] = []
+        self.failed: List[str] = []
+
+        # Running build and substitute activities, the last one is shown
+        self.running: Dict[int, str] = {}
+        self.types: Dict[int, int] = {}
+        self.transfers: Dict[int, int] = {}
+        self.drvs: Dict[int, str] = {}
+
+    @property
+    def built(self) -> int:
+        return len([drv for drv in self.finished if drv not in self.failed])
+
+    def feed(self, line: str) -> None:
+        if not line.startswith(PREFIX):
+            return
+
+        try:
+            event = json.loads(line.removeprefix(PREFIX))
+        except ValueError:
+            return
+
+        aid = event.get("id", 0)
+        match event.get("action"):
+            case "start":
+                self._start(aid, event.get("type", 0), event.get("text", ""))
+                if event.get("type") == ACT_BUILD and event.get("fields"):
+                    # fields: drvPath, machine, round, nrRounds
+                    self.drvs[aid] = event["fields"][0]
+            case "stop":
+                self._stop(aid)
+            case "result":
+                self._result(aid, event.get("type", 0), event.get("fields"))
+            case "msg":
+                if event.get("level") == LVL_ERROR:
+                    msg = RE_ANSI.sub("", event.get("msg", ""))
+                    self.errors.append(msg)
+                    m = RE_BUILD_FAILED.search(msg)
+                    if m and m.group(1) not in self.failed:
+                        self.failed.append(m.group(1))
+
+    def _start(self, aid: int, atype: int, text: str) -> None:
+        self.types[aid] = atype
+        if atype in [ACT_BUILD, ACT_SUBSTITUTE]:
+            self.running[aid] = RE_STORE_PATH.sub("", text)
+        elif atype == ACT_FILE_TRANSFER:
+            self.transfers[aid] = 0
+
+    def _stop(self, aid: int) -> None:
+        atype = self.types.pop(aid, 0)
+        if atype == ACT_BUILD:
+            self.finished.append(self.drvs.pop(aid, f"#{aid}"))
+        elif atype == ACT_SUBSTITUTE:
+            self.substituted += 1
+        self.running.pop(aid, None)
+        self.transfers.pop(aid, None)
+
+    def _result(self, aid: int, rtype: int, fields: Any) -> None:
+        if not fields:
+            return
+
+        if rtype == RES_PROGRESS and aid in self.transfers:
+            # fields: done, expected, running, failed
+            self.downloaded += fields[0] - self.transfers[aid]
+            self.transfers[aid] = fields[0]
+        elif rtype == RES_SET_PHASE and aid in self.running:
+            text = self.running[aid].split(" (")[0]
+            self.running[aid] = f"{text} ({fields[0]})"
+
+    def activity(self) -> str:
+        if not self.running:
+            return ""
+
+        return self.running[next(reversed(self.running))]
+
+    def status_line(self) -> str:
+        line = f"{self.built} built, "
+        if self.failed:
+            line += f"{len(self.failed)} failed, "
+        line += (
+            f"{self.substituted} substituted, "
+            f"{format_size(self.downloaded)} downloaded"
+        )
+        activity = self.activity()
+        if activity:
+            line += f", {activity}"
+
+        return line
+
+
+@contextmanager
+def follow(
+    filename: str,
+    progress: BuildProgress,
+    display: Callable[[BuildProgress], None],
+    interval: float = 2.0,
+) -> Iterator[IO[Any]]:
+    """
+    Yield a file to use as a command output, its lines are written to
+    <filename> and parsed by <progress>. <display> is called when the
+    status change, at most every <interval> seconds
+    """
+    rfd, wfd = os.pipe()
+
+    def reader() -> None:
+        shown = ""
+        last = 0.0
+        with os.fdopen(rfd, "r", errors="replace") as fr, open(
+            filename, "a"
+        ) as fw:
+            for line in fr:
+                fw.write(line)
+                progress.feed(line)
+
+                now = time.monotonic()
+                if now - last >= interval and progress.status_line() != shown:
+                    shown = progress.status_line()
+                    last = now
+                    display(progress)
+
+        if progress.status_line() != shown:
+            display(progress)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+
+    output = os.fdopen(wfd, "w")
+    try:
+        yield output
+    finally:
+        output.close()
+        thread.join()
+
+
+@dataclass
+class DryRun:
+    """
+    nix build --dry-run report: the derivations to build and the paths to
+    fetch from the substituters
+    """
+
+    built: List[str] = field(default_factory=list)
+    fetched: List[str] = field(default_factory=list)
+    download: int = 0
+    unpacked: int = 0
+
+
+def _bytes(size: str, unit: str) -> int:
+    return int(float(size) * UNITS.get(unit, 1))
+
+
+def parse_dry_run(output: str) -> DryRun:
+    """
+    Return the nix build --dry-run report of <output> (the command stderr)
+    """
+    report = DryRun()
+    section = None
+    for line in RE_ANSI.sub("", output).splitlines():
+        if line.startswith("  /nix/store/") and section is not None:
+            section.append(line.strip())
+            continue
+
+        section = None
+        if RE_DRY_BUILT.match(line):
+            section = report.built
+        elif m := RE_DRY_FETCHED.match(line):
+            section = report.fetched
+            if m.group(1):
+                report.download = _bytes(m.group(1), m.group(2))
+                report.unpacked = _bytes(m.group(3), m.group(4))
+
+    return report
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+
+RUNS_DIR = ".homelab/runs"
+
+# Phases of the whole run, not related to a host
+RUN_HOST = "*"
+
+
+class RunLog:
+    """
+    Timing events of a deploy run, written as JSON lines in RUNS_DIR
+    """
+
+    def __init__(self, command: str, runs_dir: str = RUNS_DIR) -> None:
+        os.makedirs(runs_dir, exist_ok=True)
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.filename = os.path.join(runs_dir, f"{self.id}.jsonl")
+        self.logs_dir = os.path.join(runs_dir, self.id)
+        self.hosts: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self.event("run", command=command)
+
+    def event(self, kind: str, **fields: Any) -> None:
+        line = json.dumps(
+            {"time": round(time.time(), 3), "event": kind, **fields}
+        )
+        with self._lock:
+            _apply(self.hosts, {"event": kind, **fields})
+            with open(self.filename, "a") as fw:
+                fw.write(f"{line}\n")
+
+    @contextmanager
+    def phase(self, hostname: str, name: str) -> Iterator[None]:
+        """
+        Time the <name> phase of the host
+        """
+        start = time.monotonic()
+        status = "ok"
+        try:
+            yield
+        except BaseException:
+            status = "failed"
+            raise
+        finally:
+            self.event(
+                "phase",
+                host=hostname,
+                phase=name,
+                duration=round(time.monotonic() - start, 3),
+                status=status,
+            )
+
+    def status(self, hostname: str, status: str) -> None:
+        self.event("status", host=hostname, status=status)
+
+    def transferred(self, hostname: str, nbytes: int) -> None:
+        self.event("transfer", host=hostname, bytes=nbytes)
+
+    def logfile(self, name: str) -> str:
+        """
+        Return the full command output file of <name> (a host) for this run
+        """
+        os.makedirs(self.logs_dir, exist_ok=True)
+        return os.path.join(self.logs_dir, f"{name}.log")
+
+
+def _apply(hosts: Dict[str, Dict[str, Any]], event: Dict[str, Any]) -> None:
+    """
+    Update the per host summary from a run event
+    """
+    if "host" not in event:
+        return
+
+    host = hosts.setdefault(
+        event["host"], {"phases": {}, "status": "", "bytes": 0}
+    )
+    match event["event"]:
+        case "phase":
+            phases = host["phases"]
+            phases[event["phase"]] = round(
+                phases.get(event["phase"], 0) + event["duration"], 3
+            )
+        case "status":
+            host["status"] = event["status"]
+        case "transfer":
+            host["bytes"] += event["bytes"]
+
+
+##############################################################################
+# Reports
+##############################################################################
+
+
+def list_runs(runs_dir: str = RUNS_DIR) -> List[str]:
+    """
+    Return the run logs, from the oldest to the newest
+    """
+    return sorted(glob.glob(os.path.join(runs_dir, "*.jsonl")))
+
+
+def find_run(run: str, runs_dir: str = RUNS_DIR) -> str:
+    """
+    Return the run log of <run>: a filename, a run id or a negative index
+    (-1 is the last run)
+    """
+    if os.path.exists(run):
+        return run
+
+    runs = list_runs(runs_dir)
+    if run.lstrip("-").isdigit() and runs:
+        return runs[int(run)]
+
+    filename = os.path.join(runs_dir, f"{run}.jsonl")
+    if os.path.exists(filename):
+        return filename
+
+    raise FileNotFoundError(f"{run}: run not found in {runs_dir}")
+
+
+def load_run(filename: str) -> Dict[str, Any]:
+    """
+    Return the command and the per host summary of a run log
+    """
+    run: Dict[str, Any] = {"command": "", "hosts": {}}
+    with open(filename, "r") as fr:
+        for line in fr:
+            event = json.loads(line)
+            if event["event"] == "run":
+                run["command"] = event.get("command", "")
+            _apply(run["hosts"], event)
+
+    return run
+
+
+def format_size(nbytes: int) -> str:
+    size = float(nbytes)
+    for unit in ["B", "KiB", "MiB"]:
+        if size < 1024:
+            return f"{size:.0f}{unit}"
+        size /= 1024
+
+    return f"{size:.1f}GiB"
+
+
+def _duration(seconds: Optional[float], sign: str = "") -> str:
+    if seconds is None:
+        return f"{'-':>10}"
+
+    return f"{seconds:>{sign}9.1f}s"
+
+
+def format_summary(hosts: Dict[str, Dict[str, Any]]) -> List[str]:
+    """
+    Return the run summary table lines, with a column per phase
+    """
+    phases: List[str] = []
+    for host in hosts.values():
+        for phase in host["phases"]:
+            if phase not in phases:
+                phases.append(phase)
+
+    header = f"{'host':<20}" + "".join(f"{p:>11}" for p in phases)
+    lines = [f"{header}{'bytes':>10}  status"]
+    for hn, host in hosts.items():
+        line = f"{hn:<20}"
+        for phase in phases:
+            if phase in host["phases"]:
+                line += f" {_duration(host['phases'][phase])}"
+            else:
+                line += f"{'-':>11}"
+        line += f"{format_size(host['bytes']):>10}  {host['status']}"
+        lines.append(line)
+
+    return lines
+
+
+def compare(
+    before: Dict[str, Dict[str, Any]], after: Dict[str, Dict[str, Any]]
+) -> List[str]:
+    """
+    Return the per host and phase durations difference between two runs
+    """
+    lines = [
+        f"{'host':<20}{'phase':<14}{'before':>10}{'after':>10}{'diff':>10}"
+    ]
+    for hn in sorted(set(before) | set(after)):
+        bphases = before.get(hn, {}).get("phases", {})
+        aphases = after.get(hn, {}).get("phases", {})
+        for phase in list(dict.fromkeys([*bphases, *aphases])):
+            b = bphases.get(phase)
+            a = aphases.get(phase)
+            diff = None if a is None or b is None else a - b
+            lines.append(
+                f"{hn:<20}{phase:<14}"
+                f"{_duration(b)}{_duration(a)}{_duration(diff, '+')}"
+            )
+
+    return lines
@@ -54,6 +54,7 @@ in
       python3.pkgs.invoke
       python3.pkgs.deploykit
       python3.pkgs.xmltodict
+      python3.pkgs.pytest
       wireguard-tools
       openssl_3_0.bin
     ] ++ lib.optional (stdenv.isLinux) mkpasswd;
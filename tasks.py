@@ -1,37 +1,232 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+from __future__ import annotations
+
+import importlib.util
+import inspect
+import io
+import copy
 import json
 import math
 import os
+import platform
 import re
+import shlex
 import shutil
+import signal
+import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict
 from pathlib import Path
+from types import ModuleType
 from typing import Any
 from typing import Callable
+from typing import Dict
 from typing import IO
+from typing import Iterator
 from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import TYPE_CHECKING
+from xml.parsers.expat import ExpatError
 
-import xmltodict
-from deploykit import DeployGroup
-from deploykit import DeployHost
-from deploykit import HostKeyCheck
+import invoke
 from invoke import Collection
 from invoke import run
-from invoke import task
+from invoke import Task
+from invoke.exceptions import CommandTimedOut
+
+import depindex
+import inventory
+import runlog
+
+if TYPE_CHECKING:
+    from deploykit import DeployHost
+
+# The homelab root can be overridden (see bench.fleet)
+ROOT = Path(os.environ.get("HOMELAB_ROOT", Path(__file__).parent)).resolve()
+
+
+class _LazyModule(ModuleType):
+    """
+    Module imported on its first attribute access. importlib.util.LazyLoader
+    is not thread-safe before python 3.12: the deploy threads could see the
+    module while another one was still executing it
+    """
+
+    def __getattr__(self, attr: str) -> Any:
+        # import_module waits for a module being imported by another thread
+        return getattr(importlib.import_module(self.__name__), attr)
+
+
+def _lazy_import(name: str) -> ModuleType:
+    """
+    Return the <name> module, really loaded on its first attribute access
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    if importlib.util.find_spec(name) is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+
+    return _LazyModule(name)
+
+
+# Heavy modules, only loaded by the tasks using them (see bench.startup)
+deploykit = _lazy_import("deploykit")
+xmltodict = _lazy_import("xmltodict")
+docmanifest = _lazy_import("docmanifest")
+hostsummary = _lazy_import("hostsummary")
+taskslib = _lazy_import("taskslib")
+nixlog = _lazy_import("nixlog")
+fakefleet = _lazy_import("fakefleet")
+flakeeval = _lazy_import("flakeeval")
+evalcache = _lazy_import("evalcache")
+urllib_request = _lazy_import("urllib.request")
+LAZY_MODULES = [
+    "deploykit",
+    "xmltodict",
+    "docmanifest",
+    "hostsummary",
+    "taskslib",
+    "nixlog",
+    "fakefleet",
+    "flakeeval",
+    "evalcache",
+    "urllib.request",
+]
+
+
+class RootTask(Task):
+    """
+    Task run from the project root directory
+    """
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        os.chdir(ROOT)
+        return super().__call__(*args, **kwargs)
 
-import taskslib
 
-ROOT = Path(__file__).parent.resolve()
-os.chdir(ROOT)
+def task(*args: Any, **kwargs: Any) -> Any:
+    """
+    invoke task decorator, for a RootTask
+    """
+    kwargs.setdefault("klass", RootTask)
+    return invoke.task(*args, **kwargs)
+
+
+# The flake source is copied as a store path (see _ship_source)
+NIX_SSHOPTS = (
+    "NIX_SSHOPTS='-o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no'"
+)
+RE_COPIED_PATH = re.compile(r"copying path '(/nix/store/[^']+)'")
+
+# Copy of the flake source on the hosts (zfs dataset, see nixos.install)
+HOMELAB_DIR = "/nix-homelab"
+
+# nix-serve default listening port (services.nix-serve.port)
+NIX_SERVE_PORT = 5000
+NIXOS_CACHE = "https://cache.nixos.org"
+
+# Structured nix logs, parsed for the live build status (see nixlog)
+NIX_LOG_FORMAT = "--log-format internal-json"
+
+# Same-zone peers used as substituters (see _peer_substituters): the nearest
+# ones, before the nix-serve (30) and the nixos (40) caches priorities
+PEERS_MAX = 3
+PEERS_PRIORITY = 20
+PEERS_TIMEOUT = 5
+# Print "<ip> <TCP connect microseconds>" of the peers, in parallel, the
+# microseconds are "-" when the root ssh of the host can not login to the
+# peer with its known host keys (the nix-daemon ssh could not either)
+PEERS_PROBE = """
+for ip in {ips}; do
+    (
+        usec=$(timeout 1 bash -c 's=${{EPOCHREALTIME/./}}
+            : 3<>/dev/tcp/$0/22 && echo $(( ${{EPOCHREALTIME/./}} - s ))' \\
+            $ip 2>/dev/null) || exit 0
+        timeout {timeout} ssh -o BatchMode=yes -o ConnectTimeout=2 \\
+            -o StrictHostKeyChecking=yes root@$ip true \\
+            </dev/null >/dev/null 2>&1 || usec=-
+        echo "$ip $usec"
+    ) &
+done
+wait
+"""
+
+# Roles needed by the other hosts, deployed before the leaf hosts
+INFRA_ROLES = ["coredns", "adguard", "nix-serve", "ntp"]
+
+# System links updated by each nixos-rebuild action
+SYSTEM_LINKS = {
+    "test": ["/run/current-system"],
+    "switch": ["/run/current-system", "/nix/var/nix/profiles/system"],
+    "boot": ["/nix/var/nix/profiles/system"],
+}
 
+# Per host result of the last docs.scan-all-hosts
+SCAN_SUMMARY = ".homelab/scan-summary.json"
+
+# Remote discovery steps, output filename, command ({out} is the output file
+# path in the remote working directory) and nix-shell packages used when the
+# homelab-discovery package is not available on the host
+DISCOVERY_COMMANDS = {
+    "Nix": ("nix.txt", "nix-info -m > {out}", "nix-info"),
+    "NixOS": ("nixos.txt", "nix-info -m > {out}", "nix-info"),
+    "Hardwares": (
+        "hardwares.txt",
+        'sudo env PATH="$PATH" inxi -F -a -i --slots -xxx -c0 -i -m --filter > {out}',  # noqa: E501
+        "inxi.override { withRecommends = true; }",
+    ),
+    "CPU": ("cpu.txt", "lscpu > {out}", ""),
+    "Topologie": (
+        "topologie.svg",
+        'sudo env PATH="$PATH" lstopo -f {out}',
+        "hwloc",
+    ),
+}
 
-RSYNC_EXCLUDES = [".git"]
+# homelab-discovery package path for each machine, see _discovery_toolbox
+_toolbox: Optional[Dict[str, str]] = None
+_toolbox_lock = threading.Lock()
+
+# Shell environment of the local nmap command (for non NixOS installation)
+LOCAL_PREFIX = "source /etc/bashrc ; LC_ALL=C"
+
+# nix environment scripts of the multi-user and single-user installations
+NIX_PROFILES = [
+    "/nix/var/nix/profiles/default/etc/profile.d/nix-daemon.sh",
+    "$HOME/.nix-profile/etc/profile.d/nix.sh",
+]
+
+# Host fingerprint, the discovery is skipped while it is unchanged (boot,
+# system, kernel and hardware, without the varying CPU frequencies)
+FINGERPRINT_FILE = "fingerprint"
+FINGERPRINT_COMMAND = (
+    "{ cat /proc/sys/kernel/random/boot_id; readlink -f /run/current-system;"
+    " uname -r; cat /sys/class/dmi/id/board_* /sys/class/dmi/id/product_*;"
+    " grep -v MHz /proc/cpuinfo; } 2>/dev/null | sha256sum | cut -d' ' -f1"
+)
 
 # NOTE: Array order is important (Config section must be computed first)
 OSSCAN = {
-    "NixOS": ["Role", "Scan", "Config", "Topologie", "Hardwares", "Nix"],
-    "Nix": ["Scan", "Config", "Topologie", "Hardwares", "Nix"],
+    "NixOS": [
+        "Role",
+        "Scan",
+        "CPU",
+        "Config",
+        "Topologie",
+        "Hardwares",
+        "Nix",
+    ],
+    "Nix": ["Scan", "CPU", "Config", "Topologie", "Hardwares", "Nix"],
     "MikroTik": [
         "Scan",
     ],
@@ -60,47 +255,39 @@ OSSCAN = {
 
 
 def get_hosts(hosts: str) -> List[DeployHost]:
-    return [DeployHost(h, user="root") for h in hosts.split(",")]
+    return [deploykit.DeployHost(h, user="root") for h in hosts.split(",")]
 
 
 def get_deploylist_from_homelab(username: str, hosts: str) -> List[DeployHost]:
-    with open("homelab.json", "r") as fh:
-        jinfo = json.load(fh)
-        hostslist = jinfo["hosts"]
-
-        if hosts == "":
-            hostnames = hostslist.keys()
-        else:
-            hostnames = hosts.split(",")
+    inv = inventory.load()
 
-        deploylist = []
-        for hn in hostnames:
-            dh = DeployHost(
-                hostslist[hn]["ipv4"],
-                user=username,
-                host_key_check=HostKeyCheck.NONE,
-                meta=dict(hostname=hn, os=hostslist[hn]["os"]),
-            )
-            deploylist.append(dh)
+    if hosts == "":
+        hostslist = list(inv.hosts.values())
+    else:
+        hostslist = [inv.host(hn) for hn in hosts.split(",")]
+
+    deploylist = []
+    for host in hostslist:
+        dh = deploykit.DeployHost(
+            host.ipv4,
+            user=username,
+            host_key_check=deploykit.HostKeyCheck.NONE,
+            meta=dict(hostname=host.name, os=host.os),
+        )
+        deploylist.append(dh)
 
     return deploylist
 
 
 def get_deploylist_from_role(role: str) -> List[DeployHost]:
-    with open("homelab.json", "r") as fh:
-        jinfo = json.load(fh)
-        hostslist = jinfo["hosts"]
-        hostnames = hostslist.keys()
-
-        deploylist = []
-        for hn in hostnames:
-            if "roles" in hostslist[hn] and role in hostslist[hn]["roles"]:
-                dh = DeployHost(
-                    hostslist[hn]["ipv4"],
-                    user="root",
-                    meta=dict(hostname=hn, os=hostslist[hn]["os"]),
-                )
-                deploylist.append(dh)
+    deploylist = []
+    for host in inventory.load().hosts_with_role(role):
+        dh = deploykit.DeployHost(
+            host.ipv4,
+            user="root",
+            meta=dict(hostname=host.name, os=host.os),
+        )
+        deploylist.append(dh)
 
     return deploylist
 
@@ -190,10 +377,10 @@ def disk_mount(c, hosts, mirror="", password=""):
 @task
 def sync_homelab(c, hosts):
     """
-    rsync currently local homelab project to future nixos installation
+    copy the homelab flake source to the future nixos installation
     """
     for h in get_hosts(hosts):
-        _sync_homelab({h.host})
+        _sync_homelab(h)
 
 
 @task
@@ -222,14 +409,14 @@ def nixos_install(c, hosts, flakeattr):
     for h in get_hosts(hosts):
         # Sync project
         info("Sync homelab project")
-        _sync_homelab(h)
+        src = _sync_homelab(h)
 
         # Install nixos
         info("Install NixOS")
         h.run(
-            f"cd /mnt/nix-homelab && nix --extra-experimental-features \
-            'nix-command flakes' shell nixpkgs#git -c nixos-install \
-            --verbose --flake .#{flakeattr} && sync"
+            f"nix --extra-experimental-features 'nix-command flakes' shell \
+            nixpkgs#git -c nixos-install --verbose \
+            --flake path:{src}#{flakeattr} && sync"
         )
 
 
@@ -239,9 +426,23 @@ def nixos_install(c, hosts, flakeattr):
         "cache": "Use binary cache from flake extra-substituers section",
         "keeperror": "Continue, if error",
         "showtrace": "Show trace on error",
+        "buildhost": "Build on <buildhost> (local or hostname), copy to hosts",
+        "affected_since": "Only hosts affected by the changes since <git-ref>",
+        "max_parallel": "Max hosts deployed at the same time (0: unlimited)",
+        "reuse": "Report the system already built on the host, no rebuild",
     },
 )
-def nix_build(c, hostnames="", cache=True, keeperror=True, showtrace=False):
+def nix_build(
+    c,
+    hostnames="",
+    cache=True,
+    keeperror=True,
+    showtrace=False,
+    buildhost="",
+    affected_since="",
+    max_parallel=0,
+    reuse=False,
+):
     """
     Test to <hostnames> server
 
@@ -249,7 +450,16 @@ def nix_build(c, hostnames="", cache=True, keeperror=True, showtrace=False):
 
     """
     _execute_nixos_rebuild(
-        "build", hostnames, False, cache, keeperror, showtrace
+        "build",
+        hostnames,
+        False,
+        cache,
+        keeperror,
+        showtrace,
+        buildhost=buildhost,
+        affected_since=affected_since,
+        max_parallel=max_parallel,
+        reuse=reuse,
     )
 
 
@@ -260,6 +470,18 @@ def nix_build(c, hostnames="", cache=True, keeperror=True, showtrace=False):
         "cache": "Use binary cache from flake extra-substituers section",
         "keeperror": "Continue, if error",
         "showtrace": "Show trace on error",
+        "buildhost": "Build on <buildhost> (local or hostname), copy to hosts",
+        "skipunchanged": "Skip hosts already running the new system",
+        "affected_since": "Only hosts affected by the changes since <git-ref>",
+        "max_parallel": "Max hosts deployed at the same time (0: unlimited)",
+        "canary": "Number of leaf hosts deployed before the others",
+        "waves": "Deploy by waves (infra hosts, canary, others), stop at a "
+        "failed wave",
+        "plan": "Show what each host will build and fetch before deploying",
+        "prefetch": "Fetch the substitutes before the activations (and plan)",
+        "fanout": "Copy once by zone or parent relay, forwarded to children",
+        "peers": "Substitute also from the nearest hosts of the same zone",
+        "reuse": "Activate the system already built on the host, no rebuild",
     },
 )
 def nix_test(
@@ -269,6 +491,17 @@ def nix_test(
     cache=True,
     keeperror=True,
     showtrace=False,
+    buildhost="",
+    skipunchanged=True,
+    affected_since="",
+    max_parallel=0,
+    canary=0,
+    waves=False,
+    plan=False,
+    prefetch=False,
+    fanout=False,
+    peers=False,
+    reuse=False,
 ):
     """
     Test to <hostnames> server
@@ -277,7 +510,23 @@ def nix_test(
 
     """
     _execute_nixos_rebuild(
-        "test", hostnames, discovery, cache, keeperror, showtrace
+        "test",
+        hostnames,
+        discovery,
+        cache,
+        keeperror,
+        showtrace,
+        buildhost=buildhost,
+        skipunchanged=skipunchanged,
+        affected_since=affected_since,
+        max_parallel=max_parallel,
+        canary=canary,
+        waves=waves,
+        plan=plan,
+        prefetch=prefetch,
+        fanout=fanout,
+        peers=peers,
+        reuse=reuse,
     )
 
 
@@ -288,6 +537,18 @@ def nix_test(
         "cache": "Use binary cache from flake extra-substituers section",
         "keeperror": "Continue, if error",
         "showtrace": "Show trace on error",
+        "buildhost": "Build on <buildhost> (local or hostname), copy to hosts",
+        "skipunchanged": "Skip hosts already running the new system",
+        "affected_since": "Only hosts affected by the changes since <git-ref>",
+        "max_parallel": "Max hosts deployed at the same time (0: unlimited)",
+        "canary": "Number of leaf hosts deployed before the others",
+        "waves": "Deploy by waves (infra hosts, canary, others), stop at a "
+        "failed wave",
+        "plan": "Show what each host will build and fetch before deploying",
+        "prefetch": "Fetch the substitutes before the activations (and plan)",
+        "fanout": "Copy once by zone or parent relay, forwarded to children",
+        "peers": "Substitute also from the nearest hosts of the same zone",
+        "reuse": "Activate the system already built on the host, no rebuild",
     },
 )
 def nix_deploy(
@@ -297,6 +558,17 @@ def nix_deploy(
     cache=True,
     keeperror=True,
     showtrace=False,
+    buildhost="",
+    skipunchanged=True,
+    affected_since="",
+    max_parallel=0,
+    canary=0,
+    waves=False,
+    plan=False,
+    prefetch=False,
+    fanout=False,
+    peers=False,
+    reuse=False,
 ):
     """
     Deploy to <hostnames> server
@@ -305,7 +577,23 @@ def nix_deploy(
 
     """
     _execute_nixos_rebuild(
-        "switch", hostnames, discovery, cache, keeperror, showtrace
+        "switch",
+        hostnames,
+        discovery,
+        cache,
+        keeperror,
+        showtrace,
+        buildhost=buildhost,
+        skipunchanged=skipunchanged,
+        affected_since=affected_since,
+        max_parallel=max_parallel,
+        canary=canary,
+        waves=waves,
+        plan=plan,
+        prefetch=prefetch,
+        fanout=fanout,
+        peers=peers,
+        reuse=reuse,
     )
 
 
@@ -316,6 +604,18 @@ def nix_deploy(
         "cache": "Use binary cache from flake extra-substituers section",
         "keeperror": "Continue, if error",
         "showtrace": "Show trace on error",
+        "buildhost": "Build on <buildhost> (local or hostname), copy to hosts",
+        "skipunchanged": "Skip hosts already running the new system",
+        "affected_since": "Only hosts affected by the changes since <git-ref>",
+        "max_parallel": "Max hosts deployed at the same time (0: unlimited)",
+        "canary": "Number of leaf hosts deployed before the others",
+        "waves": "Deploy by waves (infra hosts, canary, others), stop at a "
+        "failed wave",
+        "plan": "Show what each host will build and fetch before deploying",
+        "prefetch": "Fetch the substitutes before the activations (and plan)",
+        "fanout": "Copy once by zone or parent relay, forwarded to children",
+        "peers": "Substitute also from the nearest hosts of the same zone",
+        "reuse": "Activate the system already built on the host, no rebuild",
     },
 )
 def nix_boot(
@@ -325,6 +625,17 @@ def nix_boot(
     cache=True,
     keeperror=True,
     showtrace=False,
+    buildhost="",
+    skipunchanged=True,
+    affected_since="",
+    max_parallel=0,
+    canary=0,
+    waves=False,
+    plan=False,
+    prefetch=False,
+    fanout=False,
+    peers=False,
+    reuse=False,
 ):
     """
     rebuild boot to <hostnames> server
@@ -333,7 +644,56 @@ def nix_boot(
 
     """
     _execute_nixos_rebuild(
-        "boot", hostnames, discovery, cache, keeperror, showtrace
+        "boot",
+        hostnames,
+        discovery,
+        cache,
+        keeperror,
+        showtrace,
+        buildhost=buildhost,
+        skipunchanged=skipunchanged,
+        affected_since=affected_since,
+        max_parallel=max_parallel,
+        canary=canary,
+        waves=waves,
+        plan=plan,
+        prefetch=prefetch,
+        fanout=fanout,
+        peers=peers,
+        reuse=reuse,
+    )
+
+
+@task(
+    name="plan",
+    help={
+        "cache": "Use binary cache from flake extra-substituers section",
+        "showtrace": "Show trace on error",
+        "buildhost": "Plan the builds on <buildhost> (local or hostname)",
+        "prefetch": "Fetch the substitutes where the systems are built",
+    },
+)
+def nix_plan(
+    c, hostnames="", cache=True, showtrace=False, buildhost="", prefetch=False
+):
+    """
+    Show what will be built and fetched for <hostnames> systems
+
+    if <hostnames> is empty, plan all nix homelab server
+    """
+    if hostnames == "":
+        inv = inventory.load()
+        hostnames = ",".join(
+            [hn for hn in depindex.load_index()["nixos"] if hn in inv.hosts]
+        )
+
+    log = runlog.RunLog("nixos.plan")
+    _nixos_plan(
+        get_deploylist_from_homelab("root", hostnames),
+        buildhost,
+        _nix_options(cache, False, showtrace),
+        prefetch,
+        log,
     )
 
 
@@ -342,6 +702,7 @@ nixos.add_task(nix_deploy)
 nixos.add_task(nix_test)
 nixos.add_task(nix_build)
 nixos.add_task(nix_boot)
+nixos.add_task(nix_plan)
 
 ##############################################################################
 # Home-manager (user)
@@ -354,10 +715,19 @@ nixos.add_task(nix_boot)
         "cache": "Use binary cache from flake extra-substituers section",
         "keeperror": "Continue, if error",
         "showtrace": "Show trace on error",
+        "affected_since": "Only hosts affected by the changes since <git-ref>",
+        "max_parallel": "Max hosts deployed at the same time (0: unlimited)",
     },
 )
 def home_build(
-    c, username="", hostnames="", cache=True, keeperror=True, showtrace=False
+    c,
+    username="",
+    hostnames="",
+    cache=True,
+    keeperror=True,
+    showtrace=False,
+    affected_since="",
+    max_parallel=0,
 ):
     """
     Test to <hostnames> server
@@ -366,7 +736,14 @@ def home_build(
 
     """
     _execute_home_remote_deploy(
-        "build", username, hostnames, cache, keeperror, showtrace
+        "build",
+        username,
+        hostnames,
+        cache,
+        keeperror,
+        showtrace,
+        affected_since=affected_since,
+        max_parallel=max_parallel,
     )
 
 
@@ -376,6 +753,11 @@ def home_build(
         "cache": "Use binary cache from flake extra-substituers section",
         "keeperror": "Continue, if error",
         "showtrace": "Show trace on error",
+        "affected_since": "Only hosts affected by the changes since <git-ref>",
+        "max_parallel": "Max hosts deployed at the same time (0: unlimited)",
+        "canary": "Number of leaf hosts deployed before the others",
+        "waves": "Deploy by waves (infra hosts, canary, others), stop at a "
+        "failed wave",
     },
 )
 def home_deploy(
@@ -385,6 +767,10 @@ def home_deploy(
     cache=True,
     keeperror=True,
     showtrace=False,
+    affected_since="",
+    max_parallel=0,
+    canary=0,
+    waves=False,
 ):
     """
     Deploy to <hostnames> server
@@ -393,7 +779,16 @@ def home_deploy(
 
     """
     _execute_home_remote_deploy(
-        "switch", username, hostnames, cache, keeperror, showtrace
+        "switch",
+        username,
+        hostnames,
+        cache,
+        keeperror,
+        showtrace,
+        affected_since=affected_since,
+        max_parallel=max_parallel,
+        canary=canary,
+        waves=waves,
     )
 
 
@@ -408,15 +803,34 @@ home.add_task(home_build)
         "cache": "Use binary cache from flake extra-substituers section",
         "keeperror": "Continue, if error",
         "showtrace": "Show trace on error",
+        "buildhost": "Build on <buildhost> (local or hostname), copy to hosts",
+        "max_parallel": "Max hosts deployed at the same time (0: unlimited)",
     },
 )
-def role_build(c, role, cache=True, keeperror=True, showtrace=False):
+def role_build(
+    c,
+    role,
+    cache=True,
+    keeperror=True,
+    showtrace=False,
+    buildhost="",
+    max_parallel=0,
+):
     """
     Build for all hosts contains the role
     """
 
     deploylist = get_deploylist_from_role(role)
-    _nixos_rebuild(deploylist, "build", False, cache, keeperror, showtrace)
+    _nixos_rebuild(
+        deploylist,
+        "build",
+        False,
+        cache,
+        keeperror,
+        showtrace,
+        buildhost=buildhost,
+        max_parallel=max_parallel,
+    )
 
 
 @task(
@@ -426,17 +840,45 @@ def role_build(c, role, cache=True, keeperror=True, showtrace=False):
         "cache": "Use binary cache from flake extra-substituers section",
         "keeperror": "Continue, if error",
         "showtrace": "Show trace on error",
+        "buildhost": "Build on <buildhost> (local or hostname), copy to hosts",
+        "skipunchanged": "Skip hosts already running the new system",
+        "max_parallel": "Max hosts deployed at the same time (0: unlimited)",
+        "canary": "Number of leaf hosts deployed before the others",
+        "waves": "Deploy by waves (infra hosts, canary, others), stop at a "
+        "failed wave",
     },
 )
 def role_test(
-    c, role, discovery=True, cache=True, keeperror=True, showtrace=False
+    c,
+    role,
+    discovery=True,
+    cache=True,
+    keeperror=True,
+    showtrace=False,
+    buildhost="",
+    skipunchanged=True,
+    max_parallel=0,
+    canary=0,
+    waves=False,
 ):
     """
     Test for all hosts contains the role
     """
 
     deploylist = get_deploylist_from_role(role)
-    _nixos_rebuild(deploylist, "test", discovery, cache, keeperror, showtrace)
+    _nixos_rebuild(
+        deploylist,
+        "test",
+        discovery,
+        cache,
+        keeperror,
+        showtrace,
+        buildhost=buildhost,
+        skipunchanged=skipunchanged,
+        max_parallel=max_parallel,
+        canary=canary,
+        waves=waves,
+    )
 
 
 @task(
@@ -446,10 +888,26 @@ def role_test(
         "cache": "Use binary cache from flake extra-substituers section",
         "keeperror": "Continue, if error",
         "showtrace": "Show trace on error",
+        "buildhost": "Build on <buildhost> (local or hostname), copy to hosts",
+        "skipunchanged": "Skip hosts already running the new system",
+        "max_parallel": "Max hosts deployed at the same time (0: unlimited)",
+        "canary": "Number of leaf hosts deployed before the others",
+        "waves": "Deploy by waves (infra hosts, canary, others), stop at a "
+        "failed wave",
     },
 )
 def role_deploy(
-    c, role, discovery=True, cache=True, keeperror=True, showtrace=False
+    c,
+    role,
+    discovery=True,
+    cache=True,
+    keeperror=True,
+    showtrace=False,
+    buildhost="",
+    skipunchanged=True,
+    max_parallel=0,
+    canary=0,
+    waves=False,
 ):
     """
     Deploy for all hosts contains the role
@@ -457,7 +915,17 @@ def role_deploy(
 
     deploylist = get_deploylist_from_role(role)
     _nixos_rebuild(
-        deploylist, "switch", discovery, cache, keeperror, showtrace
+        deploylist,
+        "switch",
+        discovery,
+        cache,
+        keeperror,
+        showtrace,
+        buildhost=buildhost,
+        skipunchanged=skipunchanged,
+        max_parallel=max_parallel,
+        canary=canary,
+        waves=waves,
     )
 
 
@@ -498,41 +966,77 @@ init.add_task(nixos_generate_config)
 init.add_task(nixos_install)
 
 
-@task(name="all_pages")
-def doc_generate_all_pages(c):
+@task(
+    name="all_pages",
+    help={"force": "Generate the pages even if their inputs are unchanged"},
+)
+def doc_generate_all_pages(c, force=False):
     """
     generate all homelab documentation
     """
 
-    _doc_update_hosts_pages()
-    taskslib._doc_update_main_project_page()
+    _doc_update_hosts_pages(force)
+    taskslib._doc_update_main_project_page(ns, force)
 
 
-@task(name="main_page")
-def doc_generate_main_page(c):
+@task(
+    name="main_page",
+    help={"force": "Generate the page even if its inputs are unchanged"},
+)
+def doc_generate_main_page(c, force=False):
     """
     generate main homelab page
     """
 
-    taskslib._doc_update_main_project_page()
+    taskslib._doc_update_main_project_page(ns, force)
 
 
-@task(name="host_pages")
-def doc_generate_hosts_pages(c):
+@task(
+    name="host_pages",
+    help={"force": "Generate the pages even if their inputs are unchanged"},
+)
+def doc_generate_hosts_pages(c, force=False):
     """
     generate all homelab hosts page
     """
 
-    _doc_update_hosts_pages()
+    _doc_update_hosts_pages(force)
 
 
-@task(name="scan_all_hosts")
-def doc_scan_all_hosts(c, hosts=""):
+@task(
+    name="scan_all_hosts",
+    help={
+        "workers": "Number of hosts scanned at the same time",
+        "deadline": "Max seconds for each host discovery (0: unlimited)",
+        "step_timeout": "Max seconds for each discovery step (0: unlimited)",
+        "scan_timeout": "Max seconds for the nmap ports scan (0: unlimited)",
+        "force": "Scan the hosts even if their fingerprint is unchanged",
+        "networks": "Scan the ports of the homelab networks, not hosts IPs",
+    },
+)
+def doc_scan_all_hosts(
+    c,
+    hosts="",
+    workers=8,
+    deadline=300,
+    step_timeout=120,
+    scan_timeout=300,
+    force=False,
+    networks=False,
+):
     """
     Retrieve all hosts system infromations
     """
     deploylist = get_deploylist_from_homelab("root", hosts)
-    _scan_all_hosts(deploylist)
+    _scan_all_hosts(
+        deploylist,
+        workers,
+        deadline,
+        step_timeout,
+        scan_timeout,
+        force,
+        networks,
+    )
 
 
 docs = Collection("docs")
@@ -541,6 +1045,190 @@ docs.add_task(doc_generate_main_page)
 docs.add_task(doc_generate_hosts_pages)
 docs.add_task(doc_scan_all_hosts)
 
+##############################################################################
+# Bench
+##############################################################################
+
+
+@task(
+    name="startup",
+    help={
+        "runs": "Number of measured tasks.py imports",
+        "max_ms": "Fail if the median import time is above (0: no limit)",
+    },
+)
+def bench_startup(c, runs=10, max_ms=100):
+    """
+    Measure the tasks startup time, fail on regression
+    """
+    _bench_startup(runs, max_ms)
+
+
+@task(
+    name="fleet",
+    help={
+        "sizes": "Comma separated numbers of fake hosts",
+        "output": "Save the measures in this JSON file",
+        "keep": "Keep the fake fleets directories",
+    },
+)
+def bench_fleet(c, sizes="5,50,500", output="", keep=False):
+    """
+    Measure the deploy orchestration time and memory on fake fleets
+    """
+    _bench_fleet([int(size) for size in sizes.split(",")], output, keep)
+
+
+bench = Collection("bench")
+bench.add_task(bench_startup)
+bench.add_task(bench_fleet)
+
+##############################################################################
+# Report
+##############################################################################
+
+
+@task(name="last", help={"run": "Run id, log file or index (-1: last)"})
+def report_last(c, run="-1"):
+    """
+    Show the phases durations of the last deploy run
+    """
+    filename = runlog.find_run(run)
+    result = runlog.load_run(filename)
+
+    info(f"{result['command']} ({filename})")
+    for line in runlog.format_summary(result["hosts"]):
+        print(f"  {line}")
+
+
+@task(
+    name="compare",
+    help={
+        "before": "Run id, log file or index (-2: the run before the last)",
+        "after": "Run id, log file or index (-1: last)",
+    },
+)
+def report_compare(c, before="-2", after="-1"):
+    """
+    Compare the phases durations of two deploy runs
+    """
+    runs = [runlog.find_run(before), runlog.find_run(after)]
+    results = [runlog.load_run(filename) for filename in runs]
+
+    info(f"{results[0]['command']} ({runs[0]})")
+    info(f"{results[1]['command']} ({runs[1]})")
+    for line in runlog.compare(results[0]["hosts"], results[1]["hosts"]):
+        print(f"  {line}")
+
+
+report = Collection("report")
+report.add_task(report_last)
+report.add_task(report_compare)
+
+##############################################################################
+# Eval
+##############################################################################
+
+
+@task(
+    name="eval",
+    help={
+        "hostnames": "NixOS configurations (all if hostnames and homes unset)",
+        "homes": "Home configurations (<username>@<hostname>)",
+        "workers": "Number of nix evaluations at the same time",
+        "max_memory": "Max resident memory (MiB) of each evaluation, in a "
+        "systemd user scope (0: unlimited)",
+        "fail_fast": "Cancel the evaluations not started at the first error",
+        "output": "Save the results in this JSON file, instead of stdout",
+        "evalcache": "Reuse the results of the same flake source and lock",
+    },
+)
+def flake_eval(
+    c,
+    hostnames="",
+    homes="",
+    workers=4,
+    max_memory=0,
+    fail_fast=False,
+    output="",
+    evalcache=True,
+):
+    """
+    Evaluate the configurations in parallel, show their drvPath and outPath
+    """
+    _flake_eval(
+        _flake_attributes(hostnames, homes),
+        workers,
+        max_memory,
+        fail_fast,
+        output,
+        evalcache,
+    )
+
+
+##############################################################################
+# Cache
+##############################################################################
+
+
+@task(
+    name="push",
+    help={
+        "hostnames": "NixOS configurations (all if hostnames and homes unset)",
+        "homes": "Home configurations (<username>@<hostname>)",
+        "cachehost": "nix-serve host (default: host with the nix-serve role)",
+        "workers": "Number of closures copied at the same time",
+        "cache": "Use binary cache from flake extra-substituers section",
+        "keeperror": "Continue, if error",
+        "showtrace": "Show trace on error",
+    },
+)
+def cache_push(
+    c,
+    hostnames="",
+    homes="",
+    cachehost="",
+    workers=4,
+    cache=True,
+    keeperror=True,
+    showtrace=False,
+):
+    """
+    Build the configurations and push their closures to the nix-serve host
+    """
+    _cache_push(
+        _cache_installables(hostnames, homes),
+        cachehost,
+        workers,
+        _nix_options(cache, keeperror, showtrace),
+    )
+
+
+@task(
+    name="status",
+    help={
+        "hostnames": "NixOS configurations (all if hostnames and homes unset)",
+        "homes": "Home configurations (<username>@<hostname>)",
+        "cachehost": "nix-serve host (default: host with the nix-serve role)",
+        "cacheurl": "Cache URL (default: http://<cachehost>:5000)",
+        "workers": "Number of cache requests at the same time",
+    },
+)
+def cache_status(
+    c, hostnames="", homes="", cachehost="", cacheurl="", workers=16
+):
+    """
+    Show the cache hit ratio of each configuration closure
+    """
+    _cache_status(
+        _cache_installables(hostnames, homes), cachehost, cacheurl, workers
+    )
+
+
+cache = Collection("cache")
+cache.add_task(cache_push)
+cache.add_task(cache_status)
+
 
 ##############################################################################
 # Functions
@@ -765,6 +1453,48 @@ def _wireguard_keys(hostname: str) -> None:
     info(f"wireguard-priv-key: {private}")
 
 
+def _affected_hostnames(ref: str, hostnames: str) -> str:
+    """
+    Return the homelab hosts whose nixos configuration is affected by the
+    changes since <ref>, restricted to <hostnames> if set
+    """
+    inv = inventory.load()
+
+    affected = []
+    for hn in depindex.affected_configurations(ref)["nixos"]:
+        if hostnames and hn not in hostnames.split(","):
+            continue
+
+        if hn not in inv.hosts:
+            warn(f"{hn} is affected but not defined in homelab.json")
+            continue
+
+        affected.append(hn)
+
+    return ",".join(affected)
+
+
+def _affected_usershosts(
+    ref: str, username: str, hostnames: str
+) -> Dict[str, List[str]]:
+    """
+    Return the hosts by user whose home configuration is affected by the
+    changes since <ref>, restricted to <username> and <hostnames> if set
+    """
+    usershosts = {}
+    for conf in depindex.affected_configurations(ref)["home"]:
+        user, hn = conf.split("@")
+        if username and user != username:
+            continue
+
+        if hostnames and hn not in hostnames.split(","):
+            continue
+
+        usershosts.setdefault(user, []).append(hn)
+
+    return usershosts
+
+
 def _execute_nixos_rebuild(
     action: str,
     hostnames: str,
@@ -772,16 +1502,50 @@ def _execute_nixos_rebuild(
     cache: bool,
     keeperror: bool,
     showtrace: bool,
+    buildhost: str = "",
+    skipunchanged: bool = True,
+    affected_since: str = "",
+    max_parallel: int = 0,
+    canary: int = 0,
+    waves: bool = False,
+    plan: bool = False,
+    prefetch: bool = False,
+    fanout: bool = False,
+    peers: bool = False,
+    reuse: bool = False,
 ):
+    if affected_since:
+        hostnames = _affected_hostnames(affected_since, hostnames)
+        if hostnames == "":
+            info(f"No host affected since {affected_since}")
+            return
+
     if hostnames != "":
         # Remote deploy
         deploylist = get_deploylist_from_homelab("root", hostnames)
         _nixos_rebuild(
-            deploylist, action, discovery, cache, keeperror, showtrace
+            deploylist,
+            action,
+            discovery,
+            cache,
+            keeperror,
+            showtrace,
+            buildhost=buildhost,
+            skipunchanged=skipunchanged,
+            max_parallel=max_parallel,
+            canary=canary,
+            waves=waves,
+            plan=plan,
+            prefetch=prefetch,
+            fanout=fanout,
+            peers=peers,
+            reuse=reuse,
         )
     else:
         # Local deploy
-        _nix_local_deploy(action, discovery, cache, keeperror, showtrace)
+        _nix_local_deploy(
+            action, discovery, cache, keeperror, showtrace, skipunchanged
+        )
 
 
 def _execute_home_remote_deploy(
@@ -791,13 +1555,47 @@ def _execute_home_remote_deploy(
     cache: bool,
     keeperror: bool,
     showtrace: bool,
+    affected_since: str = "",
+    max_parallel: int = 0,
+    canary: int = 0,
+    waves: bool = False,
 ):
+    if affected_since:
+        usershosts = _affected_usershosts(affected_since, username, hostnames)
+        if not usershosts:
+            info(f"No home configuration affected since {affected_since}")
+
+        for user in usershosts:
+            deploylist = get_deploylist_from_homelab(
+                user, ",".join(usershosts[user])
+            )
+            _home_remote_deploy(
+                user,
+                deploylist,
+                action,
+                cache,
+                keeperror,
+                showtrace,
+                max_parallel=max_parallel,
+                canary=canary,
+                waves=waves,
+            )
+        return
+
     if hostnames != "":
         # Remote deploy
         deploylist = get_deploylist_from_homelab(username, hostnames)
 
         _home_remote_deploy(
-            username, deploylist, action, cache, keeperror, showtrace
+            username,
+            deploylist,
+            action,
+            cache,
+            keeperror,
+            showtrace,
+            max_parallel=max_parallel,
+            canary=canary,
+            waves=waves,
         )
     else:
         # Local deploy
@@ -823,206 +1621,1329 @@ def _nixos_generate_config(host: DeployHost, hostname: str) -> None:
         )
 
 
-# Remove .git (for ignoring dirty message), no git add needed :)
-def _sync_homelab(host: DeployHost) -> None:
-    run(
-        f"rsync --delete {' --exclude '.join([''] + RSYNC_EXCLUDES)} -ar . root@{host.host}:/mnt/nix-homelab/"  # noqa: E501
-    )
+def _sync_homelab(host: DeployHost) -> str:
+    """
+    Copy the flake source to the installer store and to the future nixos
+    /nix-homelab, return the source store path
+    """
+    src = _ship_source(host)
+    host.run(_homelab_copy(src, f"/mnt{HOMELAB_DIR}"))
 
+    return src
 
-def _host_hardware_discovery(h: DeployHost) -> None:
-    with open("homelab.json", "r") as fr:
-        jinfo = json.load(fr)
-        hosts = jinfo["hosts"]
 
-        # Create
-        hn = h.meta.get("hostname")
-        run(f"mkdir -p docs/hosts/{hn}")
+def _homelab_copy(src: str, path: str) -> str:
+    """
+    Return the command replacing the <path> content with the <src> flake
+    source. <path> is a mountpoint, the source is copied in a new directory
+    of it, the old content is only replaced when the copy is complete (a
+    failed copy is removed by the next one)
+    """
+    return (
+        f'new=$(mktemp -d {path}/.homelab.XXXXXX) && cp -r {src}/. "$new"'
+        ' && chmod -R u+w "$new"'
+        f' && find {path} -mindepth 1 -maxdepth 1 ! -path "$new"'
+        " -exec rm -rf {} +"
+        f' && find "$new" -mindepth 1 -maxdepth 1 -exec mv -t {path} {{}} +'
+        ' && rmdir "$new"'
+    )
 
-        if not os.system(f"ping -c 1 -w 1 {h.host}"):
-            if hn and h.meta.get("os") in ["NixOS", "Nix"]:
-                h.run(
-                    """
-                rm -rf /tmp/hw
-                mkdir -p /tmp/hw
-                """,
-                    check=False,
-                )
 
-            for dn in OSSCAN[hosts[hn]["os"]]:
-                # For non NixOS installation
-                # TODO: find beautifull solution (.bash_profile & co)
-                PREFIX_COMMAND = "source /etc/bashrc ; LC_ALL=C"
-                SSH_OPTS = '-o "UserKnownHostsFile=/dev/null" -o "StrictHostKeyChecking=no"'  # noqa: E501
-                match dn:
-                    case "Nix" | "NixOS":
-                        h.run(
-                            f"{PREFIX_COMMAND} nix-shell -p nix-info --run 'nix-info -m' > /tmp/hw/{dn}.txt"  # noqa: E501
-                        )
-                        run(
-                            f"scp {SSH_OPTS} root@{h.host}:/tmp/hw/{dn}.txt docs/hosts/{hn}/{dn.lower()}.txt"  # noqa: E501
-                        )
-                    case "Hardwares":
-                        h.run(
-                            f"{PREFIX_COMMAND} nix-shell -p 'inxi.override {{ withRecommends = true; }}' --run 'sudo inxi -F -a -i --slots -xxx -c0 -i -m --filter' > /tmp/hw/{dn}.txt"  # noqa: E501
-                        )
-                        run(
-                            f"scp {SSH_OPTS} root@{h.host}:/tmp/hw/{dn}.txt docs/hosts/{hn}/{dn.lower()}.txt"  # noqa: E501
-                        )
-                    case "CPU":
-                        h.run(f"{PREFIX_COMMAND} lscpu > /tmp/hw/{dn}.txt")
-                        run(
-                            f"scp {SSH_OPTS} root@{h.host}:/tmp/hw/{dn}.txt docs/hosts/{hn}/{dn.lower()}.txt"  # noqa: E501
-                        )
-                    case "Topologie":
-                        res = h.run(
-                            f"{PREFIX_COMMAND} nix-shell -p hwloc --run 'sudo lstopo -f /tmp/hw/{hn}.lstopo.svg'"  # noqa: E501
-                        )
-                        run(
-                            f"scp {SSH_OPTS} root@{hosts[hn]['ipv4']}:/tmp/hw/{hn}.lstopo.svg docs/hosts/{hn}/{dn.lower()}.svg"  # noqa: E501
-                        )
-                    case "Scan":
-                        res = run(
-                            f"{PREFIX_COMMAND} nix-shell -p nmap --run 'sudo nmap --version-intensity 0 -sV {hosts[hn]['ipv4']} -oX -'"  # noqa: E501
-                        )
+def _nmap_clean_ports(ports: Any) -> List[Dict[str, Any]]:
+    """
+    Remove sensible or unimportant values from the nmap host ports
+    """
+    if isinstance(ports, dict):
+        ports = [ports]
 
-                        # dom = parseString(res.stdout)
-                        xpars = xmltodict.parse(res.stdout)
-                        try:
-                            ports = xpars["nmaprun"]["host"]["ports"]["port"]
-
-                            if isinstance(ports, dict):
-                                ports = [ports]
-
-                            # Remove sensible or unimportant values
-                            for idx in range(len(ports)):
-                                # State
-                                if "state" in ports[idx]:
-                                    del ports[idx]["state"]
-
-                                # service elements
-                                if "service" in ports[idx]:
-                                    for value in [
-                                        "@version",
-                                        "@servicefp",
-                                        "@method",
-                                        "@conf",
-                                        "cpe",
-                                    ]:
-                                        if value in ports[idx]["service"]:
-                                            del ports[idx]["service"][value]
-
-                            jcontent = json.dumps(ports, indent=4)
-
-                            with open(
-                                f"docs/hosts/{hn}/{dn.lower()}.json", "w"
-                            ) as fw:
-                                fw.write(jcontent)
-                        except KeyError:
-                            pass
+    for port in ports:
+        port.pop("state", None)
+        if isinstance(port.get("service"), dict):
+            for value in ["@version", "@servicefp", "@method", "@conf", "cpe"]:
+                port["service"].pop(value, None)
 
+    return ports
 
-def _nixos_rebuild(
-    hosts: List[DeployHost],
-    action: str,
-    discovery: bool,
-    cache: bool,
-    keeperror: bool,
-    showtrace: bool,
-) -> None:
+
+def _nmap_scan(
+    targets: List[str],
+    hostnames: List[str],
+    timeout: float = math.inf,
+    host_timeout: float = 0,
+) -> List[str]:
     """
-    Deploy to all hosts in parallel
+    Scan the <targets> (IPs or CIDRs) with one nmap run, the XML report is
+    parsed while nmap stream it and the ports of each <hostnames> found are
+    saved in its scan.json, return the saved hostnames
     """
-    g = DeployGroup(hosts)
+    inv = inventory.load()
+    saved = []
+
+    def save_host(path: List[Any], item: Any) -> bool:
+        if path[-1][0] != "host" or not isinstance(item, dict):
+            return True
+
+        addresses = item.get("address", [])
+        if isinstance(addresses, dict):
+            addresses = [addresses]
+        hosts = [inv.host_by_ip(a.get("@addr", "")) for a in addresses]
+        hosts = [host for host in hosts if host and host.name in hostnames]
+        if not hosts or not isinstance(item.get("ports"), dict):
+            return True
+
+        ports = item["ports"].get("port")
+        if ports:
+            hn = hosts[0].name
+            os.makedirs(f"docs/hosts/{hn}", exist_ok=True)
+            with open(f"docs/hosts/{hn}/scan.json", "w") as fw:
+                fw.write(json.dumps(_nmap_clean_ports(ports), indent=4))
+            saved.append(hn)
 
-    def deploy(h: DeployHost) -> None:
-        with open("homelab.json", "r") as f:
-            jinfo = json.load(f)
-            hosts = jinfo["hosts"]
+        return True
 
-            # Search host by ip
-            hostname = None
-            for hn in hosts:
-                if "ipv4" in hosts[hn] and hosts[hn]["ipv4"] == h.host:
-                    hostname = hn
-                    break
+    options = "--version-intensity 0 -sV"
+    if host_timeout > 0:
+        options += f" --host-timeout {math.ceil(host_timeout)}s"
 
-        h.run_local(
-            f"rsync --delete {' --exclude '.join([''] + RSYNC_EXCLUDES)} -ar . {h.user}@{h.host}:/nix-homelab/"  # noqa: E501
-        )
+    command = f"sudo nmap {options} {' '.join(targets)} -oX -"
+    tools = _discovery_toolbox().get(platform.machine(), "")
+    if os.path.exists(f"{tools}/bin/nmap"):
+        command = command.replace("nmap", f"{tools}/bin/nmap", 1)
+    else:
+        command = f"nix-shell -p nmap --run '{command}'"
 
-        if hostname:
-            cache_opts = ""
-            if not cache:
-                cache_opts = "--fallback --option binary-caches https://cache.nixos.org/"  # noqa: E501
+    proc = subprocess.Popen(
+        ["bash", "-c", f"{LOCAL_PREFIX} {command}"],
+        stdout=subprocess.PIPE,
+        start_new_session=True,
+    )
 
-            keeperror_opts = ""
-            if keeperror:
-                keeperror_opts = "--option keep-going true"
+    expired = threading.Event()
 
-            showtrace_opts = ""
-            if showtrace:
-                showtrace_opts = "--show-trace"
+    def kill() -> None:
+        expired.set()
+        os.killpg(proc.pid, signal.SIGKILL)
 
-            cmd = f"cd /nix-homelab && nixos-rebuild -v {action} {showtrace_opts} {cache_opts} {keeperror_opts} --fast --option accept-flake-config true --flake .#{hostname}"  # noqa: E501
-            h.run(cmd)
+    timer = threading.Timer(timeout, kill) if timeout != math.inf else None
+    if timer:
+        timer.start()
+    try:
+        xmltodict.parse(proc.stdout, item_depth=2, item_callback=save_host)
+    except ExpatError:
+        if not expired.is_set():
+            raise
+    finally:
+        if timer:
+            timer.cancel()
+        proc.wait()
 
-            if action == "build":
-                print("#####################################################")
-                print(
-                    "# You can see the build result at"
-                    f"{h.user}@{h.host}:/nix-homelab/result"
+    if expired.is_set():
+        raise subprocess.TimeoutExpired("nmap", timeout)
+    if proc.returncode != 0:
+        raise Exception(f"nmap exit {proc.returncode}")
+
+    return saved
+
+
+def _discovery_toolbox() -> Dict[str, str]:
+    """
+    Return the homelab-discovery package store path for each machine
+    (uname -m), the package of the local machine is built
+    """
+    global _toolbox
+
+    with _toolbox_lock:
+        if _toolbox is None:
+            _toolbox = {}
+            res = run(
+                "nix eval --json .#packages --apply 'builtins.mapAttrs (system: pkgs: pkgs.homelab-discovery.outPath)'",  # noqa: E501
+                warn=True,
+                hide=True,
+            )
+            if res.ok:
+                for system, path in json.loads(res.stdout).items():
+                    _toolbox[system.split("-")[0]] = path
+
+            if platform.machine() in _toolbox:
+                run(
+                    "nix build --no-link .#homelab-discovery",
+                    warn=True,
+                    hide=True,
                 )
-                print("#####################################################")
 
-            if discovery:
-                h.meta["hostname"] = hostname
-                _host_hardware_discovery(h)
+        return _toolbox
 
-    g.run_function(deploy)
 
+def _discovery_script(
+    steps: List[str],
+    step_timeout: float = 0,
+    fingerprint: str = "",
+    toolbox: Optional[Dict[str, str]] = None,
+) -> str:
+    """
+    Return the remote shell script running the discovery <steps>, the
+    results are written to stdout as a compressed tar archive
 
-def _home_remote_deploy(
-    username: str,
+    The steps are skipped when the host fingerprint is <fingerprint>. The
+    tools are run from the <toolbox> package of the host machine when it
+    is in the host store (or can be substituted), else from a nix-shell
+    """
+    limit = f"timeout {math.ceil(step_timeout)} " if step_timeout > 0 else ""
+    lines = [
+        # nix environment of the non NixOS installations, without relying
+        # on the shell startup files
+        f"for f in {' '.join(NIX_PROFILES)}; do",
+        '    [ -e "$f" ] && source "$f" >/dev/null 2>&1 && break',
+        "done",
+        "export LC_ALL=C",
+        'export hw="$(mktemp -d)"',
+        "trap 'rm -rf \"$hw\"' EXIT",
+        'case "$(uname -m)" in',
+    ]
+    for machine, path in (toolbox or {}).items():
+        lines.append(f"    {machine}) tools={path} ;;")
+    lines += [
+        "    *) tools= ;;",
+        "esac",
+        'if [ -n "$tools" ] && { [ -e "$tools" ] || nix-store -r "$tools"; } >/dev/null 2>&1; then',  # noqa: E501
+        '    export PATH="$tools/bin:$PATH"',
+        "else",
+        # Ask for a toolbox copy, used by the next discoveries
+        '    uname -m > "$hw/.toolbox"',
+        "    tools=",
+        "fi",
+        "step() {",
+        '    if [ -n "$tools" ] || [ -z "$1" ]; then',
+        f'        {limit}bash -c "$2"',
+        "    else",
+        f'        {limit}nix-shell -p "$1" --run "$2"',
+        "    fi",
+        "}",
+        f'{FINGERPRINT_COMMAND} > "$hw/{FINGERPRINT_FILE}"',
+        f'if [ "$(cat "$hw/{FINGERPRINT_FILE}")" != "{fingerprint}" ]; then',
+    ]
+    for dn in steps:
+        filename, command, packages = DISCOVERY_COMMANDS[dn]
+        command = command.format(out=f'"$hw/{filename}"')
+        lines.append(
+            f'    step {shlex.quote(packages)} {shlex.quote(command)} </dev/null >&2 || echo {dn} >> "$hw/.failed"'  # noqa: E501
+        )
+    lines.append("fi")
+    lines.append('tar -C "$hw" -czf - .')
+
+    return "\n".join(lines) + "\n"
+
+
+def _host_remote_discovery(
+    h: DeployHost,
+    steps: List[str],
+    step_timeout: float,
+    timeout: float,
+    fingerprint: str = "",
+) -> Tuple[str, List[str]]:
+    """
+    Run the discovery <steps> in one SSH session and unpack the returned
+    archive into the host documentation directory, return the host
+    fingerprint and the failed steps
+
+    The steps are skipped when the host fingerprint is <fingerprint>
+    """
+    hn = h.meta["hostname"]
+    cmd = [
+        "ssh",
+        "-o",
+        "UserKnownHostsFile=/dev/null",
+        "-o",
+        "StrictHostKeyChecking=no",
+        "-o",
+        "BatchMode=yes",
+    ]
+    if h.port:
+        cmd += ["-p", str(h.port)]
+    if h.key:
+        cmd += ["-i", h.key]
+    cmd += [f"{h.user or 'root'}@{h.host}", "bash -s"]
+
+    toolbox = _discovery_toolbox()
+    script = _discovery_script(steps, step_timeout, fingerprint, toolbox)
+    start = time.monotonic()
+    res = subprocess.run(
+        cmd,
+        input=script.encode(),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        timeout=None if timeout == math.inf else timeout,
+    )
+    if res.returncode != 0:
+        error = res.stderr.decode(errors="replace").strip().splitlines()
+        raise Exception(error[-1] if error else f"ssh exit {res.returncode}")
+
+    failed = []
+    current = ""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with tarfile.open(fileobj=io.BytesIO(res.stdout), mode="r:gz") as tar:
+            members = [
+                m
+                for m in tar.getmembers()
+                if m.isfile() and os.path.dirname(m.name) in ["", "."]
+            ]
+            tar.extractall(tmpdir, members=members)
+
+        if os.path.exists(os.path.join(tmpdir, FINGERPRINT_FILE)):
+            with open(os.path.join(tmpdir, FINGERPRINT_FILE), "r") as fr:
+                current = fr.read().strip()
+
+        if os.path.exists(os.path.join(tmpdir, ".failed")):
+            with open(os.path.join(tmpdir, ".failed"), "r") as fr:
+                failed = fr.read().split()
+
+        if os.path.exists(os.path.join(tmpdir, ".toolbox")):
+            with open(os.path.join(tmpdir, ".toolbox"), "r") as fr:
+                machine = fr.read().strip()
+
+            # Copy the locally built toolbox, for the next discoveries
+            path = toolbox.get(machine, "")
+            if machine == platform.machine() and os.path.exists(path):
+                left = timeout - (time.monotonic() - start)
+                run(
+                    f"{NIX_SSHOPTS} nix copy -s --to ssh://{h.user or 'root'}@{h.host} {path}",  # noqa: E501
+                    warn=True,
+                    hide=True,
+                    timeout=None if left == math.inf else max(left, 1),
+                )
+
+        # Keep the previous results of the failed steps
+        for dn in steps:
+            filename = DISCOVERY_COMMANDS[dn][0]
+            src = os.path.join(tmpdir, filename)
+            if dn not in failed and os.path.exists(src):
+                shutil.move(src, f"docs/hosts/{hn}/{filename}")
+
+    # Rescan on the next discovery when a step failed
+    if current and current != fingerprint and not failed:
+        with open(f"docs/hosts/{hn}/{FINGERPRINT_FILE}", "w") as fw:
+            fw.write(f"{current}\n")
+
+    return current, failed
+
+
+def _host_hardware_discovery(
+    h: DeployHost,
+    step_timeout: float = 0,
+    deadline: float = 0,
+    force: bool = False,
+    scan: bool = True,
+) -> str:
+    """
+    Retrieve the host system informations, return the discovery status
+
+    <step_timeout> (seconds) bound each discovery step, <deadline> (a
+    time.monotonic() value) bound the whole host discovery. The host
+    hardware steps are not run again while its fingerprint is unchanged,
+    unless <force>. The nmap ports scan is always run (the ports can change
+    with the same hardware), it is skipped if not <scan>
+    """
+    # Create
+    hn = h.meta.get("hostname")
+    host = inventory.load().host(hn)
+    os.makedirs(f"docs/hosts/{hn}", exist_ok=True)
+
+    def timeout(steps: int = 1) -> float:
+        """
+        Return the time allowed for the next <steps>
+        """
+        limits = [math.inf]
+        if step_timeout > 0:
+            limits.append(step_timeout * steps)
+        if deadline > 0:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise subprocess.TimeoutExpired(f"{hn} discovery", 0)
+            limits.append(left)
+
+        return min(limits)
+
+    def local_timeout() -> Optional[float]:
+        t = timeout()
+        return None if t == math.inf else t
+
+    try:
+        res = run(
+            f"ping -c 1 -w 1 {h.host}",
+            warn=True,
+            hide=True,
+            timeout=local_timeout(),
+        )
+        if not res.ok:
+            return "unreachable"
+
+        failed = []
+        unchanged = False
+        steps = [dn for dn in OSSCAN[host.os] if dn in DISCOVERY_COMMANDS]
+        if steps:
+            known = ""
+            filename = f"docs/hosts/{hn}/{FINGERPRINT_FILE}"
+            if not force and os.path.exists(filename):
+                with open(filename, "r") as fr:
+                    known = fr.read().strip()
+
+            current, failed = _host_remote_discovery(
+                h, steps, step_timeout, timeout(len(steps)), known
+            )
+            unchanged = bool(known) and current == known
+
+        if scan and "Scan" in OSSCAN[host.os]:
+            _nmap_scan([host.ipv4], [hn], timeout(), step_timeout)
+
+        if failed:
+            return f"failed: {', '.join(failed)}"
+    except (subprocess.TimeoutExpired, CommandTimedOut):
+        return "timeout"
+    except Exception as e:
+        return f"failed: {e}"
+
+    return "unchanged" if unchanged else "ok"
+
+
+def _nix_options(cache: bool, keeperror: bool, showtrace: bool) -> str:
+    """
+    Return the nix options shared by all build commands
+    """
+    cache_opts = ""
+    if not cache:
+        cache_opts = (
+            "--fallback --option binary-caches https://cache.nixos.org/"
+        )
+
+    keeperror_opts = ""
+    if keeperror:
+        keeperror_opts = "--option keep-going true"
+
+    showtrace_opts = ""
+    if showtrace:
+        showtrace_opts = "--show-trace"
+
+    return f"{showtrace_opts} {cache_opts} {keeperror_opts}"
+
+
+def _get_buildhost(buildhost: str) -> Optional[DeployHost]:
+    """
+    Return the builder host, None if the build is done on the local computer
+    """
+    if buildhost in ["local", "localhost"]:
+        return None
+
+    builder = get_deploylist_from_homelab("root", buildhost)[0]
+    # Forward the agent, the builder copy the closures to the hosts
+    builder.forward_agent = True
+
+    return builder
+
+
+def _nix_build(
+    builder: Optional[DeployHost],
+    installables: Dict[str, str],
+    nixopts: str,
+    log: runlog.RunLog,
+) -> Dict[str, str]:
+    """
+    Build the <installables> (name: installable) in one nix command, return
+    the out path of each name
+
+    On the local computer, the flake attributes found in the evaluation
+    cache are built from their derivation, without evaluation
+    """
+    names = list(installables)
+    cache = evalcache.load()
+
+    # The builder evaluates the flake source copied in its store
+    prefix = f"path:{_ship_source(builder)}#" if builder else ".#"
+
+    targets = []
+    for installable in installables.values():
+        entry = cache.get(installable.removeprefix(".#"))
+        if builder is None and entry and os.path.exists(entry["drvPath"]):
+            targets.append(f"{entry['drvPath']}^out")
+        else:
+            targets.append(prefix + installable.removeprefix(".#"))
+
+    cmd = f"nix build --no-link --json {NIX_LOG_FORMAT} {nixopts} --option accept-flake-config true {' '.join(targets)}"  # noqa: E501
+
+    if builder is None:
+        info(f"Build {', '.join(names)} on local computer")
+        with _nix_progress("build", log) as output:
+            res = run(cmd, hide="stdout", err_stream=output)
+    else:
+        info(f"Build {', '.join(names)} on {builder.meta['hostname']}")
+        with _nix_progress("build", log) as output:
+            res = builder.run(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=output,
+            )
+
+    # nix build --json keep the installables order
+    builds = json.loads(res.stdout)
+    for idx, installable in enumerate(installables.values()):
+        if installable.startswith(".#"):
+            cache.put(
+                installable.removeprefix(".#"),
+                builds[idx]["drvPath"],
+                builds[idx]["outputs"]["out"],
+            )
+    cache.save()
+
+    return {
+        name: builds[idx]["outputs"]["out"] for idx, name in enumerate(names)
+    }
+
+
+def _nixos_build_toplevels(
+    builder: Optional[DeployHost],
+    hostnames: List[str],
+    nixopts: str,
+    log: runlog.RunLog,
+) -> Dict[str, str]:
+    """
+    Build all hosts system in one nix command, return the toplevel paths
+    """
+    return _nix_build(
+        builder,
+        {
+            hn: f".#nixosConfigurations.{hn}.config.system.build.toplevel"
+            for hn in hostnames
+        },
+        nixopts,
+        log,
+    )
+
+
+def _nixos_copy_closure(
+    builder: Optional[DeployHost],
+    h: DeployHost,
+    toplevel: str,
+    log: Optional[runlog.RunLog] = None,
+) -> None:
+    """
+    Copy the system closure from the builder to the host, the sent paths
+    size is recorded in the run <log>
+    """
+    cmd = f"{NIX_SSHOPTS} nix copy --log-format raw --to ssh://{h.user}@{h.host} {toplevel}"  # noqa: E501
+
+    if builder is None:
+        res = h.run_local(cmd, stderr=subprocess.PIPE)
+    else:
+        res = builder.run(cmd, stderr=subprocess.PIPE)
+    _log_copied_paths(log, h.meta["hostname"], builder, res.stderr)
+
+
+def _nixos_eval_toplevels(hostnames: List[str]) -> Dict[str, str]:
+    """
+    Evaluate the toplevel out paths of the hosts in one nix evaluation,
+    hosts without nixosConfigurations are ignored. The hosts found in the
+    evaluation cache are not evaluated (see evalcache)
+    """
+    cache = evalcache.load()
+
+    toplevels = {}
+    for hn in hostnames:
+        entry = cache.get(flakeeval.attribute("nixos", hn))
+        if entry:
+            toplevels[hn] = entry["outPath"]
+
+    todo = [hn for hn in hostnames if hn not in toplevels]
+    if not todo:
+        info(f"Evaluation of {', '.join(hostnames)} systems cached")
+        return toplevels
+
+    names = " ".join([f'"{hn}"' for hn in todo])
+    apply = f"cs: builtins.mapAttrs (n: c: {{ inherit (c.config.system.build.toplevel) drvPath outPath; }}) (builtins.intersectAttrs (builtins.listToAttrs (map (n: {{ name = n; value = null; }}) [ {names} ])) cs)"  # noqa: E501
+
+    info(f"Evaluate {', '.join(todo)} systems")
+    res = run(
+        f"nix eval --json --option accept-flake-config true .#nixosConfigurations --apply '{apply}'",  # noqa: E501
+        hide="stdout",
+    )
+
+    for hn, paths in json.loads(res.stdout).items():
+        cache.put(
+            flakeeval.attribute("nixos", hn),
+            paths["drvPath"],
+            paths["outPath"],
+        )
+        toplevels[hn] = paths["outPath"]
+    cache.save()
+
+    return toplevels
+
+
+def _nixos_is_uptodate(h: DeployHost, toplevel: str, action: str) -> bool:
+    """
+    Check if the system links updated by <action> already point to <toplevel>
+    """
+    if action not in SYSTEM_LINKS:
+        return False
+
+    res = h.run(
+        f"readlink -f {' '.join(SYSTEM_LINKS[action])}",
+        stdout=subprocess.PIPE,
+        check=False,
+    )
+    if res.returncode != 0:
+        return False
+
+    return all([path == toplevel for path in res.stdout.split()])
+
+
+def _substituters() -> List[str]:
+    """
+    Return the binary caches URLs, in the nix query order: the nix-serve
+    hosts caches, then the nixos cache
+    """
+    return [
+        f"http://{host.ipv4}:{NIX_SERVE_PORT}"
+        for host in inventory.load().hosts_with_role("nix-serve")
+    ] + [NIXOS_CACHE]
+
+
+def _nixos_plan(
+    hosts: List[DeployHost],
+    buildhost: str,
+    nixopts: str,
+    prefetch: bool,
+    log: runlog.RunLog,
+) -> None:
+    """
+    Show, for each host, the derivations to build and the paths to fetch
+    (by binary cache) where its system is built: on the host, or on the
+    <buildhost>. The hosts are planned in parallel with nix build --dry-run
+
+    if <prefetch> is set, the paths are fetched at the same time on all the
+    hosts (or on the builder)
+    """
+    builder = _get_buildhost(buildhost) if buildhost else None
+    builder_src = _ship_source(builder) if builder else ""
+
+    def dry_run(h: DeployHost) -> nixlog.DryRun:
+        hn = h.meta["hostname"]
+        attr = f"nixosConfigurations.{hn}.config.system.build.toplevel"
+        cmd = f"nix build --dry-run {nixopts} --option accept-flake-config true"  # noqa: E501
+
+        with log.phase(hn, "plan"):
+            if buildhost and builder is None:
+                res = run(f"{cmd} .#{attr}", hide=True)
+            else:
+                if builder:
+                    target, src = builder, builder_src
+                else:
+                    target, src = h, _ship_source(h, log)
+                res = target.run(
+                    f"{cmd} path:{src}#{attr}",
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                )
+
+        return nixlog.parse_dry_run(res.stderr)
+
+    plans = {}
+    failed = False
+    for r in deploykit.DeployGroup(hosts).run_function(dry_run, check=False):
+        if r.error:
+            warn(f"{r.host.meta['hostname']} plan failed: {r.error}")
+            failed = True
+        else:
+            plans[r.host.meta["hostname"]] = r.result
+
+    if failed:
+        sys.exit(1)
+
+    # The binary cache of each fetched path, the first one having it
+    urls = _substituters()
+    paths = sorted({path for p in plans.values() for path in p.fetched})
+
+    def source(path: str) -> str:
+        for url in urls:
+            if _narinfo_exists(url, path):
+                return url.split("//")[-1]
+
+        return "unknown"
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        sources = dict(zip(paths, executor.map(source, paths)))
+
+    info("Deploy plan")
+    info(f"  {'host':<20}{'build':>7}{'fetch':>7}{'download':>10}  caches")
+    for hn, p in plans.items():
+        counts: Dict[str, int] = {}
+        for path in p.fetched:
+            counts[sources[path]] = counts.get(sources[path], 0) + 1
+        caches = ", ".join([f"{url}: {nb}" for url, nb in counts.items()])
+        info(
+            f"  {hn:<20}{len(p.built):>7}{len(p.fetched):>7}"
+            f"{runlog.format_size(p.download):>10}  {caches}"
+        )
+
+    if not prefetch:
+        return
+
+    if buildhost:
+        info(f"Prefetch {len(paths)} paths on {buildhost}")
+        with log.phase(runlog.RUN_HOST, "prefetch"):
+            cmd = f"nix-store -r {' '.join(paths)}"
+            if paths and builder is None:
+                output = run(cmd, hide=True).stderr
+            elif paths:
+                output = builder.run(
+                    cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+                ).stderr
+            if paths:
+                _log_copied_paths(log, runlog.RUN_HOST, builder, output)
+        return
+
+    def fetch(h: DeployHost) -> None:
+        hn = h.meta["hostname"]
+        if plans[hn].fetched:
+            with log.phase(hn, "prefetch"):
+                res = h.run(
+                    f"nix-store -r {' '.join(plans[hn].fetched)}",
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                )
+                _log_copied_paths(log, hn, h, res.stderr)
+
+    info(f"Prefetch the substitutes on {len(hosts)} hosts")
+    for r in deploykit.DeployGroup(hosts).run_function(fetch, check=False):
+        if r.error:
+            warn(f"{r.host.meta['hostname']} prefetch failed: {r.error}")
+
+
+def _print_deploy_summary(
+    statuses: Dict[str, str],
+    log: Optional[runlog.RunLog] = None,
+    title: str = "Deploy summary",
+) -> None:
+    if log is None:
+        info(title)
+        for hn in statuses:
+            if statuses[hn].startswith("failed"):
+                warn(f"  {hn:<20} {statuses[hn]}")
+            else:
+                info(f"  {hn:<20} {statuses[hn]}")
+        return
+
+    for hn in statuses:
+        log.status(hn, statuses[hn])
+
+    info(f"{title} ({log.filename})")
+    lines = runlog.format_summary(log.hosts)
+    info(f"  {lines[0]}")
+    for hn, line in zip(log.hosts, lines[1:]):
+        if log.hosts[hn]["status"].startswith("failed"):
+            warn(f"  {line}")
+        else:
+            info(f"  {line}")
+
+
+_source: Optional[List[str]] = None
+_source_lock = threading.Lock()
+
+
+def _flake_source_paths() -> List[str]:
+    """
+    Return the store paths of the flake source (only the git tracked files)
+    then of its inputs, added once to the local store
+    """
+    global _source
+
+    def paths(archive: Dict[str, Any]) -> List[str]:
+        result = [archive["path"]]
+        for sub in archive.get("inputs", {}).values():
+            result += paths(sub)
+        return result
+
+    with _source_lock:
+        if _source is None:
+            res = run("nix flake archive --json .", hide=True)
+            _source = paths(json.loads(res.stdout))
+
+    return _source
+
+
+def _flake_source() -> str:
+    """
+    Return the store path of the flake source
+    """
+    return _flake_source_paths()[0]
+
+
+def _ship_source(h: DeployHost, log: Optional[runlog.RunLog] = None) -> str:
+    """
+    Copy the flake source and its inputs to the host store, return the
+    source store path. nix copy only send the paths missing on the host, the
+    sent paths size is recorded in the run <log>
+    """
+    src = _flake_source()
+    res = h.run_local(
+        f"{NIX_SSHOPTS} nix flake archive --log-format raw --to ssh://{h.user}@{h.host} .",  # noqa: E501
+        stderr=subprocess.PIPE,
+    )
+
+    _log_copied_paths(log, h.meta["hostname"], None, res.stderr)
+
+    return src
+
+
+def _log_copied_paths(
+    log: Optional[runlog.RunLog],
+    hostname: str,
+    store: Optional[DeployHost],
+    output: Optional[str],
+) -> None:
+    """
+    Record in the run <log> the size of the paths copied to the host, found
+    in the <output> of a nix copy (or nix-store -r). The sizes are queried
+    from the <store> having the paths (None: local store)
+    """
+    copied = sorted(set(RE_COPIED_PATH.findall(output or "")))
+    if log is None or not copied:
+        return
+
+    cmd = f"nix path-info --json {' '.join(copied)}"
+    if store is None:
+        stdout = run(cmd, hide=True).stdout
+    else:
+        stdout = store.run(cmd, stdout=subprocess.PIPE).stdout
+    infos = json.loads(stdout)
+    if isinstance(infos, dict):
+        infos = list(infos.values())
+    log.transferred(hostname, sum(i.get("narSize", 0) for i in infos))
+
+
+@contextmanager
+def _nix_progress(name: str, log: runlog.RunLog) -> Iterator[IO[Any]]:
+    """
+    Yield the output file of a nix command run with NIX_LOG_FORMAT, show a
+    live status line of <name> (a host) and keep the full output in the run
+    log directory. The nix errors are shown if the command fails
+    """
+    filename = log.logfile(name)
+    progress = nixlog.BuildProgress()
+
+    def display(progress: nixlog.BuildProgress) -> None:
+        info(f"{name:<20} {progress.status_line()}")
+
+    try:
+        with nixlog.follow(filename, progress, display) as output:
+            yield output
+    except Exception:
+        for msg in progress.errors:
+            warn(f"{name}: {msg}")
+        warn(f"{name}: full log in {filename}")
+        raise
+
+
+def _rollout_waves(
+    hosts: List[DeployHost], canary: int
+) -> List[List[DeployHost]]:
+    """
+    Split the hosts in deployment waves, in this order:
+    - the infra hosts (parents of other hosts or with an INFRA_ROLES role),
+      one wave by depth in the homelab parent tree
+    - the <canary> first leaf hosts
+    - all the other leaf hosts
+    """
+    inv = inventory.load()
+
+    def is_infra(hn: str) -> bool:
+        roles = inv.host(hn).roles
+        return bool(inv.children(hn)) or bool(set(roles) & set(INFRA_ROLES))
+
+    infras = {}
+    leaves = []
+    for h in hosts:
+        hn = h.meta["hostname"]
+        if is_infra(hn):
+            infras.setdefault(inv.depth(hn), []).append(h)
+        else:
+            leaves.append(h)
+
+    # Keep the hosts of a same zone together
+    leaves.sort(
+        key=lambda h: (inv.host(h.meta["hostname"]).zone, h.meta["hostname"])
+    )
+
+    waves = [infras[level] for level in sorted(infras)]
+    if canary > 0 and len(leaves) > canary:
+        waves.append(leaves[:canary])
+        leaves = leaves[canary:]
+    if leaves:
+        waves.append(leaves)
+
+    return waves
+
+
+def _run_rollout(
+    hosts: List[DeployHost],
+    func: Callable[[DeployHost], str],
+    max_parallel: int,
+    canary: int,
+    waves: bool = False,
+) -> Dict[str, str]:
+    """
+    Run <func> on the hosts wave by wave (see _rollout_waves), with at most
+    <max_parallel> hosts at the same time. The rollout stop at the first
+    failed wave, return the status of each host
+
+    if <waves> is not set (default, builds), all the hosts are run at once
+    and a failed host does not stop the others
+    """
+    semaphore = None
+    if max_parallel > 0:
+        semaphore = threading.BoundedSemaphore(max_parallel)
+
+    def bounded(h: DeployHost) -> str:
+        if semaphore is None:
+            return func(h)
+
+        with semaphore:
+            return func(h)
+
+    statuses = {}
+    groups = _rollout_waves(hosts, canary) if waves else [hosts]
+    for idx, wave in enumerate(groups):
+        hostnames = [h.meta["hostname"] for h in wave]
+        if waves:
+            info(f"Wave {idx + 1}/{len(groups)}: {', '.join(hostnames)}")
+
+        failed = False
+        for r in deploykit.DeployGroup(wave).run_function(
+            bounded, check=False
+        ):
+            if r.error:
+                failed = True
+                statuses[r.host.meta["hostname"]] = f"failed: {r.error}"
+            else:
+                statuses[r.host.meta["hostname"]] = r.result
+
+        if failed and waves:
+            warn(f"Wave {idx + 1} failed, stop the rollout")
+            break
+
+    for h in hosts:
+        if h.meta["hostname"] not in statuses:
+            statuses[h.meta["hostname"]] = "skipped"
+
+    return statuses
+
+
+def _host_has_path(h: DeployHost, path: str) -> bool:
+    """
+    Check if the <path> store path is valid (registered, complete) on the
+    host, a path left by an interrupted build only exists
+    """
+    if not path:
+        return False
+
+    res = h.run(
+        f"nix-store --check-validity {path}",
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=False,
+    )
+    return res.returncode == 0
+
+
+def _peer_latencies(h: DeployHost, ips: List[str]) -> Dict[str, int]:
+    """
+    Return the TCP connect latency (microseconds) from the host to each
+    reachable peer of <ips>, -1 for the peers without root ssh access
+    """
+    try:
+        res = h.run(
+            PEERS_PROBE.format(ips=" ".join(ips), timeout=PEERS_TIMEOUT),
+            stdout=subprocess.PIPE,
+            check=False,
+            timeout=PEERS_TIMEOUT * 2,
+        )
+    except Exception as e:
+        warn(f"{h.host} peers probe failed: {e}")
+        return {}
+
+    latencies = {}
+    for line in (res.stdout or "").splitlines():
+        ip, _, usec = line.partition(" ")
+        if ip in ips:
+            latencies[ip] = int(usec) if usec.isdigit() else -1
+
+    return latencies
+
+
+def _peer_substituters(h: DeployHost, hostname: str) -> str:
+    """
+    Return the nix options adding the same-zone NixOS hosts as substituters
+    of the host, the <PEERS_MAX> nearest ones by TCP connect latency
+    (measured from the host), the nearest first
+
+    The peers are not trusted: only their paths signed by a trusted key
+    (binary caches, nix-serve, peers with a secret-key-files) are used
+    """
+    inv = inventory.load()
+    zone = inv.host(hostname).zone
+    peers = {
+        p.ipv4: p.name
+        for p in inv.hosts_in_zone(zone)
+        if zone and p.name != hostname and p.os == "NixOS"
+    }
+    if not peers:
+        return ""
+
+    latencies = _peer_latencies(h, list(peers))
+    nearest = sorted([(us, ip) for ip, us in latencies.items() if us >= 0])[
+        :PEERS_MAX
+    ]
+    if not nearest:
+        if latencies:
+            warn(
+                f"{hostname} root has no ssh access to its peers "
+                f"({', '.join(peers[ip] for ip in latencies)}), "
+                "built without peers"
+            )
+        return ""
+
+    info(
+        f"{hostname} peers: "
+        + ", ".join(f"{peers[ip]} ({us / 1000:.1f}ms)" for us, ip in nearest)
+    )
+    urls = [
+        f"ssh-ng://root@{ip}?priority={PEERS_PRIORITY + idx}"
+        for idx, (_, ip) in enumerate(nearest)
+    ]
+
+    return f" --option extra-substituters '{' '.join(urls)}'"
+
+
+def _fanout_relays(hosts: List[DeployHost]) -> Dict[str, str]:
+    """
+    Return the relay of each host (hostname: relay hostname, "" for the
+    hosts served directly): its nearest deployed parent, else the first
+    deployed host of its zone (nearest to the root)
+    """
+    inv = inventory.load()
+    hostnames = [h.meta["hostname"] for h in hosts]
+
+    relays = {}
+    zones: Dict[str, List[str]] = {}
+    for hn in hostnames:
+        parents = [p for p in inv.ancestors(hn) if p in hostnames]
+        if parents:
+            relays[hn] = parents[0]
+        else:
+            zones.setdefault(inv.host(hn).zone or hn, []).append(hn)
+
+    for members in zones.values():
+        members.sort(key=lambda hn: (inv.depth(hn), hn))
+        relays[members[0]] = ""
+        for hn in members[1:]:
+            relays[hn] = members[0]
+
+    return relays
+
+
+def _fanout(
+    hosts: List[DeployHost],
+    sender: Optional[DeployHost],
+    paths: Dict[str, List[str]],
+    log: runlog.RunLog,
+) -> List[str]:
+    """
+    Copy the store <paths> of each host (hostname: paths) along the relays
+    tree (see _fanout_relays): from the <sender> (None: local computer) once
+    to each top relay, then each relay forwards to its children in
+    parallel. A relay receives the paths of all its subtree, the paths
+    cross each link once. Return the hostnames having received their paths
+    """
+    byname = {h.meta["hostname"]: h for h in hosts}
+    relays = _fanout_relays(hosts)
+    children: Dict[str, List[DeployHost]] = {}
+    for hn, relay in relays.items():
+        children.setdefault(relay, []).append(byname[hn])
+
+    for relay, targets in children.items():
+        if relay:
+            names = [h.meta["hostname"] for h in targets]
+            info(f"{relay} relays to {', '.join(names)}")
+
+    def subtree(hn: str) -> List[str]:
+        result = list(paths.get(hn, []))
+        for child in children.get(hn, []):
+            result += subtree(child.meta["hostname"])
+        return result
+
+    received = []
+
+    def send(src: Optional[DeployHost], targets: List[DeployHost]) -> None:
+        def receive(h: DeployHost) -> None:
+            hn = h.meta["hostname"]
+            cmd = f"{NIX_SSHOPTS} nix copy --log-format raw --to ssh://{h.user}@{h.host} {' '.join(sorted(set(subtree(hn))))}"  # noqa: E501
+            with log.phase(hn, "fanout"):
+                if src is None:
+                    res = h.run_local(
+                        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+                    )
+                else:
+                    res = src.run(
+                        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+                    )
+                _log_copied_paths(log, hn, src, res.stderr)
+            received.append(hn)
+
+            if children.get(hn):
+                # The relay copy to its children with the forwarded agent,
+                # the host itself is left as is for its activation
+                relay = copy.copy(h)
+                relay.forward_agent = True
+                send(relay, children[hn])
+
+        for r in deploykit.DeployGroup(targets).run_function(
+            receive, check=False
+        ):
+            if r.error:
+                warn(f"{r.host.meta['hostname']} fanout failed: {r.error}")
+
+    send(sender, children.get("", []))
+
+    return received
+
+
+def _nixos_activate(h: DeployHost, toplevel: str, action: str) -> None:
+    """
+    Activate an already copied system closure on the host
+    """
+    if action in ["switch", "boot"]:
+        h.run(f"nix-env -p /nix/var/nix/profiles/system --set {toplevel}")
+
+    h.run(f"{toplevel}/bin/switch-to-configuration {action}")
+
+
+def _nixos_rebuild(
     hosts: List[DeployHost],
     action: str,
+    discovery: bool,
     cache: bool,
     keeperror: bool,
     showtrace: bool,
+    buildhost: str = "",
+    skipunchanged: bool = True,
+    max_parallel: int = 0,
+    canary: int = 0,
+    waves: bool = False,
+    plan: bool = False,
+    prefetch: bool = False,
+    fanout: bool = False,
+    peers: bool = False,
+    reuse: bool = False,
 ) -> None:
     """
-    Deploy to all hosts in parallel
+    Deploy to all hosts in parallel, at most <max_parallel> at the same
+    time. If <waves> is set, the hosts are deployed by waves (see
+    _run_rollout), the builds are always run on all the hosts at once
+
+    if <buildhost> is set, all systems are built once on the builder, then
+    the closures are copied and activated on the hosts
+
+    if <skipunchanged> is set, the hosts already running the new system
+    are skipped
+
+    if <plan> is set, the builds and the substitutes of each host are shown
+    first, <prefetch> also fetch the substitutes (see _nixos_plan)
+
+    if <fanout> is set, the closures (with <buildhost>) or the flake source
+    are copied to all hosts before the waves, once by zone or parent relay
+    (see _fanout)
+
+    if <peers> is set, the hosts building their system also substitute
+    from the nearest hosts of their zone, a host deployed by a previous wave
+    already has the shared paths (see _peer_substituters)
+
+    if <reuse> is set, the system evaluated from the flake source (see
+    _nixos_eval_toplevels) is activated without a rebuild on the hosts where
+    it is already valid (built by a previous nixos.test, ...), like the
+    <buildhost> closures: the nix options are not used, the discovery still
+    runs after the activation. nixos.build only reports it
+
+    each phase duration is recorded in a run log (see runlog)
     """
-    g = DeployGroup(hosts)
+    statuses = {}
+    log = runlog.RunLog(f"nixos.{action}")
+
+    evaluated = {}
+    skipunchanged = skipunchanged and action in SYSTEM_LINKS
+    if skipunchanged or (reuse and not buildhost):
+        with log.phase(runlog.RUN_HOST, "eval"):
+            evaluated = _nixos_eval_toplevels(
+                [h.meta["hostname"] for h in hosts]
+            )
 
-    def deploy(h: DeployHost) -> None:
-        with open("homelab.json", "r") as f:
-            jinfo = json.load(f)
-            hosts = jinfo["hosts"]
+    if skipunchanged:
 
-            # Search host by ip
-            hostname = None
-            for hn in hosts:
-                if "ipv4" in hosts[hn] and hosts[hn]["ipv4"] == h.host:
-                    hostname = hn
-                    break
+        def uptodate(h: DeployHost) -> bool:
+            hn = h.meta["hostname"]
+            return hn in evaluated and _nixos_is_uptodate(
+                h, evaluated[hn], action
+            )
 
-        h.run_local(
-            f"rsync --delete {' --exclude '.join([''] + RSYNC_EXCLUDES)} -ar . {h.user}@{h.host}:~/nix-homelab/"  # noqa: E501
+        with log.phase(runlog.RUN_HOST, "check"):
+            group = deploykit.DeployGroup(hosts)
+            for r in group.run_function(uptodate):
+                if r.result:
+                    statuses[r.host.meta["hostname"]] = "up to date"
+
+        hosts = [h for h in hosts if h.meta["hostname"] not in statuses]
+
+    if (plan or prefetch) and hosts:
+        _nixos_plan(
+            hosts,
+            buildhost,
+            _nix_options(cache, keeperror, showtrace),
+            prefetch,
+            log,
         )
 
-        if hostname:
-            cache_opts = ""
-            if not cache:
-                cache_opts = "--fallback --option binary-caches https://cache.nixos.org/"  # noqa: E501
+    toplevels = {}
+    if buildhost and hosts:
+        builder = _get_buildhost(buildhost)
+        with log.phase(runlog.RUN_HOST, "build"):
+            toplevels = _nixos_build_toplevels(
+                builder,
+                [h.meta["hostname"] for h in hosts],
+                _nix_options(cache, keeperror, showtrace),
+                log,
+            )
+
+    fanned: List[str] = []
+    if fanout and hosts:
+        if buildhost:
+            fanned = _fanout(
+                hosts,
+                _get_buildhost(buildhost),
+                {hn: [path] for hn, path in toplevels.items()},
+                log,
+            )
+        else:
+            source = _flake_source_paths()
+            fanned = _fanout(
+                hosts, None, {h.meta["hostname"]: source for h in hosts}, log
+            )
+
+    def deploy(h: DeployHost) -> str:
+        # Search host by ip
+        host = inventory.load().host_by_ip(h.host)
+        hostname = host.name if host else None
+
+        if hostname and buildhost:
+            toplevel = toplevels[hostname]
+            if action == "build":
+                info(f"{hostname} build result: {toplevel}")
+                return "built"
+
+            if hostname not in fanned:
+                with log.phase(hostname, "copy"):
+                    _nixos_copy_closure(builder, h, toplevel, log)
+            with log.phase(hostname, "activate"):
+                _nixos_activate(h, toplevel, action)
+
+        elif (
+            hostname
+            and reuse
+            and _host_has_path(h, evaluated.get(hostname, ""))
+        ):
+            toplevel = evaluated[hostname]
+            if action == "build":
+                info(f"{hostname} build result: {toplevel} (reused)")
+                return "built"
+
+            with log.phase(hostname, "activate"):
+                _nixos_activate(h, toplevel, action)
+
+        elif hostname:
+            if hostname in fanned:
+                src = _flake_source()
+            else:
+                with log.phase(hostname, "source"):
+                    src = _ship_source(h, log)
+
+            nixopts = _nix_options(cache, keeperror, showtrace)
+            if peers:
+                with log.phase(hostname, "peers"):
+                    nixopts += _peer_substituters(h, hostname)
+            cmd = f"nixos-rebuild -v {action} {NIX_LOG_FORMAT} {nixopts} --fast --option accept-flake-config true --flake path:{src}#{hostname}"  # noqa: E501
+            with log.phase(hostname, "rebuild"), _nix_progress(
+                hostname, log
+            ) as output:
+                h.run(cmd, stdout=output, stderr=output)
+
+            if action == "build":
+                print("#####################################################")
+                print(
+                    "# You can see the build result at "
+                    f"{h.user}@{h.host}:~/result"
+                )
+                print("#####################################################")
+
+        if hostname and discovery:
+            h.meta["hostname"] = hostname
+            with log.phase(hostname, "discovery"):
+                status = _host_hardware_discovery(h)
+            if status not in ["ok", "unchanged"]:
+                warn(f"{hostname} discovery {status}")
+
+        return "built" if action == "build" else "deployed"
+
+    statuses.update(
+        _run_rollout(
+            hosts,
+            deploy,
+            max_parallel,
+            canary,
+            waves=waves and action != "build",
+        )
+    )
+
+    _print_deploy_summary(statuses, log)
+    if [st for st in statuses.values() if st.startswith("failed")]:
+        sys.exit(1)
+
+
+def _home_remote_deploy(
+    username: str,
+    hosts: List[DeployHost],
+    action: str,
+    cache: bool,
+    keeperror: bool,
+    showtrace: bool,
+    max_parallel: int = 0,
+    canary: int = 0,
+    waves: bool = False,
+) -> None:
+    """
+    Deploy to all hosts in parallel, at most <max_parallel> at the same
+    time. If <waves> is set, the hosts are deployed by waves (see
+    _run_rollout), the builds are always run on all the hosts at once
+
+    each phase duration is recorded in a run log (see runlog)
+    """
+    log = runlog.RunLog(f"home.{action}")
 
-            keeperror_opts = ""
-            if keeperror:
-                keeperror_opts = "--option keep-going true"
+    def deploy(h: DeployHost) -> str:
+        # Search host by ip
+        host = inventory.load().host_by_ip(h.host)
+        hostname = host.name if host else None
 
-            showtrace_opts = ""
-            if showtrace:
-                showtrace_opts = "--show-trace"
+        if hostname:
+            with log.phase(hostname, "source"):
+                src = _ship_source(h, log)
+
+            nixopts = _nix_options(cache, keeperror, showtrace)
 
             # Create missing user profile
             h.run(
@@ -1033,43 +2954,84 @@ def _home_remote_deploy(
             #    f"sudo chown {h.user} /nix/var/nix/profiles/per-user/{h.user}"
             # )
 
-            # homemanager deployment
-            cmd = f"cd ~/nix-homelab && home-manager -v {action} {showtrace_opts} {cache_opts} {keeperror_opts} --option accept-flake-config true --flake .#{username}@{hostname}"  # noqa: E501
-            h.run(cmd)
+            # home-manager does not pass --log-format to nix, the activation
+            # package is built first, home-manager then only activate it
+            installable = f'path:{src}#homeConfigurations."{username}@{hostname}".activationPackage'  # noqa: E501
+            outlink = "--out-link result" if action == "build" else "--no-link"
+            cmd = f"nix build {outlink} {NIX_LOG_FORMAT} {nixopts} --option accept-flake-config true {installable}"  # noqa: E501
+            with log.phase(hostname, "build"), _nix_progress(
+                hostname, log
+            ) as output:
+                h.run(cmd, stdout=output, stderr=output)
+
+            if action != "build":
+                # homemanager deployment
+                cmd = f"home-manager -v {action} {nixopts} --option accept-flake-config true --flake path:{src}#{username}@{hostname}"  # noqa: E501
+                with log.phase(hostname, "home-manager"):
+                    h.run(cmd)
+
+        return "built" if action == "build" else "deployed"
+
+    statuses = _run_rollout(
+        hosts,
+        deploy,
+        max_parallel,
+        canary,
+        waves=waves and action != "build",
+    )
 
-    g.run_function(deploy)
+    _print_deploy_summary(statuses, log)
+    if [st for st in statuses.values() if st.startswith("failed")]:
+        sys.exit(1)
 
 
 def _nix_local_deploy(
-    action: str, discovery: bool, cache: bool, keeperror: bool, showtrace: bool
+    action: str,
+    discovery: bool,
+    cache: bool,
+    keeperror: bool,
+    showtrace: bool,
+    skipunchanged: bool = True,
 ) -> None:
     """
     Deploy to on local compute
-    """
-    run(
-        f"rsync --delete {' --exclude '.join([''] + RSYNC_EXCLUDES)} -ar . /nix-homelab/"  # noqa: E501
-    )
 
-    cache_opts = ""
-    if not cache:
-        cache_opts = (
-            "--fallback --option binary-caches https://cache.nixos.org/"
-        )
+    if <skipunchanged> is set, nothing is done when the local computer
+    already runs the new system
+    """
+    log = runlog.RunLog(f"nixos.{action}")
+    hostname = platform.node()
+
+    if skipunchanged and action in SYSTEM_LINKS:
+        with log.phase(hostname, "eval"):
+            toplevel = _nixos_eval_toplevels([hostname]).get(hostname)
+
+        if toplevel:
+            with log.phase(hostname, "check"):
+                res = run(
+                    f"readlink -f {' '.join(SYSTEM_LINKS[action])}",
+                    hide=True,
+                    warn=True,
+                )
+            if res.ok and all([p == toplevel for p in res.stdout.split()]):
+                info(f"{hostname} is up to date")
+                return
 
-    keeperror_opts = ""
-    if keeperror:
-        keeperror_opts = "--option keep-going true"
+    src = _flake_source()
+    if os.path.isdir(HOMELAB_DIR):
+        run(_homelab_copy(src, HOMELAB_DIR))
 
-    showtrace_opts = ""
-    if showtrace:
-        showtrace_opts = "--show-trace"
+    nixopts = _nix_options(cache, keeperror, showtrace)
 
-    cmd = f"cd /nix-homelab && sudo nixos-rebuild -v {action} {showtrace_opts} {cache_opts} {keeperror_opts} --fast --option accept-flake-config true --flake .#"  # noqa: E501
-    run(cmd)
+    cmd = f"sudo nixos-rebuild -v {action} {NIX_LOG_FORMAT} {nixopts} --fast --option accept-flake-config true --flake path:{src}"  # noqa: E501
+    with log.phase(hostname, "rebuild"), _nix_progress(
+        hostname, log
+    ) as output:
+        run(cmd, out_stream=output, err_stream=output)
 
     if action == "build":
         print("#####################################################")
-        print("# You can see the build result at /nix-homelab/result")
+        print(f"# You can see the build result at {ROOT}/result")
         print("#####################################################")
 
 
@@ -1079,280 +3041,545 @@ def _home_local_deploy(
     """
     Deploy to on local compute
     """
-    run(
-        f"rsync --delete {' --exclude '.join([''] + RSYNC_EXCLUDES)} -ar . ~/nix-homelab/"  # noqa: E501
-    )
-
-    cache_opts = ""
-    if not cache:
-        cache_opts = (
-            "--fallback --option binary-caches https://cache.nixos.org/"
-        )
-
-    keeperror_opts = ""
-    if keeperror:
-        keeperror_opts = "--option keep-going true"
-
-    showtrace_opts = ""
-    if showtrace:
-        showtrace_opts = "--show-trace"
+    src = _flake_source()
+    nixopts = _nix_options(cache, keeperror, showtrace)
 
-    cmd = f"cd ~/nix-homelab && home-manager {action} {showtrace_opts} {cache_opts} {keeperror_opts} --option accept-flake-config true --flake ."  # noqa: E501
+    cmd = f"home-manager {action} {nixopts} --option accept-flake-config true --flake path:{src}"  # noqa: E501
     run(cmd)
 
 
-# def _nix_build(hosts: List[DeployHost], cache: bool, keeperror: bool, showtrace: bool) -> None:  # noqa: E501
-#     """
-#     Build for all hosts in parallel
-#     """
-#     g = DeployGroup(hosts)
-
-#     def deploy(h: DeployHost) -> None:
-#         with open('homelab.json', 'r') as f:
-#             jinfo = json.load(f)
-#             hosts = jinfo['hosts']
-
-#             # Search host by ip
-#             hostname = None
-#             for hn in hosts:
-#                 if 'ipv4' in hosts[hn] and  hosts[hn]['ipv4'] == h.host:
-#                     hostname = hn
-#                     break
+def _scan_all_hosts(
+    deploylist: List[DeployHost],
+    workers: int = 8,
+    deadline: float = 0,
+    step_timeout: float = 0,
+    scan_timeout: float = 0,
+    force: bool = False,
+    networks: bool = False,
+) -> None:
+    """
+    Scan the hosts in parallel, a slow or unreachable host does not delay
+    the others, then scan the ports of all hosts with one nmap run (of the
+    hosts IPs, or of the homelab <networks>). The result is saved in
+    SCAN_SUMMARY
 
-#         h.run_local(
-#             f"rsync --delete {' --exclude '.join([''] + RSYNC_EXCLUDES)} -ar . {h.user}@{h.host}:/nix-homelab/"  # noqa: E501
-#         )
+    The <deadline> of each host starts with its discovery (a queued host
+    does not wait on it), the nmap run is bound by <scan_timeout>
+    """
 
-#         if hostname:
-#             cache_opts = ""
-#             if not cache:
-#                 cache_opts = "--fallback --option binary-caches https://cache.nixos.org/"  # noqa: E501
+    def scan(dh: DeployHost) -> Dict[str, Any]:
+        start = time.monotonic()
+        end = start + deadline if deadline > 0 else 0
+        status = _host_hardware_discovery(
+            dh, step_timeout, end, force, scan=False
+        )
+        return {
+            "status": status,
+            "duration": round(time.monotonic() - start, 1),
+        }
+
+    summary = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {
+            executor.submit(scan, dh): dh.meta["hostname"] for dh in deploylist
+        }
+        for future in as_completed(futures):
+            summary[futures[future]] = future.result()
+
+    # Ports scan of the reachable hosts, with an unchanged hardware too
+    inv = inventory.load()
+    hostnames = [
+        hn
+        for hn in summary
+        if summary[hn]["status"] in ["ok", "unchanged"]
+        and "Scan" in OSSCAN[inv.host(hn).os]
+    ]
+    if hostnames:
+        if networks:
+            targets = [network.cidr for network in inv.networks.values()]
+        else:
+            targets = [inv.host(hn).ipv4 for hn in hostnames]
+
+        start = time.monotonic()
+        try:
+            timeout = scan_timeout if scan_timeout > 0 else math.inf
+            _nmap_scan(targets, hostnames, timeout, step_timeout)
+        except subprocess.TimeoutExpired:
+            error = "timeout"
+        except Exception as e:
+            error = f"failed: scan {e}"
+        else:
+            error = ""
 
-#             keeperror_opts = ""
-#             if keeperror:
-#                 keeperror_opts = "--option keep-going true"
+        elapsed = time.monotonic() - start
+        for hn in hostnames:
+            summary[hn]["duration"] = round(
+                summary[hn]["duration"] + elapsed, 1
+            )
+            if error:
+                summary[hn]["status"] = error
+
+    summary = dict(sorted(summary.items()))
+    os.makedirs(os.path.dirname(SCAN_SUMMARY), exist_ok=True)
+    with open(SCAN_SUMMARY, "w") as fw:
+        fw.write(json.dumps(summary, indent=4))
+
+    info("Scan summary")
+    for hn, result in summary.items():
+        line = f"  {hn:<20} {result['status']:<12} {result['duration']}s"
+        if result["status"] in ["ok", "unchanged"]:
+            info(line)
+        else:
+            warn(line)
 
-#             showtrace_opts = ""
-#             if showtrace:
-#                 showtrace_opts="--show-trace"
 
-#             cmd = f"cd /nix-homelab && nixos-rebuild -v build {showtrace_opts} {cache_opts} {keeperror_opts} --fast --option accept-flake-config true --option keep-going true --flake .#{hostname}"  # noqa: E501
-#             h.run(cmd)
+def _doc_host_page_key(inv: inventory.Inventory, hn: str) -> str:
+    """
+    Return the key of the host page inputs
+    """
+    host = inv.host(hn)
+    return docmanifest.hash_inputs(
+        [
+            "docs/hosts/host.tpl",
+            f"docs/hosts/{hn}/scan.json",
+            f"docs/hosts/{hn}/cpu.txt",
+            f"docs/hosts/{hn}/hardwares.txt",
+            "taskslib.py",
+            "hostsummary.py",
+        ],
+        {
+            "host": host.raw,
+            "roles": {
+                role: [
+                    inv.roles[role].icon,
+                    inv.roles[role].description,
+                    os.path.exists(f"docs/{role}.md"),
+                ]
+                for role in host.roles
+            },
+            "osscan": OSSCAN[host.os],
+            "generator": inspect.getsource(_doc_update_hosts_pages),
+        },
+    )
 
-#             h.meta['hostname'] = hostname
 
-#     g.run_function(deploy)
+def _doc_update_hosts_pages(force: bool = False) -> None:
+    """
+    Generate the hosts pages whose inputs changed since the last
+    generation, or all pages if <force>
+    """
+    inv = inventory.load()
+    manifest = docmanifest.Manifest()
 
+    for hn in inv.hosts:
+        # Readme name
+        os.makedirs(f"docs/hosts/{hn}", exist_ok=True)
+        rname = f"docs/hosts/{hn}.md"
 
-def _scan_all_hosts(deploylist: List[DeployHost]) -> None:
-    for dh in deploylist:
-        _host_hardware_discovery(dh)
+        key = _doc_host_page_key(inv, hn)
+        if not force and manifest.is_uptodate(rname, key):
+            continue
 
+        # Start from the template if doc not exists
+        if not os.path.exists(rname):
+            tname = "docs/hosts/host.tpl"
+        else:
+            tname = rname
 
-def _doc_update_hosts_pages() -> None:
-    with open("homelab.json", "r") as fh:
-        jinfo = json.load(fh)
-        hosts = jinfo["hosts"]
+        # Read readme.md content
+        with open(tname, "r") as fr:
+            content = fr.read().rstrip()
 
-        for hn in hosts:
-            # Readme name
-            os.makedirs(f"docs/hosts/{hn}", exist_ok=True)
-            rname = f"docs/hosts/{hn}.md"
-
-            # Clone template if doc not exists
-            if not os.path.exists(rname):
-                shutil.copyfile("docs/hosts/host.tpl", rname)
-
-            # Read readme.md content
-            with open(rname, "r") as fr:
-                content = fr.read().rstrip()
-
-                hinfo = ""
-                sinfo = {
-                    "memory": "",
-                    "disk": "",
-                    "kernel": "",
-                    "cpu": {
-                        "arch": "",
-                        "model": "",
-                        "nb": "",
-                        "bits": 0,
-                        "bogomips": 0,
-                    },
-                }
-
-                for dn in OSSCAN[hosts[hn]["os"]]:
-                    output = ""
-                    match dn:
-                        case "Role":
-                            output = taskslib.generateUsedRoles(
-                                hostname=hn, rootpath=".."
-                            )
-                        case "Config":
-                            filename = f"docs/hosts/{hn}/cpu.txt"
-                            if os.path.exists(filename):
-                                output = "```text\n"
-                                with open(filename, "r") as fr:
-                                    cpu_content = fr.read().strip()
-
-                                    # CPU architecture
-                                    m = re.search(
-                                        r"Architecture:\s+(.*)",
-                                        cpu_content,
-                                        flags=re.M,
-                                    )
-                                    if m:
-                                        sinfo["cpu"]["arch"] = m.group(1)
-                                        output += f"Arch     : {sinfo['cpu']['arch']}\n"  # noqa: E501
-
-                                    # CPU number
-                                    m = re.search(
-                                        r"CPU\(s\):\s+([0-9]+)",
-                                        cpu_content,
-                                        flags=re.M,
-                                    )
-                                    if m:
-                                        sinfo["cpu"]["nb"] = m.group(1)
-
-                                    # CPU model
-                                    m = re.search(
-                                        r"Model name:\s+(.*)",
-                                        cpu_content,
-                                        flags=re.M,
-                                    )
-                                    if m:
-                                        sinfo["cpu"]["model"] = m.group(1)
-                                        output += f"CPU      : {sinfo['cpu']['nb']} x {sinfo['cpu']['model']}\n"  # noqa: E501
-
-                                    # CPU cores
-                                    m = re.search(
-                                        r"BogoMIPS:\s+([0-9]+)",
-                                        cpu_content,
-                                        flags=re.M,
-                                    )
-                                    if m:
-                                        sinfo["cpu"]["bogomips"] = round(
-                                            int(m.group(1))
-                                        )
-                                        output += f"BogoMIPS : {sinfo['cpu']['bogomips']}\n"  # noqa: E501
-
-                            filename = f"docs/hosts/{hn}/hardwares.txt"
-                            if os.path.exists(filename):
-                                with open(filename, "r") as fr:
-                                    hw_content = (
-                                        fr.read().strip().replace("\\", "~")
-                                    )
+            hinfo = ""
+            summary = hostsummary.HostSummary()
 
-                                    # Memory
-                                    m = re.search(
-                                        r"Memory:.*RAM: total: .*?([0-9]+\.[0-9]+) GiB",  # noqa: E501
-                                        hw_content,
-                                        flags=re.M,
-                                    )
-                                    if m:
-                                        sinfo[
-                                            "memory"
-                                        ] = f"{math.floor(float(m.group(1))*1.073741824)} Go"  # noqa: E501
-                                        output += f"RAM      : {sinfo['memory']} Go\n"  # noqa: E501
-
-                                    # Disk
-                                    m = re.search(
-                                        r"Local Storage:.*?total.*?: ([0-9]+\.[0-9]+ \w?iB)",  # noqa: E501
-                                        hw_content,
-                                        flags=re.M,
-                                    )
-                                    if m:
-                                        sinfo["disk"] = m.group(1)
-                                        output += (
-                                            f"DISK     : {sinfo['disk']} Go\n"
-                                        )
-
-                                    # CPU bits
-                                    m = re.search(
-                                        r"CPU: .*?bits: (.*?) \w+:",
-                                        hw_content,
-                                        flags=re.M,
-                                    )
-                                    if m:
-                                        sinfo["cpu"]["bits"] = m.group(1)
-
-                                    # Kernel
-                                    m = re.search(
-                                        r"System: .*?Kernel: ([0-9]+\.[0-9]+\.[0-9]+)",  # noqa: E501
-                                        hw_content,
-                                        flags=re.M,
-                                    )
-                                    if m:
-                                        sinfo["kernel"] = m.group(1)
-                                        output += (
-                                            f"KERNEL   : {sinfo['kernel']}\n"
-                                        )
-
-                            if output:
-                                output += "```"
-
-                        case "Hardwares":
-                            filename = f"docs/hosts/{hn}/{dn.lower()}.txt"
-                            if os.path.exists(filename):
-                                with open(filename, "r") as fr:
-                                    hw_content = (
-                                        fr.read().strip().replace("\\", "~")
-                                    )
+            for dn in OSSCAN[inv.hosts[hn].os]:
+                output = ""
+                match dn:
+                    case "Role":
+                        output = taskslib.generateUsedRoles(
+                            hostname=hn, rootpath=".."
+                        )
+                    case "Config":
+                        summary = hostsummary.load(hn)
+                        lines = summary.lines()
+                        if lines:
+                            output = "```text\n" + "\n".join(lines) + "\n```"
 
-                                    output = f"""```
+                    case "Hardwares":
+                        filename = f"docs/hosts/{hn}/{dn.lower()}.txt"
+                        if os.path.exists(filename):
+                            with open(filename, "r") as fr:
+                                hw_content = (
+                                    fr.read().strip().replace("\\", "~")
+                                )
+
+                                output = f"""```
 {hw_content}
 ```
 """
-                        case "Topologie":
-                            output = f"""
+                    case "Topologie":
+                        output = f"""
 ![hardware topology](https://raw.githubusercontent.com/badele/nix-homelab/master/docs/hosts/{hn}/topologie.svg)
  """  # noqa: E501
 
-                        case "Scan":
-                            filename = f"docs/hosts/{hn}/{dn.lower()}.json"
+                    case "Scan":
+                        filename = f"docs/hosts/{hn}/{dn.lower()}.json"
 
-                            if os.path.exists(filename):
-                                with open(filename, "r") as fr:
-                                    frs = fr.read().strip().replace("\\", "~")
-                                    services = json.loads(frs)
+                        if os.path.exists(filename):
+                            with open(filename, "r") as fr:
+                                frs = fr.read().strip().replace("\\", "~")
+                                services = json.loads(frs)
 
-                                    output = """| Port | Proto | Service | Product | Extra info |
+                                output = """| Port | Proto | Service | Product | Extra info |
 | ------ | ------ | ------ |------ |------ |
 """  # noqa: E501
 
-                                    for svc in services:
-                                        proto = svc["@protocol"]
-                                        port = svc["@portid"]
+                                for svc in services:
+                                    proto = svc["@protocol"]
+                                    port = svc["@portid"]
 
-                                        name = svc["service"].get("@name", "")
-                                        product = svc["service"].get(
-                                            "@product", ""
-                                        )
-                                        extrainfo = svc["service"].get(
-                                            "@extrainfo", ""
-                                        )
+                                    name = svc["service"].get("@name", "")
+                                    product = svc["service"].get(
+                                        "@product", ""
+                                    )
+                                    extrainfo = svc["service"].get(
+                                        "@extrainfo", ""
+                                    )
 
-                                        output += f"|{port}|{proto}|{name}|{product}|{extrainfo}|\n"  # noqa: E501
-                                    output += "\n"
+                                    output += f"|{port}|{proto}|{name}|{product}|{extrainfo}|\n"  # noqa: E501
+                                output += "\n"
 
-                    if output != "":
-                        hinfo += f"""
+                if output != "":
+                    hinfo += f"""
 ### {dn}
 
 {output}
         """
 
-                with open(f"docs/hosts/{hn}/summaries.json", "w") as fw:
-                    fw.write(json.dumps(sinfo, indent=4))
+            docmanifest.write_if_changed(
+                f"docs/hosts/{hn}/summaries.json",
+                json.dumps(summary.to_dict(), indent=4),
+            )
+
+            # Replace content
+            newcontent = taskslib._replace_content(content, "HOSTINFOS", hinfo)
+
+        # Write new content
+        docmanifest.write_if_changed(rname, newcontent)
+        manifest.update(rname, key)
+
+    manifest.save()
+
+
+def _bench_startup(runs: int, max_ms: float) -> None:
+    """
+    Import tasks.py in <runs> fresh interpreters with invoke loaded (as
+    from the inv command), fail if the median import time is above <max_ms>
+    or if a LAZY_MODULES module is loaded at startup
+    """
+    script = """
+import json, sys, time
+import invoke  # already loaded by the inv command
+start = time.perf_counter()
+import tasks
+ms = (time.perf_counter() - start) * 1000
+loaded = [m for m in tasks.LAZY_MODULES if m in sys.modules]
+print(json.dumps({"ms": ms, "loaded": loaded}))
+"""
+
+    times = []
+    loaded = set()
+    for _ in range(max(1, runs)):
+        res = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=ROOT,
+            stdout=subprocess.PIPE,
+            text=True,
+            check=True,
+        )
+        result = json.loads(res.stdout)
+        times.append(result["ms"])
+        loaded.update(result["loaded"])
+
+    times.sort()
+    median = times[len(times) // 2]
+    info(
+        f"tasks.py import: median {median:.1f}ms, "
+        f"min {times[0]:.1f}ms, max {times[-1]:.1f}ms ({len(times)} runs)"
+    )
+
+    failed = False
+    if loaded:
+        warn(f"Modules loaded at startup: {', '.join(sorted(loaded))}")
+        failed = True
+    if max_ms > 0 and median > max_ms:
+        warn(f"Startup regression: {median:.1f}ms > {max_ms}ms")
+        failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+def _cache_host(cachehost: str) -> inventory.Host:
+    """
+    Return the <cachehost> host, or the first host with the nix-serve role
+    """
+    inv = inventory.load()
+    if cachehost:
+        return inv.host(cachehost)
+
+    hosts = inv.hosts_with_role("nix-serve")
+    if not hosts:
+        raise inventory.InventoryError("no host with the nix-serve role")
+
+    return hosts[0]
+
+
+def _flake_attributes(hostnames: str, homes: str) -> Dict[str, str]:
+    """
+    Return the flake attribute of the selected nixos and home
+    configurations, or of all the flake configurations if none is selected
+    """
+    if not hostnames and not homes:
+        index = depindex.load_index()
+        hostnames = ",".join(index["nixos"])
+        homes = ",".join(index["home"])
+
+    attrs = {}
+    for hn in filter(None, hostnames.split(",")):
+        attrs[hn] = flakeeval.attribute("nixos", hn)
+    for conf in filter(None, homes.split(",")):
+        attrs[conf] = flakeeval.attribute("home", conf)
+
+    return attrs
 
-                # Replace content
-                newcontent = taskslib._replace_content(
-                    content, "HOSTINFOS", hinfo
-                )
 
-            # Write new content
-            with open(rname, "w") as fw:
-                fw.write(newcontent)
+def _cache_installables(hostnames: str, homes: str) -> Dict[str, str]:
+    return {
+        name: f".#{attr}"
+        for name, attr in _flake_attributes(hostnames, homes).items()
+    }
+
+
+def _nix_closure(path: str) -> List[str]:
+    """
+    Return the store paths of the <path> closure, empty if <path> is not in
+    the local store
+    """
+    res = run(f"nix path-info -r {path}", warn=True, hide=True)
+    return res.stdout.split() if res.ok else []
+
+
+def _flake_eval(
+    attrs: Dict[str, str],
+    workers: int,
+    max_memory: int,
+    fail_fast: bool,
+    output: str,
+    usecache: bool = True,
+) -> None:
+    """
+    Evaluate the <attrs> (see flakeeval), write the results as JSON and
+    fail if an evaluation failed. The results are cached if <usecache>
+    """
+    start = time.monotonic()
+    results = flakeeval.evaluate_all(
+        attrs,
+        workers,
+        max_memory,
+        fail_fast,
+        evalcache.load() if usecache else None,
+    )
+    content = json.dumps([r.to_dict() for r in results], indent=4)
+
+    if output:
+        with open(output, "w") as fw:
+            fw.write(f"{content}\n")
+    else:
+        print(content)
+
+    errors = [r for r in results if r.error]
+    for r in errors:
+        warn(f"{r.name}: {r.error}")
+
+    # info write to stdout, the summary must not break the JSON output
+    print(
+        f"{len(results) - len(errors)}/{len(attrs)} evaluated in "
+        f"{time.monotonic() - start:.1f}s",
+        file=sys.stderr,
+    )
+    if errors:
+        sys.exit(1)
+
+
+def _narinfo_exists(url: str, path: str) -> bool:
+    """
+    Check if the <path> store path is available in the <url> binary cache
+    """
+    narinfo = f"{url}/{os.path.basename(path)[:32]}.narinfo"
+    request = urllib_request.Request(narinfo, method="HEAD")
+    try:
+        with urllib_request.urlopen(request, timeout=10):
+            return True
+    except OSError:
+        # urllib.error.URLError and HTTPError are OSError
+        return False
+
+
+def _cache_push(
+    installables: Dict[str, str],
+    cachehost: str,
+    workers: int,
+    nixopts: str,
+) -> None:
+    """
+    Build the <installables> and copy their closures to the nix-serve host
+    store, nix-serve sign the paths when it serve them
+
+    The paths shared by several closures are copied once, then the rest of
+    each closure is copied in parallel
+    """
+    host = _cache_host(cachehost)
+    log = runlog.RunLog("cache.push")
+
+    with log.phase(runlog.RUN_HOST, "build"):
+        outs = _nix_build(None, installables, nixopts, log)
+
+    counts: Dict[str, int] = {}
+    for out in outs.values():
+        for path in _nix_closure(out):
+            counts[path] = counts.get(path, 0) + 1
+    shared = [path for path, count in counts.items() if count > 1]
+
+    def copy(name: str, paths: List[str]) -> None:
+        with log.phase(name, "copy"):
+            res = run(
+                f"{NIX_SSHOPTS} nix copy --no-check-sigs --log-format raw --to ssh://root@{host.ipv4} {' '.join(paths)}",  # noqa: E501
+                hide=True,
+            )
+            _log_copied_paths(log, name, None, res.stderr)
+
+    if shared:
+        info(f"Copy {len(shared)} shared paths to {host.name}")
+        copy(runlog.RUN_HOST, shared)
+
+    info(f"Copy {len(outs)} closures to {host.name}")
+    statuses = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {
+            executor.submit(copy, name, [out]): name
+            for name, out in outs.items()
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+                statuses[futures[future]] = "pushed"
+            except Exception as e:
+                statuses[futures[future]] = f"failed: {e}"
+
+    _print_deploy_summary(statuses, log, "Push summary")
+    if [st for st in statuses.values() if st.startswith("failed")]:
+        sys.exit(1)
+
+
+def _cache_status(
+    installables: Dict[str, str], cachehost: str, cacheurl: str, workers: int
+) -> None:
+    """
+    Show the part of each configuration closure available in the nix-serve
+    cache, the closures must be in the local store (see cache.push)
+    """
+    host = _cache_host(cachehost)
+    url = cacheurl or f"http://{host.ipv4}:{NIX_SERVE_PORT}"
+
+    # nix build --dry-run --json evaluate the out paths without building
+    res = run(
+        f"nix build --dry-run --json --option accept-flake-config true {' '.join(installables.values())}",  # noqa: E501
+        hide=True,
+    )
+    outs = {
+        name: build["outputs"]["out"]
+        for name, build in zip(installables, json.loads(res.stdout))
+    }
+    closures = {name: _nix_closure(out) for name, out in outs.items()}
+
+    paths = sorted({path for closure in closures.values() for path in closure})
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        hits = dict(
+            zip(
+                paths,
+                executor.map(lambda path: _narinfo_exists(url, path), paths),
+            )
+        )
+
+    info(f"{url} ({host.name})")
+    info(f"  {'configuration':<24}{'paths':>8}{'cached':>8}{'ratio':>8}")
+    for name, closure in closures.items():
+        if not closure:
+            warn(f"  {name:<24}{'not built, run cache.push first':>24}")
+            continue
+
+        nb = len([path for path in closure if hits[path]])
+        line = f"  {name:<24}{len(closure):>8}{nb:>8}{nb / len(closure):>8.0%}"
+        if nb < len(closure):
+            warn(line)
+        else:
+            info(line)
+
+
+# Commands run against each fake fleet, {hostnames} are its NixOS hosts
+BENCH_FLEET_COMMANDS = [
+    "nixos.build --hostnames {hostnames}",
+    "docs.scan-all-hosts --force --deadline 0",
+    "docs.all-pages",
+]
+
+
+def _bench_fleet(sizes: List[int], output: str, keep: bool) -> None:
+    """
+    Run the BENCH_FLEET_COMMANDS against fake fleets of <sizes> hosts (see
+    fakefleet), report the duration and the peak memory of each command
+    """
+    source = str(Path(__file__).parent.resolve())
+    measures = []
+    for size in sizes:
+        root = tempfile.mkdtemp(prefix=f"homelab-fleet-{size}-")
+        hostnames = fakefleet.create(root, source, size)
+        logfile = f"{root}/.fleet/bench.log"
+        info(f"Fake fleet of {size} hosts in {root}")
+
+        failed = False
+        for command in BENCH_FLEET_COMMANDS:
+            args = [sys.executable, "-m", "invoke", "--search-root", source]
+            args += shlex.split(command.format(hostnames=",".join(hostnames)))
+            measure = fakefleet.measure(
+                root, command.split()[0], args, size, logfile
+            )
+            measures.append(measure)
+            if measure.returncode != 0:
+                warn(f"{measure.command} failed, see {logfile}")
+                failed = True
+
+        if not keep and not failed:
+            shutil.rmtree(root)
+
+    info(f"{'command':<24}{'hosts':>8}{'time':>10}{'memory':>10}  status")
+    for m in measures:
+        status = "ok" if m.returncode == 0 else f"failed ({m.returncode})"
+        info(
+            f"{m.command:<24}{m.hosts:>8}{m.seconds:>9.2f}s"
+            f"{m.maxrss // 1024:>7}MiB  {status}"
+        )
+
+    if output:
+        with open(output, "w") as fw:
+            fw.write(
+                json.dumps([asdict(m) for m in measures], indent=4) + "\n"
+            )
+
+    if [m for m in measures if m.returncode != 0]:
+        sys.exit(1)
 
 
 ##############################################################################
@@ -1366,3 +3593,7 @@ ns.add_collection(home)
 ns.add_collection(docs)
 ns.add_collection(init)
 ns.add_collection(role)
+ns.add_collection(bench)
+ns.add_collection(report)
+ns.add_collection(cache)
+ns.add_task(flake_eval)
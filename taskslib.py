@@ -1,15 +1,27 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import json
+from __future__ import annotations
+
 import os
-import re
 import sys
+import textwrap
 from typing import Any
 from typing import Callable
 from typing import IO
+from typing import List
+from typing import Tuple
+from typing import TYPE_CHECKING
+
+from invoke import Collection
+from invoke import Task
+from invoke.util import helpline
 
-from deploykit import DeployHost
-from invoke import run
+import docmanifest
+import doctemplate
+import inventory
+
+if TYPE_CHECKING:
+    from deploykit import DeployHost
 
 
 def color_text(code: int, file: IO[Any] = sys.stdout) -> Callable[[str], None]:
@@ -22,6 +34,11 @@ def color_text(code: int, file: IO[Any] = sys.stdout) -> Callable[[str], None]:
     return wrapper
 
 
+# `inv -l` layout, for a non interactive terminal
+COMMANDS_WIDTH = 80
+COMMANDS_INDENT = "  "
+
+
 warn = color_text(31, file=sys.stderr)
 info = color_text(32)
 
@@ -42,25 +59,89 @@ nix-store --generate-binary-cache-key {hostname}.h cache-priv-key.pem cache-pub-
     )
 
 
-def generateCommandsList() -> str:
-    res = run("inv -l", hide=True)
+def _commands(coll: Collection, prefix: str = "") -> List[Tuple[str, Task]]:
+    """
+    Return the (dotted name, task) of the <coll> collection tree, in the
+    `inv -l` order
+    """
+    commands = []
+    for name, t in sorted(coll.tasks.items()):
+        aliases = [f"{prefix}{alias}" for alias in sorted(t.aliases)]
+        alias = f" ({', '.join(aliases)})" if aliases else ""
+        commands.append((f"{prefix}{name}{alias}", t))
+
+    for name, subcoll in sorted(coll.collections.items()):
+        commands.extend(_commands(subcoll, f"{prefix}{name}."))
+
+    return commands
+
+
+def generateCommandsList(ns: Collection) -> str:
+    """
+    Return the `inv -l` tasks list of the <ns> collection
+    """
+    commands = _commands(ns)
+    name_width = max(len(name) for name, _ in commands)
+    wrapper = textwrap.TextWrapper(
+        width=COMMANDS_WIDTH - name_width - len(COMMANDS_INDENT) - 3 - 1
+    )
+
+    lines = ["Available tasks:", ""]
+    for name, t in commands:
+        spec = f"{COMMANDS_INDENT}{name:<{name_width}}   "
+        chunks = wrapper.wrap(helpline(t) or "")
+        if not chunks:
+            lines.append(spec.rstrip())
+            continue
+
+        lines.append(spec + chunks[0])
+        for chunk in chunks[1:]:
+            lines.append(" " * len(spec) + chunk)
+
+    text = "\n".join(lines)
     commands = f"""```
-{res.stdout}
+{text}
+
+
 ```
 """
 
     return commands
 
 
+def generateCommandsTable(ns: Collection) -> str:
+    """
+    Return the tasks of the <ns> collection as a table, with their options
+    """
+    table = """| Command | Description | Options |
+| ------ | ------ | ------ |
+"""
+
+    for name, t in _commands(ns):
+        options = []
+        for arg in t.get_arguments():
+            flag = arg.name.replace("_", "-")
+            if arg.kind is bool and arg.default is True:
+                flag = f"no-{flag}"
+            option = f"`--{flag}`"
+            if arg.help:
+                option += f" {arg.help}"
+            options.append(option)
+
+        description = (helpline(t) or "").replace("|", "\\|")
+        options = "<br>".join(options).replace("|", "\\|")
+        table += f"|{name}|{description}|{options}|\n"
+
+    return table
+
+
 ##############################################################################
 # Functions
 ##############################################################################
 
 
 def generateHostsList() -> str:
-    with open("homelab.json", "r") as f:
-        jhl = json.load(f)
-        hosts = jhl["hosts"]
+    hosts = inventory.load().hosts
 
     # Header table
     hosts_table = """<table>
@@ -74,10 +155,10 @@ def generateHostsList() -> str:
     # Hosts loop
     for hn in hosts:
         hosts_table += f"""<tr>
-            <td><a href="./docs/hosts/{hn}.md"><img width="32" src="{hosts[hn]["icon"]}"></a></td>
-            <td><a href="./docs/hosts/{hn}.md">{hn}</a>&nbsp;({hosts[hn]["ipv4"]})</td>
-            <td>{hosts[hn]["os"]}</td>
-            <td>{hosts[hn]["description"]}</td>
+            <td><a href="./docs/hosts/{hn}.md"><img width="32" src="{hosts[hn].icon}"></a></td>
+            <td><a href="./docs/hosts/{hn}.md">{hn}</a>&nbsp;({hosts[hn].ipv4})</td>
+            <td>{hosts[hn].os}</td>
+            <td>{hosts[hn].description}</td>
         </tr>"""  # noqa: E501
 
     hosts_table += "</table>"
@@ -86,29 +167,22 @@ def generateHostsList() -> str:
 
 
 def getUsedRolesList(hostname=None):
-    filename = "homelab.json"
+    inv = inventory.load()
     allroles = {}
-    with open(filename, "r") as fr:
-        jinfo = json.load(fr)
-        hostslist = jinfo["hosts"]
 
-        for hn in hostslist:
-            if hostname and hn != hostname:
-                continue
-
-            if "roles" in hostslist[hn]:
-                for svc in hostslist[hn]["roles"]:
-                    if svc not in allroles:
-                        allroles[svc] = []
-                    allroles[svc].append(hn)
+    if hostname:
+        for svc in inv.host(hostname).roles:
+            allroles[svc] = [hostname]
+    else:
+        for svc in inv.by_role:
+            allroles[svc] = [host.name for host in inv.by_role[svc]]
 
     return allroles
 
 
 def generateNetworkGraph():
-    with open("homelab.json", "r") as f:
-        jhl = json.load(f)
-        hosts = jhl["hosts"]
+    inv = inventory.load()
+    hosts = inv.hosts
 
     # Header table
     network_graph = """```mermaid
@@ -119,26 +193,19 @@ def generateNetworkGraph():
  """
 
     # Hosts loop
-    zones = {}
     for hn in hosts:
-        if "zone" in hosts[hn]:
-            zone = hosts[hn]["zone"]
-            if zone not in zones:
-                zones[zone] = []
-            zones[zone].append(hn)
-
-        network_graph += f"{hn}[<center>{hosts[hn]['description']}</br>{hosts[hn]['ipv4']}</center>]"  # noqa: E501
+        network_graph += f"{hn}[<center>{hosts[hn].description}</br>{hosts[hn].ipv4}</center>]"  # noqa: E501
 
-        if "parent" in hosts[hn]:
-            network_graph += f"---{hosts[hn]['parent']}"
+        if hosts[hn].parent:
+            network_graph += f"---{hosts[hn].parent}"
 
         network_graph += "\n"
     network_graph += "\n"
 
-    for zn in zones:
+    for zn in inv.by_zone:
         network_graph += f"subgraph {zn}\n"
-        for zi in zones[zn]:
-            network_graph += f"{zi}\n"
+        for zi in inv.by_zone[zn]:
+            network_graph += f"{zi.name}\n"
         network_graph += "end\n\n"
 
     network_graph += "```"
@@ -147,9 +214,7 @@ def generateNetworkGraph():
 
 def generateUsedRoles(rootpath, hostname=None) -> str:
     # Get hosts infos
-    with open("homelab.json", "r") as fhl:
-        jhl = json.load(fhl)
-        roles = jhl["roles"]
+    roles = inventory.load().roles
 
     allroles = getUsedRolesList(hostname)
 
@@ -172,17 +237,17 @@ def generateUsedRoles(rootpath, hostname=None) -> str:
         filename = f"docs/{mname}.md"
         if os.path.exists(filename):
             roles_table += f"""<tr>
-            <td><a href="{rootpath}/{mname}.md"><img width="32" src="{roles[mname]["icon"]}"></a></td>
+            <td><a href="{rootpath}/{mname}.md"><img width="32" src="{roles[mname].icon}"></a></td>
             <td><a href="{rootpath}/{mname}.md">{mname}</a></td>
             """  # noqa: E501
         else:
             roles_table += f"""<tr>
-            <td><img width="32" src="{roles[mname]["icon"]}"></td>
+            <td><img width="32" src="{roles[mname].icon}"></td>
             <td>{mname}</td>
             """
 
         roles_table += f"""<td>{", ".join(hosts_list)}</td>
-        <td>{roles[mname]['description']}</td>
+        <td>{roles[mname].description}</td>
         """
 
     roles_table += "</table>"
@@ -192,40 +257,44 @@ def generateUsedRoles(rootpath, hostname=None) -> str:
 
 # Replace the content marker
 def _replace_content(content: str, marker: str, newcontent) -> str:
-    newcontent = f"""[comment]: (>>{marker})
+    return doctemplate.render(content, {marker: lambda: newcontent})
 
-{newcontent}
 
-[comment]: (<<{marker})"""
-
-    result = re.sub(
-        rf"\[comment\]: \(\>\>{marker}\).*\[comment\]\: \(\<\<{marker}\)",
-        newcontent,
-        content,
-        flags=re.DOTALL | re.M,
+def _main_project_page_key() -> str:
+    """
+    Return the key of the main project page inputs
+    """
+    inv = inventory.load()
+    return docmanifest.hash_inputs(
+        ["homelab.json", "tasks.py", "taskslib.py"],
+        {role: os.path.exists(f"docs/{role}.md") for role in inv.roles},
     )
 
-    return result
-
 
 # Update the main README.md project page
-def _doc_update_main_project_page() -> None:
+def _doc_update_main_project_page(ns: Collection, force: bool = False) -> None:
+    manifest = docmanifest.Manifest()
+    key = _main_project_page_key()
+    if not force and manifest.is_uptodate("README.md", key):
+        return
+
     # Read readme.md content
     with open("README.md", "r") as fr:
         content = fr.read().rstrip()
 
-    # Get generated contents
-    hosts_table = generateHostsList()
-    roles_table = generateUsedRoles(rootpath="./docs")
-    network_graph = generateNetworkGraph()
-    commands = generateCommandsList()
-
-    # Replace content
-    newcontent = _replace_content(content, "HOSTS", hosts_table)
-    newcontent = _replace_content(content, "NETWORK", network_graph)
-    newcontent = _replace_content(newcontent, "ROLES", roles_table)
-    newcontent = _replace_content(newcontent, "COMMANDS", commands)
+    # Replace content, the generators are only run for the present markers
+    newcontent = doctemplate.render(
+        content,
+        {
+            "HOSTS": generateHostsList,
+            "NETWORK": generateNetworkGraph,
+            "ROLES": lambda: generateUsedRoles(rootpath="./docs"),
+            "COMMANDS": lambda: generateCommandsList(ns),
+            "COMMANDS_TABLE": lambda: generateCommandsTable(ns),
+        },
+    )
 
     # Write new content
-    with open("README.md", "w") as fw:
-        fw.write(newcontent)
+    docmanifest.write_if_changed("README.md", newcontent)
+    manifest.update("README.md", key)
+    manifest.save()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Any
+from typing import Dict
+
+import pytest
+
+# The tested modules are at the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inventory  # noqa: E402
+
+# Small homelab: the home zone tree (router > nas > desktop, router >
+# laptop), a cloud zone and a host without zone
+HOMELAB: Dict[str, Any] = {
+    "domain": "homelab.lan",
+    "roles": {"coredns": {}, "nix-serve": {}},
+    "hosts": {
+        "router": {
+            "ipv4": "192.168.0.1",
+            "os": "NixOS",
+            "zone": "home",
+            "parent": "internet",
+            "roles": ["coredns"],
+        },
+        "nas": {
+            "ipv4": "192.168.0.2",
+            "os": "NixOS",
+            "zone": "home",
+            "parent": "router",
+            "roles": ["nix-serve"],
+        },
+        "desktop": {
+            "ipv4": "192.168.0.3",
+            "os": "NixOS",
+            "zone": "home",
+            "parent": "nas",
+        },
+        "laptop": {
+            "ipv4": "192.168.0.4",
+            "os": "NixOS",
+            "zone": "home",
+            "parent": "router",
+        },
+        "vps1": {
+            "ipv4": "10.0.0.1",
+            "os": "NixOS",
+            "zone": "cloud",
+            "parent": "internet",
+        },
+        "vps2": {
+            "ipv4": "10.0.0.2",
+            "os": "NixOS",
+            "zone": "cloud",
+            "parent": "internet",
+        },
+        "box": {"ipv4": "10.0.1.1", "os": "NixOS", "parent": "internet"},
+    },
+}
+
+
+def write_files(root: Path, files: Dict[str, str]) -> None:
+    """
+    Write the <files> (relative filename: content) in <root>
+    """
+    for filename, content in files.items():
+        path = root / filename
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+
+
+def git(root: Path, *args: str) -> str:
+    res = subprocess.run(
+        [
+            "git",
+            "-c",
+            "user.name=homelab",
+            "-c",
+            "user.email=homelab@localhost",
+            *args,
+        ],
+        cwd=root,
+        stdout=subprocess.PIPE,
+        check=True,
+        text=True,
+    )
+
+    return res.stdout
+
+
+@pytest.fixture
+def gitrepo(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """
+    Empty git repository, used as the current directory
+    """
+    git(tmp_path, "init", "-q")
+    monkeypatch.chdir(tmp_path)
+
+    return tmp_path
+
+
+@pytest.fixture
+def homelab(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """
+    The HOMELAB homelab.json, in the current directory
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(inventory, "_cache", {})
+    write_files(tmp_path, {"homelab.json": json.dumps(HOMELAB)})
+
+    return tmp_path
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+deploykit = pytest.importorskip("deploykit")
+
+import tasks  # noqa: E402
+import taskslib  # noqa: E402
+
+ROOT = Path(__file__).parent.parent
+
+
+def test_commands_list() -> None:
+    # Not a terminal: inv -l wraps the help lines at 80 columns
+    res = subprocess.run(
+        [sys.executable, "-m", "invoke", "-l"],
+        cwd=ROOT,
+        stdout=subprocess.PIPE,
+        stdin=subprocess.DEVNULL,
+        check=True,
+        text=True,
+    )
+
+    assert (
+        taskslib.generateCommandsList(tasks.ns) == f"```\n{res.stdout}\n```\n"
+    )
+
+
+def test_commands_table() -> None:
+    table = taskslib.generateCommandsTable(tasks.ns)
+
+    # A header, then a row by command with its options
+    assert len(table.splitlines()) == 2 + len(taskslib._commands(tasks.ns))
+    assert "|nixos.deploy|Deploy to <hostnames> server|" in table
+    assert "`--no-discovery` get host information after deployment" in table
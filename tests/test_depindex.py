@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import io
+from pathlib import Path
+
+import pytest
+from conftest import git
+from conftest import write_files
+
+import depindex
+
+FLAKE = """
+{
+  outputs = { nixpkgs, home-manager, ... }: {
+    nixosConfigurations = {
+      alpha = nixpkgs.lib.nixosSystem {
+        modules = [ ./hosts/alpha ];
+      };
+      beta = nixpkgs.lib.nixosSystem {
+        modules = [ ./hosts/beta ];
+      };
+    };
+    homeConfigurations = {
+      "user@alpha" = home-manager.lib.homeManagerConfiguration {
+        modules = [ ./users/user/alpha.nix ];
+      };
+    };
+  };
+}
+"""
+DNS_IMPORT = "{ imports = [ ../../roles/dns.nix ]; }"
+
+
+@pytest.fixture
+def flake(gitrepo: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    # invoke run forwards the stdin, captured by pytest
+    monkeypatch.setattr("sys.stdin", io.StringIO())
+    write_files(
+        gitrepo,
+        {
+            "flake.nix": FLAKE,
+            "flake.lock": "{}",
+            # alpha imports the dns role, the comments are not imports
+            "hosts/alpha/default.nix": DNS_IMPORT,
+            "hosts/beta/default.nix": f"{{ }} # {DNS_IMPORT}",
+            "roles/dns.nix": "{ }",
+            "users/user/alpha.nix": "{ imports = [ ../common ]; }",
+            "users/common/default.nix": "{ }",
+        },
+    )
+    git(gitrepo, "add", ".")
+    git(gitrepo, "commit", "-q", "-m", "init")
+
+    return gitrepo
+
+
+def test_unchanged(flake: Path) -> None:
+    assert depindex.affected_configurations("HEAD") == {
+        "nixos": [],
+        "home": [],
+    }
+
+
+def test_imported_file(flake: Path) -> None:
+    write_files(flake, {"roles/dns.nix": "{ services.bind.enable = true; }"})
+
+    assert depindex.affected_configurations("HEAD") == {
+        "nixos": ["alpha"],
+        "home": [],
+    }
+
+
+def test_directory_import(flake: Path) -> None:
+    write_files(flake, {"users/common/default.nix": "{ home.foo = 1; }"})
+
+    assert depindex.affected_configurations("HEAD") == {
+        "nixos": [],
+        "home": ["user@alpha"],
+    }
+
+
+def test_global_dependency(flake: Path) -> None:
+    write_files(flake, {"flake.lock": '{"version": 7}'})
+
+    assert depindex.affected_configurations("HEAD") == {
+        "nixos": ["alpha", "beta"],
+        "home": ["user@alpha"],
+    }
+
+
+def test_untracked_file(flake: Path) -> None:
+    write_files(flake, {"hosts/beta/disks.nix": "{ }"})
+
+    assert "hosts/beta/disks.nix" in depindex.changed_files("HEAD")
+    assert depindex.affected_configurations("HEAD")["nixos"] == ["beta"]
+
+
+def test_ignored_file(flake: Path) -> None:
+    write_files(flake, {".gitignore": "result\n"})
+    git(flake, "add", ".gitignore")
+    git(flake, "commit", "-q", "-m", "ignore")
+    write_files(flake, {"result": ""})
+
+    assert depindex.changed_files("HEAD") == []
+
+
+def test_index_updated(flake: Path) -> None:
+    depindex.affected_configurations("HEAD")
+    write_files(
+        flake,
+        {"hosts/beta/default.nix": DNS_IMPORT},
+    )
+    git(flake, "commit", "-q", "-am", "beta dns")
+    write_files(flake, {"roles/dns.nix": "{ services.bind.enable = true; }"})
+
+    assert depindex.affected_configurations("HEAD")["nixos"] == [
+        "alpha",
+        "beta",
+    ]
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import io
+import json
+import os
+import platform
+import subprocess
+import tarfile
+from pathlib import Path
+from typing import Dict
+
+import pytest
+from conftest import write_files
+
+deploykit = pytest.importorskip("deploykit")
+
+import tasks  # noqa: E402
+
+# nmap -sV -oX report (trimmed): router with two ports, nas with one port,
+# desktop without open port, laptop not scanned and an unknown host
+NMAP_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE nmaprun>
+<nmaprun scanner="nmap" args="nmap --version-intensity 0 -sV -oX -">
+<scaninfo type="connect" protocol="tcp" numservices="1000"/>
+<host starttime="1700000000" endtime="1700000010">
+<status state="up" reason="syn-ack"/>
+<address addr="192.168.0.1" addrtype="ipv4"/>
+<address addr="52:54:00:12:34:56" addrtype="mac"/>
+<ports>
+<extraports state="closed" count="998"/>
+<port protocol="tcp" portid="22">
+<state state="open" reason="syn-ack"/>
+<service name="ssh" product="OpenSSH" version="9.6" method="probed" conf="10">
+<cpe>cpe:/a:openbsd:openssh:9.6</cpe>
+</service>
+</port>
+<port protocol="udp" portid="53">
+<state state="open" reason="udp-response"/>
+<service name="domain" product="CoreDNS" method="probed" conf="10"/>
+</port>
+</ports>
+</host>
+<host>
+<status state="up" reason="syn-ack"/>
+<address addr="192.168.0.2" addrtype="ipv4"/>
+<ports>
+<port protocol="tcp" portid="5000">
+<state state="open" reason="syn-ack"/>
+<service name="http" product="nix-serve" servicefp="SF:..."/>
+</port>
+</ports>
+</host>
+<host>
+<status state="up" reason="syn-ack"/>
+<address addr="192.168.0.3" addrtype="ipv4"/>
+<ports>
+<extraports state="closed" count="1000"/>
+</ports>
+</host>
+<host>
+<status state="up" reason="syn-ack"/>
+<address addr="192.168.0.99" addrtype="ipv4"/>
+<ports>
+<port protocol="tcp" portid="80">
+<state state="open" reason="syn-ack"/>
+<service name="http"/>
+</port>
+</ports>
+</host>
+<runstats><finished elapsed="10.00" exit="success"/></runstats>
+</nmaprun>
+"""
+
+STEPS = {
+    "Good": ("good.txt", "echo good > {out}", ""),
+    "Bad": ("bad.txt", "echo partial > {out}; exit 1", ""),
+}
+
+
+@pytest.fixture
+def nmap(homelab: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """
+    Fake nmap of the local toolbox, run by a fake sudo, the tests append
+    its output commands to the returned script
+    """
+    bindir = homelab / "tools" / "bin"
+    write_files(
+        bindir,
+        {
+            "nmap": f'#!/bin/sh\necho "$@" > {homelab}/args\n',
+            "sudo": '#!/bin/sh\nexec "$@"\n',
+        },
+    )
+    for path in bindir.iterdir():
+        path.chmod(0o755)
+
+    monkeypatch.setenv("PATH", f"{bindir}:/usr/bin:/bin")
+    monkeypatch.setattr(
+        tasks,
+        "_discovery_toolbox",
+        lambda: {platform.machine(): str(homelab / "tools")},
+    )
+
+    return bindir / "nmap"
+
+
+def test_nmap_scan(homelab: Path, nmap: Path) -> None:
+    write_files(homelab, {"nmap.xml": NMAP_XML})
+    with nmap.open("a") as fa:
+        fa.write(f"cat {homelab}/nmap.xml\n")
+
+    saved = tasks._nmap_scan(
+        ["192.168.0.0/24"], ["router", "nas", "desktop"], 10, 5
+    )
+
+    # Hosts without open ports, not asked or unknown are not saved
+    assert saved == ["router", "nas"]
+    assert not (homelab / "docs/hosts/desktop/scan.json").exists()
+    assert not (homelab / "docs/hosts/laptop").exists()
+    assert (homelab / "args").read_text().split() == [
+        "--version-intensity",
+        "0",
+        "-sV",
+        "--host-timeout",
+        "5s",
+        "192.168.0.0/24",
+        "-oX",
+        "-",
+    ]
+
+    # The ports state and the service details are removed
+    with open(homelab / "docs/hosts/router/scan.json") as fr:
+        assert json.load(fr) == [
+            {
+                "@protocol": "tcp",
+                "@portid": "22",
+                "service": {
+                    "@name": "ssh",
+                    "@product": "OpenSSH",
+                },
+            },
+            {
+                "@protocol": "udp",
+                "@portid": "53",
+                "service": {"@name": "domain", "@product": "CoreDNS"},
+            },
+        ]
+    with open(homelab / "docs/hosts/nas/scan.json") as fr:
+        assert json.load(fr) == [
+            {
+                "@protocol": "tcp",
+                "@portid": "5000",
+                "service": {"@name": "http", "@product": "nix-serve"},
+            }
+        ]
+
+
+def test_nmap_scan_timeout(homelab: Path, nmap: Path) -> None:
+    write_files(homelab, {"nmap.xml": NMAP_XML})
+    with nmap.open("a") as fa:
+        fa.write(f"head -n 5 {homelab}/nmap.xml\nsleep 30\n")
+
+    with pytest.raises(subprocess.TimeoutExpired):
+        tasks._nmap_scan(["192.168.0.1"], ["router"], 0.5)
+
+
+def test_nmap_scan_failed(homelab: Path, nmap: Path) -> None:
+    with nmap.open("a") as fa:
+        fa.write("echo '<nmaprun></nmaprun>'\nexit 2\n")
+
+    with pytest.raises(Exception, match="nmap exit 2"):
+        tasks._nmap_scan(["192.168.0.1"], ["router"])
+
+
+def discover(
+    tmp_path: Path, fingerprint: str, toolbox: Dict[str, str]
+) -> Dict[str, str]:
+    """
+    Run the discovery script locally, return the archive files content
+    """
+    script = tasks._discovery_script(list(STEPS), 10, fingerprint, toolbox)
+    res = subprocess.run(
+        ["bash", "-s"],
+        input=script.encode(),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        cwd=tmp_path,
+        check=True,
+    )
+
+    files = {}
+    with tarfile.open(fileobj=io.BytesIO(res.stdout), mode="r:gz") as tar:
+        for member in tar.getmembers():
+            if member.isfile():
+                fr = tar.extractfile(member)
+                assert fr is not None
+                files[os.path.normpath(member.name)] = fr.read().decode()
+
+    return files
+
+
+def test_discovery_script(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(tasks, "DISCOVERY_COMMANDS", STEPS)
+    toolbox = {platform.machine(): str(tmp_path)}
+
+    # The failed steps are listed, the host toolbox is used
+    files = discover(tmp_path, "", toolbox)
+    fingerprint = files.pop(tasks.FINGERPRINT_FILE).strip()
+    assert len(fingerprint) == 64
+    assert files == {
+        "good.txt": "good\n",
+        "bad.txt": "partial\n",
+        ".failed": "Bad\n",
+    }
+
+    # Unchanged fingerprint: the steps are skipped
+    assert discover(tmp_path, fingerprint, toolbox) == {
+        tasks.FINGERPRINT_FILE: f"{fingerprint}\n"
+    }
+
+
+def test_discovery_script_toolbox(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(tasks, "DISCOVERY_COMMANDS", STEPS)
+
+    # Toolbox not in the host store: a copy is asked for the host machine
+    for toolbox in [{}, {platform.machine(): str(tmp_path / "missing")}]:
+        files = discover(tmp_path, "", toolbox)
+        assert files[".toolbox"] == f"{platform.machine()}\n"
+        assert files["good.txt"] == "good\n"
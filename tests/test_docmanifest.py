@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from pathlib import Path
+
+import pytest
+from conftest import write_files
+
+import docmanifest
+
+
+@pytest.fixture
+def docs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.chdir(tmp_path)
+    write_files(tmp_path, {"hosts/alpha.nix": "{ }", "README.md": "alpha"})
+
+    return tmp_path
+
+
+def test_hash_inputs(docs: Path) -> None:
+    files = ["hosts/alpha.nix"]
+    key = docmanifest.hash_inputs(files, {"ipv4": "10.0.0.1"})
+
+    assert docmanifest.hash_inputs(files, {"ipv4": "10.0.0.1"}) == key
+    assert docmanifest.hash_inputs() == docmanifest.hash_inputs([], None)
+
+    # Changed data, changed file content, missing files
+    assert docmanifest.hash_inputs(files, {"ipv4": "10.0.0.2"}) != key
+    write_files(docs, {"hosts/alpha.nix": "{ x = 1; }"})
+    assert docmanifest.hash_inputs(files, {"ipv4": "10.0.0.1"}) != key
+    missing = docmanifest.hash_inputs(["hosts/beta.nix"])
+    assert docmanifest.hash_inputs(["hosts/gamma.nix"]) != missing
+
+
+def test_write_if_changed(docs: Path) -> None:
+    assert not docmanifest.write_if_changed("README.md", "alpha")
+    assert docmanifest.write_if_changed("README.md", "beta")
+    assert docmanifest.write_if_changed("NEW.md", "gamma")
+    assert (docs / "README.md").read_text() == "beta"
+    assert (docs / "NEW.md").read_text() == "gamma"
+
+
+def test_manifest(docs: Path) -> None:
+    manifest = docmanifest.Manifest()
+    assert not manifest.is_uptodate("README.md", "key")
+
+    manifest.update("README.md", "key")
+    manifest.update("MISSING.md", "key")
+    manifest.save()
+
+    manifest = docmanifest.Manifest()
+    assert manifest.is_uptodate("README.md", "key")
+    assert not manifest.is_uptodate("README.md", "other")
+    # The generated page was removed
+    assert not manifest.is_uptodate("MISSING.md", "key")
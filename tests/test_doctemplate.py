@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from typing import Callable
+from typing import Dict
+from typing import List
+
+import doctemplate
+
+
+def generators(called: List[str]) -> Dict[str, Callable[[], str]]:
+    def generate(marker: str) -> Callable[[], str]:
+        def content() -> str:
+            called.append(marker)
+            return f"new {marker}"
+
+        return content
+
+    return {marker: generate(marker) for marker in ["HOSTS", "ROLES"]}
+
+
+def test_render() -> None:
+    called: List[str] = []
+    content = "\n\n".join(
+        [
+            "# Homelab",
+            doctemplate.section("HOSTS", "old hosts"),
+            "Text",
+            doctemplate.section("UNKNOWN", "kept"),
+        ]
+    )
+
+    assert doctemplate.render(content, generators(called)) == "\n\n".join(
+        [
+            "# Homelab",
+            doctemplate.section("HOSTS", "new HOSTS"),
+            "Text",
+            doctemplate.section("UNKNOWN", "kept"),
+        ]
+    )
+    # ROLES is not in the content
+    assert called == ["HOSTS"]
+
+
+def test_render_twice() -> None:
+    content = doctemplate.section("ROLES", "old") * 2
+
+    assert doctemplate.render(content, generators([])) == (
+        doctemplate.section("ROLES", "new ROLES") * 2
+    )
+
+
+def test_unbalanced_markers() -> None:
+    called: List[str] = []
+    content = "\n".join(
+        [
+            # Not closed
+            "[comment]: (>>HOSTS)",
+            "hosts",
+            # Closed without opening
+            "[comment]: (<<ROLES)",
+            "roles",
+        ]
+    )
+
+    assert doctemplate.render(content, generators(called)) == content
+    assert called == []
+
+
+def test_unclosed_marker() -> None:
+    content = "\n".join(
+        ["[comment]: (>>HOSTS)", doctemplate.section("ROLES", "old")]
+    )
+
+    # The next sections are still filled
+    assert doctemplate.render(content, generators([])) == "\n".join(
+        ["[comment]: (>>HOSTS)", doctemplate.section("ROLES", "new ROLES")]
+    )
+
+
+def test_nested_markers() -> None:
+    content = "\n".join(
+        [
+            "[comment]: (>>HOSTS)",
+            "[comment]: (>>ROLES)",
+            "roles",
+            "[comment]: (<<ROLES)",
+            "[comment]: (<<HOSTS)",
+        ]
+    )
+
+    # The outer section is replaced, the inner markers are its content
+    assert doctemplate.render(content, generators([])) == (
+        doctemplate.section("HOSTS", "new HOSTS")
+    )
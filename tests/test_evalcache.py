@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from pathlib import Path
+
+import pytest
+from conftest import git
+from conftest import write_files
+
+import evalcache
+
+ATTR = "nixosConfigurations.alpha.config.system.build.toplevel"
+
+
+@pytest.fixture
+def flake(gitrepo: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.setattr(evalcache, "_cache", None)
+    write_files(
+        gitrepo,
+        {
+            "flake.nix": "{ }",
+            "flake.lock": "{}",
+            "hosts/alpha/default.nix": "{ }",
+        },
+    )
+    git(gitrepo, "add", ".")
+    git(gitrepo, "commit", "-q", "-m", "init")
+
+    return gitrepo
+
+
+def test_source_key(flake: Path) -> None:
+    key = evalcache.source_key()
+    assert evalcache.source_key() == key
+
+    # Ignored by nix: untracked files
+    write_files(flake, {"notes.txt": "todo"})
+    assert evalcache.source_key() == key
+
+    # A tracked file content, a new staged file and the lock
+    write_files(flake, {"hosts/alpha/default.nix": "{ x = 1; }"})
+    changed = evalcache.source_key()
+    assert changed != key
+
+    git(flake, "add", "notes.txt")
+    staged = evalcache.source_key()
+    assert staged != changed
+
+    write_files(flake, {"flake.lock": '{"version": 7}'})
+    assert evalcache.source_key() != staged
+
+    # Back to the committed tree
+    git(flake, "rm", "-q", "--cached", "notes.txt")
+    git(flake, "checkout", "-q", ".")
+    assert evalcache.source_key() == key
+
+
+def test_entries(flake: Path) -> None:
+    cache = evalcache.EvalCache()
+    assert cache.get(ATTR) is None
+    cache.put(ATTR, "/drv", "/out")
+    cache.save()
+
+    assert evalcache.EvalCache().get(ATTR) == {
+        "drvPath": "/drv",
+        "outPath": "/out",
+    }
+
+    # Changed source, then back to the cached one
+    write_files(flake, {"flake.nix": "{ outputs = { }; }"})
+    assert evalcache.EvalCache().get(ATTR) is None
+    git(flake, "checkout", "-q", ".")
+    assert evalcache.EvalCache().get(ATTR) is not None
+
+
+def test_max_sources(flake: Path) -> None:
+    for idx in range(evalcache.MAX_SOURCES + 1):
+        write_files(flake, {"flake.lock": f'{{"version": {idx}}}'})
+        cache = evalcache.EvalCache()
+        cache.put(ATTR, f"/drv/{idx}", f"/out/{idx}")
+        cache.save()
+
+    # The oldest source is removed
+    write_files(flake, {"flake.lock": '{"version": 0}'})
+    assert evalcache.EvalCache().get(ATTR) is None
+    write_files(flake, {"flake.lock": '{"version": 1}'})
+    assert evalcache.EvalCache().get(ATTR) == {
+        "drvPath": "/drv/1",
+        "outPath": "/out/1",
+    }
+
+
+def test_load(flake: Path) -> None:
+    cache = evalcache.load()
+    assert evalcache.load() is cache
+
+    write_files(flake, {"flake.nix": "{ outputs = { }; }"})
+    assert evalcache.load() is not cache
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import subprocess
+import threading
+from pathlib import Path
+from typing import Any
+from typing import List
+from typing import Tuple
+
+import pytest
+
+deploykit = pytest.importorskip("deploykit")
+
+import runlog  # noqa: E402
+import tasks  # noqa: E402
+
+
+def test_relays(homelab: Path) -> None:
+    hosts = tasks.get_deploylist_from_homelab("root", "")
+
+    # One top relay by zone, the children are sent by their nearest
+    # deployed parent, a host without zone is sent directly
+    assert tasks._fanout_relays(hosts) == {
+        "router": "",
+        "nas": "router",
+        "desktop": "nas",
+        "laptop": "router",
+        "vps1": "",
+        "vps2": "vps1",
+        "box": "",
+    }
+
+
+def test_relays_ancestor(homelab: Path) -> None:
+    hosts = tasks.get_deploylist_from_homelab("root", "router,desktop")
+
+    # nas is not deployed, its deployed parent relays to desktop
+    assert tasks._fanout_relays(hosts) == {"router": "", "desktop": "router"}
+
+
+def test_relays_zone(homelab: Path) -> None:
+    hosts = tasks.get_deploylist_from_homelab("root", "nas,desktop,laptop")
+
+    # Without the zone root, its first host (nearest to the root) relays
+    assert tasks._fanout_relays(hosts) == {
+        "laptop": "",
+        "nas": "laptop",
+        "desktop": "nas",
+    }
+
+
+def test_fanout(
+    homelab: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    lock = threading.Lock()
+    copies: List[Tuple[str, str, bool]] = []
+
+    def target(cmd: str) -> str:
+        # The receiver and the sent paths
+        return cmd.split("@")[1]
+
+    def run(self: Any, cmd: str, **kwargs: Any) -> Any:
+        with lock:
+            copies.append(
+                (self.meta["hostname"], target(cmd), self.forward_agent)
+            )
+        return subprocess.CompletedProcess(cmd, 0, "", "")
+
+    def run_local(self: Any, cmd: str, **kwargs: Any) -> Any:
+        with lock:
+            copies.append(("local", target(cmd), False))
+        return subprocess.CompletedProcess(cmd, 0, "", "")
+
+    monkeypatch.setattr(deploykit.DeployHost, "run", run)
+    monkeypatch.setattr(deploykit.DeployHost, "run_local", run_local)
+
+    hosts = tasks.get_deploylist_from_homelab("root", "router,nas,desktop")
+    log = runlog.RunLog("nixos.switch", str(tmp_path / "runs"))
+    received = tasks._fanout(
+        hosts, None, {h.meta["hostname"]: [f"/{h.host}"] for h in hosts}, log
+    )
+
+    assert sorted(received) == ["desktop", "nas", "router"]
+    # A relay receives the paths of its subtree
+    assert copies == [
+        ("local", "192.168.0.1 /192.168.0.1 /192.168.0.2 /192.168.0.3", False),
+        ("router", "192.168.0.2 /192.168.0.2 /192.168.0.3", True),
+        ("nas", "192.168.0.3 /192.168.0.3", True),
+    ]
+    # The agent is only forwarded for the relays copies
+    assert [h.forward_agent for h in hosts] == [False, False, False]
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import signal
+import subprocess
+import time
+from typing import Any
+from typing import List
+
+import pytest
+
+import flakeeval
+
+
+def completed(returncode: int, stdout: str = "", stderr: str = "") -> Any:
+    return subprocess.CompletedProcess([], returncode, stdout, stderr)
+
+
+def test_evaluate(monkeypatch: pytest.MonkeyPatch) -> None:
+    commands: List[List[str]] = []
+
+    def run(cmd: List[str], **kwargs: Any) -> Any:
+        commands.append(cmd)
+        return completed(0, '{"drvPath": "/drv", "outPath": "/out"}')
+
+    monkeypatch.setattr(subprocess, "run", run)
+    attr = flakeeval.attribute("nixos", "alpha")
+    result = flakeeval.evaluate("alpha", attr)
+
+    assert result.to_dict() == {
+        "name": "alpha",
+        "attr": "nixosConfigurations.alpha.config.system.build.toplevel",
+        "drvPath": "/drv",
+        "outPath": "/out",
+        "time": result.seconds,
+        "error": "",
+        "cached": False,
+    }
+    assert commands[0][:2] == ["nix", "eval"]
+
+    # The resident memory is limited by a systemd scope
+    flakeeval.evaluate("alpha", attr, max_memory=2048)
+    assert commands[1][:3] == ["systemd-run", "--user", "--scope"]
+    assert "MemoryMax=2048M" in commands[1]
+    sep = commands[1].index("--")
+    assert commands[1][sep + 1 :] == commands[0]  # noqa: E203
+
+
+@pytest.mark.parametrize(
+    "proc, max_memory, error",
+    [
+        (
+            completed(1, stderr="warning\nerror: undefined variable"),
+            0,
+            "error: undefined variable",
+        ),
+        (completed(1), 0, "exit 1"),
+        (completed(-signal.SIGKILL), 1024, "out of memory (max 1024 MiB)"),
+        (completed(-signal.SIGKILL), 0, "exit -9"),
+    ],
+)
+def test_evaluate_error(
+    monkeypatch: pytest.MonkeyPatch, proc: Any, max_memory: int, error: str
+) -> None:
+    monkeypatch.setattr(subprocess, "run", lambda *args, **kwargs: proc)
+
+    result = flakeeval.evaluate("alpha", "attr", max_memory)
+    assert result.error == error
+
+
+def fake_evaluate(name: str, attr: str, max_memory: int) -> Any:
+    if name != "beta":
+        time.sleep(0.2)
+    return flakeeval.EvalResult(
+        name,
+        attr,
+        drv_path=f"/drv/{name}",
+        out_path=f"/out/{name}",
+        error="failed" if name == "beta" else "",
+    )
+
+
+def test_evaluate_all(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(flakeeval, "evaluate", fake_evaluate)
+    attrs = {name: f"attr.{name}" for name in ["alpha", "beta", "gamma"]}
+
+    results = flakeeval.evaluate_all(attrs, 2)
+    assert [r.name for r in results] == ["alpha", "beta", "gamma"]
+    assert [r.error for r in results] == ["", "failed", ""]
+
+
+def test_evaluate_all_fail_fast(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(flakeeval, "evaluate", fake_evaluate)
+    attrs = {name: f"attr.{name}" for name in ["beta", "alpha", "gamma"]}
+
+    # The worker can start alpha before the cancel, gamma can not start
+    # before the end of alpha: it is cancelled, and reported
+    results = flakeeval.evaluate_all(attrs, 1, fail_fast=True)
+    assert [r.name for r in results] == ["beta", "alpha", "gamma"]
+    assert results[0].error == "failed"
+    assert results[1].error in ["", "cancelled"]
+    assert results[2].error == "cancelled"
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import shutil
+from pathlib import Path
+from typing import List
+
+import pytest
+from conftest import write_files
+
+import hostsummary
+
+# lscpu and inxi reports of the hosts pages, before the HostSummary parsers
+FIXTURES = Path(__file__).parent / "fixtures" / "hosts"
+
+LSCPU = """Architecture:            x86_64
+  CPU op-mode(s):        32-bit, 64-bit
+CPU(s):                  8
+Model name:              Intel(R) Core(TM) i7-8550U CPU @ 1.80GHz
+BogoMIPS:                3999.93
+NUMA node0 CPU(s):       0-7
+"""
+
+INXI = (
+    "System: Host: alpha Kernel: 6.1.55 arch: x86_64 bits: 64 "
+    "Console: pty pts/0 Distro: NixOS 23.05 "
+    "CPU: Info: quad core model: Intel Core i7-8550U bits: 64 type: MT MCP "
+    "Memory: System RAM: total: 15.54 GiB available: 15.4 GiB "
+    "Local Storage: total: 476.94 GiB used: 98.7 GiB (20.7%)"
+)
+
+
+def test_parse() -> None:
+    summary = hostsummary.HostSummary()
+    hostsummary.parse_lscpu(LSCPU, summary)
+    hostsummary.parse_inxi(INXI, summary)
+
+    assert summary.to_dict() == {
+        "memory": "16 Go",
+        "disk": "476.94 GiB",
+        "kernel": "6.1.55",
+        "cpu": {
+            "arch": "x86_64",
+            "model": "Intel(R) Core(TM) i7-8550U CPU @ 1.80GHz",
+            "nb": "8",
+            "bits": "64",
+            "bogomips": 3999,
+        },
+    }
+    assert summary.lines() == [
+        "Arch     : x86_64",
+        "CPU      : 8 x Intel(R) Core(TM) i7-8550U CPU @ 1.80GHz",
+        "BogoMIPS : 3999",
+        "RAM      : 16 Go",
+        "DISK     : 476.94 GiB",
+        "KERNEL   : 6.1.55",
+    ]
+
+
+def test_parse_partial() -> None:
+    summary = hostsummary.HostSummary()
+    hostsummary.parse_lscpu("Architecture: aarch64\nBogoMIPS: -\n", summary)
+    hostsummary.parse_inxi("System: Host: beta", summary)
+
+    assert summary.lines() == ["Arch     : aarch64"]
+
+
+@pytest.fixture
+def hosts(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(hostsummary, "_cache", None)
+    write_files(
+        tmp_path,
+        {
+            "docs/hosts/alpha/cpu.txt": LSCPU,
+            "docs/hosts/alpha/hardwares.txt": INXI,
+        },
+    )
+
+    return tmp_path
+
+
+def test_load_cached(hosts: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    summary = hostsummary.load("alpha")
+    assert summary.memory == "16 Go"
+    assert (hosts / hostsummary.CACHE_FILE).exists()
+
+    # Unchanged reports, the summary of the cache file is used
+    parsed = []
+    monkeypatch.setattr(hostsummary, "_cache", None)
+    monkeypatch.setattr(
+        hostsummary, "parse_lscpu", lambda *args: parsed.append(args)
+    )
+    assert hostsummary.load("alpha") == summary
+    assert parsed == []
+
+    # Changed report
+    write_files(hosts, {"docs/hosts/alpha/cpu.txt": "CPU(s): 4\n"})
+    hostsummary.load("alpha")
+    assert len(parsed) == 1
+
+
+def test_load_without_reports(hosts: Path) -> None:
+    assert hostsummary.load("beta") == hostsummary.HostSummary()
+
+
+@pytest.mark.parametrize(
+    "hostname, lines",
+    [
+        (
+            "badxps",
+            [
+                "Arch     : x86_64",
+                "CPU      : 12 x Intel(R) Core(TM) i7-8750H CPU @ 2.20GHz",
+                "BogoMIPS : 4399",
+                "RAM      : 16 Go",
+                "DISK     : 476.94 GiB",
+                "KERNEL   : 6.1.20",
+            ],
+        ),
+        (
+            "rpi40",
+            [
+                "Arch     : aarch64",
+                "CPU      : 4 x Cortex-A72",
+                "BogoMIPS : 108",
+                "RAM      : 8 Go",
+                "DISK     : 495.48 GiB",
+                "KERNEL   : 5.15.84",
+            ],
+        ),
+    ],
+)
+def test_load_reports(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    hostname: str,
+    lines: List[str],
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(hostsummary, "_cache", None)
+    shutil.copytree(FIXTURES / hostname, tmp_path / "docs/hosts" / hostname)
+
+    # The unit is no longer repeated ("16 Go Go", "476.94 GiB Go")
+    assert hostsummary.load(hostname).lines() == lines
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+from pathlib import Path
+from typing import Any
+from typing import Dict
+
+import pytest
+
+import inventory
+
+
+def homelab(**hosts: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "domain": "homelab.lan",
+        "roles": {"dns": {}, "nix-serve": {}},
+        "hosts": {
+            hn: {"ipv4": f"192.168.0.{idx + 1}", "os": "NixOS", **hinfo}
+            for idx, (hn, hinfo) in enumerate(hosts.items())
+        },
+    }
+
+
+def test_indexes() -> None:
+    inv = inventory.Inventory(
+        homelab(
+            router={"parent": "internet", "zone": "home", "roles": ["dns"]},
+            nas={"parent": "router", "zone": "home", "roles": ["nix-serve"]},
+            desktop={"parent": "nas", "zone": "home", "roles": ["dns"]},
+        )
+    )
+
+    assert inv.host_by_ip("192.168.0.2").name == "nas"
+    assert inv.host_by_ip("192.168.0.9") is None
+    assert [h.name for h in inv.hosts_with_role("dns")] == [
+        "router",
+        "desktop",
+    ]
+    assert [h.name for h in inv.hosts_in_zone("home")] == [
+        "router",
+        "nas",
+        "desktop",
+    ]
+    assert [h.name for h in inv.children("router")] == ["nas"]
+    assert inv.ancestors("desktop") == ["nas", "router"]
+    assert [inv.depth(hn) for hn in ["router", "nas", "desktop"]] == [0, 1, 2]
+
+
+def test_missing_field() -> None:
+    jinfo = homelab(router={})
+    del jinfo["hosts"]["router"]["os"]
+
+    with pytest.raises(inventory.InventoryError, match="missing 'os'"):
+        inventory.Inventory(jinfo)
+
+
+def test_duplicate_ipv4() -> None:
+    jinfo = homelab(router={}, nas={})
+    jinfo["hosts"]["nas"]["ipv4"] = jinfo["hosts"]["router"]["ipv4"]
+
+    with pytest.raises(
+        inventory.InventoryError, match="already used by router"
+    ):
+        inventory.Inventory(jinfo)
+
+
+def test_undefined_role() -> None:
+    with pytest.raises(inventory.InventoryError, match="'dhcp' not defined"):
+        inventory.Inventory(homelab(router={"roles": ["dhcp"]}))
+
+
+def test_unknown_parent() -> None:
+    with pytest.raises(inventory.InventoryError, match="unknown parent"):
+        inventory.Inventory(homelab(nas={"parent": "router"}))
+
+
+@pytest.mark.parametrize(
+    "parents",
+    [
+        {"router": "router"},
+        {"router": "nas", "nas": "router"},
+        {"desktop": "nas", "nas": "switch", "switch": "nas"},
+    ],
+)
+def test_parent_loop(parents: Dict[str, str]) -> None:
+    hosts = {hn: {"parent": parent} for hn, parent in parents.items()}
+    for parent in parents.values():
+        hosts.setdefault(parent, {})
+
+    with pytest.raises(inventory.InventoryError, match="parent loop"):
+        inventory.Inventory(homelab(**hosts))
+
+
+def test_load_cached(tmp_path: Path) -> None:
+    filename = str(tmp_path / "homelab.json")
+    with open(filename, "w") as fw:
+        json.dump(homelab(router={}), fw)
+
+    inv = inventory.load(filename)
+    assert inventory.load(filename) is inv
+
+    with open(filename, "w") as fw:
+        json.dump(homelab(router={}, nas={}), fw)
+    st = os.stat(filename)
+    os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+
+    assert list(inventory.load(filename).hosts) == ["router", "nas"]
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+from pathlib import Path
+from typing import Any
+from typing import List
+
+import pytest
+
+import nixlog
+
+DRV_HELLO = "/nix/store/" + "a" * 32 + "-hello-2.12.drv"
+DRV_WORLD = "/nix/store/" + "b" * 32 + "-world-1.0.drv"
+
+
+def line(action: str, **fields: Any) -> str:
+    return f"{nixlog.PREFIX}{json.dumps({'action': action, **fields})}\n"
+
+
+def start_build(aid: int, drv: str) -> str:
+    return line(
+        "start",
+        id=aid,
+        type=nixlog.ACT_BUILD,
+        text=f"building '{drv}'",
+        fields=[drv, "", 1, 1],
+    )
+
+
+def test_counters() -> None:
+    progress = nixlog.BuildProgress()
+    for event in [
+        "building the system configuration...\n",
+        f"{nixlog.PREFIX}{{not json\n",
+        start_build(1, DRV_HELLO),
+        line("result", id=1, type=nixlog.RES_SET_PHASE, fields=["build"]),
+        line("start", id=2, type=nixlog.ACT_SUBSTITUTE, text="copying"),
+        line("start", id=3, type=nixlog.ACT_FILE_TRANSFER, text="get"),
+        line("result", id=3, type=nixlog.RES_PROGRESS, fields=[512, 0, 0, 0]),
+        line("result", id=3, type=nixlog.RES_PROGRESS, fields=[2048, 0, 0, 0]),
+        line("stop", id=3),
+        line("stop", id=2),
+    ]:
+        progress.feed(event)
+
+    assert progress.activity() == "building 'hello-2.12.drv' (build)"
+    assert progress.status_line() == (
+        "0 built, 1 substituted, 2KiB downloaded, "
+        "building 'hello-2.12.drv' (build)"
+    )
+
+    progress.feed(line("stop", id=1))
+    assert progress.built == 1
+    assert progress.status_line() == "1 built, 1 substituted, 2KiB downloaded"
+
+
+def test_failed_builds() -> None:
+    progress = nixlog.BuildProgress()
+    for event in [
+        start_build(1, DRV_HELLO),
+        start_build(2, DRV_WORLD),
+        # nix < 2.19, the error before the build stop
+        line(
+            "msg",
+            level=nixlog.LVL_ERROR,
+            msg=f"\x1b[31;1merror:\x1b[0m builder for '{DRV_HELLO}' failed",
+        ),
+        line("stop", id=1),
+        line("stop", id=2),
+        # nix >= 2.19, the error after the build stop
+        line(
+            "msg",
+            level=nixlog.LVL_ERROR,
+            msg=f"error: Cannot build '{DRV_WORLD}'.",
+        ),
+        line("msg", level=nixlog.LVL_ERROR, msg="error: 1 dependency failed"),
+    ]:
+        progress.feed(event)
+
+    assert progress.built == 0
+    assert progress.failed == [DRV_HELLO, DRV_WORLD]
+    assert len(progress.errors) == 3
+    assert progress.status_line() == (
+        "0 built, 2 failed, 0 substituted, 0B downloaded"
+    )
+
+
+def test_follow(tmp_path: Path) -> None:
+    filename = str(tmp_path / "alpha.log")
+    progress = nixlog.BuildProgress()
+    shown: List[str] = []
+
+    with nixlog.follow(
+        filename, progress, lambda p: shown.append(p.status_line())
+    ) as output:
+        output.write(start_build(1, DRV_HELLO))
+        output.write(line("stop", id=1))
+
+    assert progress.built == 1
+    assert shown[-1] == "1 built, 0 substituted, 0B downloaded"
+    with open(filename, "r") as fr:
+        assert fr.read() == start_build(1, DRV_HELLO) + line("stop", id=1)
+
+
+def test_parse_dry_run() -> None:
+    report = nixlog.parse_dry_run(
+        "\n".join(
+            [
+                "warning: Git tree '/root/nix-homelab' is dirty",
+                "these 2 derivations will be built:",
+                f"  {DRV_HELLO}",
+                f"  {DRV_WORLD}",
+                "these 3 paths will be fetched "
+                "(1.50 MiB download, 6.00 MiB unpacked):",
+                "  /nix/store/" + "c" * 32 + "-glibc-2.38",
+                "  /nix/store/" + "d" * 32 + "-bash-5.2",
+                "  /nix/store/" + "e" * 32 + "-zlib-1.3",
+            ]
+        )
+    )
+
+    assert report.built == [DRV_HELLO, DRV_WORLD]
+    assert len(report.fetched) == 3
+    assert report.download == int(1.5 * 1024**2)
+    assert report.unpacked == 6 * 1024**2
+
+
+@pytest.mark.parametrize(
+    "header",
+    [
+        "this derivation will be built:",
+        "these derivations will be built:",
+        "\x1b[1mthese 1 derivations will be built:\x1b[0m",
+    ],
+)
+def test_parse_dry_run_built(header: str) -> None:
+    report = nixlog.parse_dry_run("\n".join([header, f"  {DRV_HELLO}"]))
+
+    assert report.built == [DRV_HELLO]
+    assert report.fetched == []
+
+
+@pytest.mark.parametrize(
+    "header, download",
+    [
+        (
+            "this path will be fetched (12.5 KiB download, 50 KiB unpacked):",
+            12800,
+        ),
+        (
+            "these paths will be fetched (0.01 MiB download, 1 MiB unpacked):",
+            10485,
+        ),
+        ("these paths will be fetched:", 0),
+    ],
+)
+def test_parse_dry_run_fetched(header: str, download: int) -> None:
+    report = nixlog.parse_dry_run("\n".join([header, f"  {DRV_HELLO}"]))
+
+    assert report.built == []
+    assert report.fetched == [DRV_HELLO]
+    assert report.download == download
+
+
+def test_parse_dry_run_nothing() -> None:
+    report = nixlog.parse_dry_run(
+        "\n".join(["copying path", f"  {DRV_HELLO}"])
+    )
+
+    assert report == nixlog.DryRun()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import threading
+import time
+from pathlib import Path
+from typing import List
+
+import pytest
+
+deploykit = pytest.importorskip("deploykit")
+
+import tasks  # noqa: E402
+
+
+def hostnames(waves: List[List[deploykit.DeployHost]]) -> List[List[str]]:
+    return [[h.meta["hostname"] for h in wave] for wave in waves]
+
+
+def test_waves(homelab: Path) -> None:
+    hosts = tasks.get_deploylist_from_homelab("root", "")
+
+    # The infra hosts by depth (parents, or with an infra role), then the
+    # canary and the other leaf hosts, grouped by zone
+    assert hostnames(tasks._rollout_waves(hosts, 1)) == [
+        ["router"],
+        ["nas"],
+        ["box"],
+        ["vps1", "vps2", "desktop", "laptop"],
+    ]
+    assert hostnames(tasks._rollout_waves(hosts, 2)) == [
+        ["router"],
+        ["nas"],
+        ["box", "vps1"],
+        ["vps2", "desktop", "laptop"],
+    ]
+    assert hostnames(tasks._rollout_waves(hosts, 0)) == [
+        ["router"],
+        ["nas"],
+        ["box", "vps1", "vps2", "desktop", "laptop"],
+    ]
+
+
+def test_waves_canary_all_leaves(homelab: Path) -> None:
+    hosts = tasks.get_deploylist_from_homelab("root", "laptop,desktop")
+
+    # No canary wave without other leaf hosts
+    assert hostnames(tasks._rollout_waves(hosts, 2)) == [["desktop", "laptop"]]
+
+
+def test_rollout_all_at_once(homelab: Path) -> None:
+    hosts = tasks.get_deploylist_from_homelab("root", "")
+
+    def deploy(h: deploykit.DeployHost) -> str:
+        if h.meta["hostname"] == "router":
+            raise Exception("boom")
+        return "deployed"
+
+    # Without waves, a failed host does not stop the others
+    statuses = tasks._run_rollout(hosts, deploy, 0, 1)
+    assert statuses.pop("router") == "failed: boom"
+    assert set(statuses.values()) == {"deployed"}
+
+
+def test_rollout_waves(homelab: Path) -> None:
+    hosts = tasks.get_deploylist_from_homelab("root", "")
+    deployed: List[str] = []
+
+    def deploy(h: deploykit.DeployHost) -> str:
+        if h.meta["hostname"] == "box":
+            raise Exception("boom")
+        deployed.append(h.meta["hostname"])
+        return "deployed"
+
+    # The failed canary stops the rollout
+    statuses = tasks._run_rollout(hosts, deploy, 0, 1, waves=True)
+    assert deployed == ["router", "nas"]
+    assert statuses == {
+        "router": "deployed",
+        "nas": "deployed",
+        "box": "failed: boom",
+        "desktop": "skipped",
+        "laptop": "skipped",
+        "vps1": "skipped",
+        "vps2": "skipped",
+    }
+
+
+def test_rollout_max_parallel(homelab: Path) -> None:
+    hosts = tasks.get_deploylist_from_homelab("root", "")
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def deploy(h: deploykit.DeployHost) -> str:
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return "deployed"
+
+    statuses = tasks._run_rollout(hosts, deploy, 2, 0)
+    assert set(statuses.values()) == {"deployed"}
+    assert running[1] == 2
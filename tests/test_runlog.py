@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from pathlib import Path
+
+import pytest
+
+import runlog
+
+
+def test_run(tmp_path: Path) -> None:
+    log = runlog.RunLog("nixos.switch", str(tmp_path))
+    with log.phase(runlog.RUN_HOST, "eval"):
+        pass
+    with log.phase("alpha", "rebuild"):
+        log.transferred("alpha", 2048)
+        log.transferred("alpha", 1024)
+    with pytest.raises(RuntimeError):
+        with log.phase("beta", "rebuild"):
+            raise RuntimeError("build failed")
+    with log.phase("beta", "rebuild"):
+        pass
+    log.status("alpha", "deployed")
+
+    run = runlog.load_run(log.filename)
+    assert run["command"] == "nixos.switch"
+    assert run["hosts"] == log.hosts
+    assert list(run["hosts"]) == [runlog.RUN_HOST, "alpha", "beta"]
+    assert run["hosts"]["alpha"]["bytes"] == 3072
+    assert run["hosts"]["alpha"]["status"] == "deployed"
+    # The durations of a repeated phase are added
+    assert list(run["hosts"]["beta"]["phases"]) == ["rebuild"]
+
+    assert log.logfile("alpha") == str(tmp_path / log.id / "alpha.log")
+
+
+def test_find_run(tmp_path: Path) -> None:
+    for name in ["20240101-000000-1", "20240102-000000-1"]:
+        (tmp_path / f"{name}.jsonl").write_text("")
+
+    first = str(tmp_path / "20240101-000000-1.jsonl")
+    last = str(tmp_path / "20240102-000000-1.jsonl")
+    assert runlog.list_runs(str(tmp_path)) == [first, last]
+    assert runlog.find_run("-1", str(tmp_path)) == last
+    assert runlog.find_run("0", str(tmp_path)) == first
+    assert runlog.find_run("20240101-000000-1", str(tmp_path)) == first
+    assert runlog.find_run(last, str(tmp_path)) == last
+    with pytest.raises(FileNotFoundError):
+        runlog.find_run("20240103-000000-1", str(tmp_path))
+
+
+def test_format_size() -> None:
+    assert runlog.format_size(0) == "0B"
+    assert runlog.format_size(2048) == "2KiB"
+    assert runlog.format_size(5 * 1024**2) == "5MiB"
+    assert runlog.format_size(3 * 1024**3) == "3.0GiB"
+
+
+def test_format_summary() -> None:
+    hosts = {
+        "alpha": {"phases": {"rebuild": 12.34}, "status": "ok", "bytes": 0},
+        "beta": {"phases": {"copy": 1.0}, "status": "failed", "bytes": 1024},
+    }
+
+    assert runlog.format_summary(hosts) == [
+        "host                    rebuild       copy     bytes  status",
+        "alpha                     12.3s          -        0B  ok",
+        "beta                          -       1.0s      1KiB  failed",
+    ]
+
+
+def test_compare() -> None:
+    before = {"alpha": {"phases": {"rebuild": 10.0, "copy": 2.0}}}
+    after = {
+        "alpha": {"phases": {"rebuild": 7.5}},
+        "beta": {"phases": {"rebuild": 3.0}},
+    }
+
+    assert runlog.compare(before, after) == [
+        "host                phase             before     after      diff",
+        "alpha               rebuild            10.0s      7.5s     -2.5s",
+        "alpha               copy                2.0s         -         -",
+        "beta                rebuild                -      3.0s         -",
+    ]
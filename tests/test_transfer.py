@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import subprocess
+from pathlib import Path
+from typing import Any
+from typing import List
+
+import pytest
+
+deploykit = pytest.importorskip("deploykit")
+
+import runlog  # noqa: E402
+import tasks  # noqa: E402
+
+SYSTEM = "/nix/store/" + "a" * 32 + "-nixos-system-vps1"
+GLIBC = "/nix/store/" + "b" * 32 + "-glibc-2.38"
+
+
+class Builder:
+    """
+    Builder host running nix copy then nix path-info (nix >= 2.19 output)
+    """
+
+    def __init__(self) -> None:
+        self.commands: List[str] = []
+
+    def run(self, cmd: str, **kwargs: Any) -> Any:
+        self.commands.append(cmd)
+        stdout, stderr = "", ""
+        if "nix copy" in cmd:
+            stderr = "\n".join(
+                [
+                    f"copying path '{GLIBC}' to 'ssh://root@10.0.0.1'...",
+                    f"copying path '{SYSTEM}' to 'ssh://root@10.0.0.1'...",
+                    f"copying path '{GLIBC}' to 'ssh://root@10.0.0.1'...",
+                    "copying 2 paths...",
+                ]
+            )
+        elif "nix path-info" in cmd:
+            stdout = json.dumps(
+                {GLIBC: {"narSize": 30000}, SYSTEM: {"narSize": 2000}}
+            )
+
+        return subprocess.CompletedProcess(cmd, 0, stdout, stderr)
+
+
+def test_copy_closure(tmp_path: Path) -> None:
+    log = runlog.RunLog("nixos.switch", str(tmp_path))
+    builder = Builder()
+    h = deploykit.DeployHost(
+        "10.0.0.1", user="root", meta={"hostname": "vps1"}
+    )
+
+    tasks._nixos_copy_closure(builder, h, SYSTEM, log)
+
+    # The sizes of the copied paths are queried once, on the builder
+    assert "--log-format raw" in builder.commands[0]
+    assert builder.commands[1] == f"nix path-info --json {SYSTEM} {GLIBC}"
+    assert log.hosts["vps1"]["bytes"] == 32000
+
+
+def test_copy_nothing(tmp_path: Path) -> None:
+    log = runlog.RunLog("nixos.switch", str(tmp_path))
+    builder = Builder()
+
+    tasks._log_copied_paths(log, "vps1", builder, "copying 0 paths...")
+    tasks._log_copied_paths(None, "vps1", builder, f"copying path '{SYSTEM}'")
+
+    assert builder.commands == []
+    assert "vps1" not in log.hosts